@@ -0,0 +1,61 @@
+from hashlib import sha256
+from typing import IO
+
+chunk_size = 1048576
+
+
+class AnswerHash:
+    '''
+    Hash of an output as acmoj-checker compares it: sha256 of the bytes,
+    or if ignore_whitespace is set, of the lines that are not blank, each
+    without trailing whitespace and followed by a newline. Outputs with
+    the same hash are the same to the checker, so outputs could be checked
+    against the hash of the answer without the answer itself.
+    '''
+
+    def __init__(self, ignore_whitespace: bool):
+        self.ignore_whitespace = ignore_whitespace
+        self.hash = sha256()
+        # whitespace of the current line not hashed yet, as it is only
+        # part of the line if something else follows it.
+        self.pending = b''
+        self.blank = True
+
+    def _segment(self, segment: bytes):
+        stripped = segment.rstrip()
+        if stripped == b'':
+            self.pending += segment
+            return
+        self.hash.update(self.pending)
+        self.hash.update(stripped)
+        self.pending = segment[len(stripped):]
+        self.blank = False
+
+    def _end_line(self):
+        if not self.blank:
+            self.hash.update(b'\n')
+        self.pending = b''
+        self.blank = True
+
+    def update(self, data: bytes):
+        if not self.ignore_whitespace:
+            self.hash.update(data)
+            return
+        *lines, last = data.split(b'\n')
+        for line in lines:
+            self._segment(line)
+            self._end_line()
+        self._segment(last)
+
+    def hexdigest(self) -> str:
+        if self.ignore_whitespace:
+            # the last line counts even without a newline.
+            self._end_line()
+        return self.hash.hexdigest()
+
+
+def hash_answer(file: IO[bytes], ignore_whitespace: bool) -> str:
+    h = AnswerHash(ignore_whitespace)
+    while (data := file.read(chunk_size)) != b'':
+        h.update(data)
+    return h.hexdigest()
@@ -0,0 +1,35 @@
+from base64 import b64decode, b64encode
+from hashlib import blake2b
+
+
+class BloomFilter:
+    '''
+    A fixed size bloom filter over strings, used by runners to advertise
+    the contents of their file cache to the scheduler.
+    '''
+
+    def __init__(self, bits: int, hashes: int, data: bytearray | None = None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = data if data is not None else bytearray((bits + 7) // 8)
+
+    def _indices(self, item: str):
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str):
+        for i in self._indices(item):
+            self.data[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.data[i >> 3] & (1 << (i & 7)) for i in self._indices(item))
+
+    def dump(self) -> str:
+        return f'{self.bits} {self.hashes} {b64encode(self.data).decode()}'
+
+    @staticmethod
+    def load(dump: str) -> 'BloomFilter':
+        bits, hashes, data = dump.split(' ', 2)
+        return BloomFilter(int(bits), int(hashes), bytearray(b64decode(data)))
@@ -62,12 +62,22 @@ class ResourceUsage(DataclassBase):
     file_size_bytes: int
 
 
+@dataclass
+class CompileCache(DataclassBase):
+    # signed urls of the shared compile cache object for this task
+    get: FileUrl
+    put: FileUrl
+
+
 @dataclass
 class CompileTask(DataclassBase):
     source: CompileSource
     supplementary_files: list[FileUrl]
     artifact: Artifact | None
     limits: ResourceUsage
+    cache: CompileCache | None = None
+    # supplementary files to build precompiled headers for (C++ only)
+    precompiled_headers: list[str] = field(default_factory=lambda: [])
 
 
 type Input = CompileTask | Artifact
@@ -100,6 +110,8 @@ class RunArgs(DataclassBase):
 class CompareChecker(DataclassBase):
     ignore_whitespace: bool
     answer: FileUrl
+    # commons.answer_hash of the answer, if known
+    answer_hash: str | None = None
 
 
 @dataclass
@@ -109,7 +121,10 @@ class DirectChecker(DataclassBase):
 
 @dataclass
 class SpjChecker(DataclassBase):
-    format: Literal["checker", "scorer"]
+    # checker: run for each testpoint with file paths in argv
+    # batch: run once per task, checking testpoints on request, see
+    #     judger2.steps.batch_check
+    format: Literal["checker", "scorer", "batch"]
     executable: Input
     answer: FileUrl | None
     supplementary_files: list[FileUrl]
@@ -132,6 +147,11 @@ class Testpoint[T: (Input, InputPlan)](DataclassBase):
 @dataclass
 class JudgeTask[T: (Input, InputPlan)](DataclassBase):
     testpoints: list[Testpoint[T]]
+    # run each testpoint in a fresh working directory, for tasks that are
+    # batches of independent testpoints.
+    isolated: bool = False
+    # version of the judge plan the task is from, see JudgePlan.version
+    plan_version: str | None = None
 
 
 type TaskType = CompileTask | JudgeTask[Input]
@@ -180,6 +200,9 @@ type CompileResultType = CompileError | RunError | Aborted | MiscError | Compile
 class CompileResult(DataclassBase):
     result: CompileResultType
     message: str
+    # hash of everything the compile output depends on, if cacheable
+    cache_key: str | None = None
+    cache_hit: bool = False
 
 
 @dataclass
@@ -290,6 +313,7 @@ class CompileTaskPlan(DataclassBase):
     supplementary_files: list[FileUrl | UserCode]
     artifact: bool
     limits: ResourceUsage
+    precompiled_headers: list[str] = field(default_factory=lambda: [])
 
 
 @dataclass
@@ -322,6 +346,12 @@ class QuizProblem(DataclassBase):
     options: list[QuizOption] | None = None
 
 
+@dataclass
+class BatchPlan(DataclassBase):
+    target_msecs: int
+    max_testpoints: int
+
+
 DEFAULT_GROUP = "default"
 
 
@@ -332,6 +362,10 @@ class JudgePlan(DataclassBase):
     judge: list[JudgeTaskPlan] = field(default_factory=lambda: [])
     score: list[TestpointGroup] = field(default_factory=lambda: [])
     quiz: list[QuizProblem] | None = None
+    batch: BatchPlan | None = None
+    # changes every time the plan is generated, i.e. every time the problem
+    # is updated, so that runners know when problem files could change.
+    version: str | None = None
 
 
 # Please sync changes to web/static/api/api.yml
@@ -1,12 +1,13 @@
 import json
 from asyncio import get_running_loop
-from dataclasses import dataclass, is_dataclass
+from dataclasses import dataclass, field, is_dataclass
 from logging import getLogger
 from pathlib import PosixPath
 from shutil import rmtree
 from traceback import format_exception
-from typing import Any, Callable, Dict, Optional, Type, TypeVar
-from uuid import uuid4
+from typing import Any, Callable, Dict, List, Optional, Type, TypeVar
+from urllib.parse import urlsplit
+from uuid import NAMESPACE_URL, uuid4, uuid5
 
 
 logger = getLogger(__name__)
@@ -82,7 +83,8 @@ def deserialize(data: str) -> Any:
 
 
 working_dir: str | None = None
-before_exit: Callable[[PosixPath], None] | None = None
+# if before_exit returns True, it has taken over removing the dir.
+before_exit: Callable[[PosixPath], bool | None] | None = None
 
 class TempDir:
     path: PosixPath
@@ -98,14 +100,14 @@ class TempDir:
     def __exit__(self, *_args):
         logger.debug('exiting temp dir %(path)s', { 'path': self.path }, 'tempdir:exit')
         try:
-            if before_exit is not None:
-                before_exit(self.path)
+            if before_exit is not None and before_exit(self.path):
+                return
             rmtree(self.path, ignore_errors=True)
         except Exception as e:
             logger.error('error removing temp dir %(path)s: %(error)s', { 'path': self.path, 'error': e }, 'tempdir:remove')
 
     @staticmethod
-    def config(_working_dir: str, _before_exit: Callable[[PosixPath], None] | None = None):
+    def config(_working_dir: str, _before_exit: Callable[[PosixPath], bool | None] | None = None):
         global working_dir, before_exit
         working_dir = _working_dir
         before_exit = _before_exit
@@ -122,19 +124,21 @@ class RedisQueues:
             return f'{prefix}-{name}'
         self._prefix = prefix
         self._task_prefix = queue('task')
+        self._in_progress_prefix = f'{queue("in-progress")}-runner'
+        # status updates of all tasks, as a stream.
+        self.progress = queue('progress')
         if runner is not None:
             def rqueue(name: str):
                 return f'{queue(name)}-runner{runner.id}'
             self.tasks = queue(f'{runner.group}-tasks')
             self.in_progress = rqueue('in-progress')
             self.heartbeat = rqueue('heartbeat')
+            self.caches = self.caches_group(runner.group)
 
     class TaskRedisQueues:
         def __init__(self, prefix: str, id: str):
             def queue(name: str):
                 return f'{prefix}-{name}-{id}'
-            self.task = queue('task')
-            self.progress = queue('progress')
             self.abort = queue('abort')
     def task(self, task_id: str) -> TaskRedisQueues:
         return RedisQueues.TaskRedisQueues(self._task_prefix, task_id)
@@ -142,9 +146,87 @@ class RedisQueues:
     def tasks_group(self, group: str):
         return f'{self._prefix}-{group}-tasks'
 
+    # tasks sent to a specific runner because it has the files cached.
+    def tasks_runner(self, group: str, runner_id: str):
+        return f'{self.tasks_group(group)}-runner{runner_id}'
+
+    # a token is pushed here for every task pushed to a task queue, so
+    # that idle runners could block on all of their queues at once.
+    def wakeup(self, queue: str):
+        return f'{queue}-wakeup'
+
+    # cache contents of all runners in a group, as a hash from runner id.
+    def caches_group(self, group: str):
+        return f'{self._prefix}-{group}-caches'
+
     def runner(self, runner: RunnerInfo):
         return RedisQueues(self._prefix, runner)
 
+    # in-progress lists of all runners, for use with SCAN.
+    def all_in_progress(self) -> str:
+        return f'{self._in_progress_prefix}*'
+
+    def runner_id_from_in_progress(self, key: str) -> str:
+        return key[len(self._in_progress_prefix):]
+
+
+@dataclass
+class TaskMessage:
+    '''
+    A task as it is stored in the task queues. The payload is carried
+    inline, so that a runner could take a task into its in-progress list
+    with a single atomic LMOVE.
+    '''
+    id: str
+    # tasks still queued after this (unix) time are stale and are dropped.
+    deadline: float
+    payload: str
+
+    def dump(self) -> str:
+        return f'{self.id} {self.deadline} {self.payload}'
+
+    @staticmethod
+    def load(message: str) -> 'TaskMessage':
+        id, deadline, payload = message.split(' ', 2)
+        return TaskMessage(id, float(deadline), payload)
+
+    @staticmethod
+    def id_of(message: str) -> str:
+        return message[:message.index(' ')]
+
+
+@dataclass
+class Heartbeat:
+    '''
+    What a runner periodically writes to its heartbeat key: the time,
+    whether each of its task slots is running a task, and statistics of its
+    file cache. Runners without slots only write the time.
+    '''
+    time: float
+    slots: List[bool]
+    cache: Dict[str, int] = field(default_factory=dict)
+
+    def dump(self) -> str:
+        return json.dumps({ 'time': self.time, 'slots': self.slots, 'cache': self.cache })
+
+    @staticmethod
+    def load(heartbeat: str) -> 'Heartbeat':
+        try:
+            return Heartbeat(float(heartbeat), [False])
+        except ValueError:
+            pass
+        data = json.loads(heartbeat)
+        return Heartbeat(float(data['time']), [bool(x) for x in data['slots']],
+            data.get('cache', {}))
+
+
+def cache_id(url: str) -> str:
+    '''
+    The name under which runners cache the file at the given URL. Query
+    strings are ignored, so signed URLs of the same object share a name.
+    '''
+    return str(uuid5(NAMESPACE_URL, urlsplit(url).path))
+
 
 def format_exc(e: BaseException):
     return ''.join(format_exception(type(e), e, e.__traceback__))
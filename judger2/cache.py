@@ -1,18 +1,22 @@
-from asyncio import sleep
-from dataclasses import dataclass
+from asyncio import Task, create_task, shield, sleep
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from http.client import NOT_MODIFIED, OK
 from logging import getLogger
-from os import chmod, path, remove, rename, scandir, stat, unlink, utime
+from os import path, rename, scandir, stat, utime
 from pathlib import PosixPath
-from shutil import copy
 from time import time
 from urllib.parse import urlsplit
-from uuid import NAMESPACE_URL, uuid5
+from uuid import uuid4
 
-from aiohttp import request
+from aiohttp import ClientSession
 
+from commons.bloom import BloomFilter
+from commons.util import cache_id
 from judger2.config import config
+from judger2.materialize import materialize
 
 logger = getLogger(__name__)
 
@@ -25,17 +29,248 @@ class CachedFile:
 
 def cached_from_url(url: str) -> CachedFile:
     key = urlsplit(url).path
-    cache_id = str(uuid5(NAMESPACE_URL, key))
-    p = PosixPath(path.join(config.cache_dir, cache_id))
+    p = PosixPath(path.join(config.cache_dir, cache_id(url)))
     filename = PosixPath(key).name
     return CachedFile(p, filename)
 
 
+@dataclass
+class CacheEntry:
+    size: int
+    last_used: float
+    # when the file was last checked against the server, and the version
+    # of the judge plan of the task that checked it.
+    validated_at: float = 0.0
+    plan_version: str | None = None
+
+class CacheIndex:
+    '''
+    The files in the cache directory with their sizes, in order of last
+    use. Built once at startup and kept up to date as files are added and
+    used, so that the least recently used files could be evicted once the
+    cache grows beyond max_bytes without scanning the directory. Files
+    pinned by running tasks and files being fetched are not evicted.
+    '''
+
+    def __init__(self):
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+        # bloom filters do not support removal, so the filter of cached
+        # files is rebuilt once files have been removed.
+        self.filter_stale = False
+        # number of tasks using each file.
+        self.pins: dict[str, int] = {}
+
+    def rebuild(self):
+        files: list[tuple[str, CacheEntry]] = []
+        for file in scandir(config.cache_dir):
+            if not file.is_file(follow_symlinks=False) or file.name.endswith('.part'):
+                continue
+            st = file.stat()
+            files.append((file.name, CacheEntry(st.st_size, max(st.st_atime, st.st_mtime))))
+        files.sort(key=lambda x: x[1].last_used)
+        self.entries = OrderedDict(files)
+        self.total_bytes = sum(x.size for _, x in files)
+        self.evict()
+
+    def _discard(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def add(self, file: PosixPath):
+        '''Records a file that was written into the cache.'''
+        self._discard(file.name)
+        self.entries[file.name] = CacheEntry(file.stat().st_size, time())
+        self.total_bytes += self.entries[file.name].size
+        self.evict()
+
+    def touch(self, file: PosixPath):
+        '''Records a use of a cached file.'''
+        entry = self.entries.get(file.name)
+        if entry is None:
+            self.add(file)
+            return
+        entry.last_used = time()
+        self.entries.move_to_end(file.name)
+
+    def validated(self, file: PosixPath, plan_version: str | None):
+        '''Records that the cached file is up to date.'''
+        entry = self.entries.get(file.name)
+        if entry is not None:
+            entry.validated_at = time()
+            entry.plan_version = plan_version
+
+    def is_trusted(self, file: PosixPath, plan_version: str | None) -> bool:
+        '''
+        Whether the cached file could be used without checking it against
+        the server. Problem files are only changed by updating the problem,
+        which changes the plan version, so files checked by a judge task of
+        the same plan version are up to date. Files needed by tasks without
+        a plan version, such as compiling the checker while generating the
+        plan, are always checked.
+        '''
+        if plan_version is None:
+            return False
+        entry = self.entries.get(file.name)
+        if entry is None or entry.plan_version != plan_version:
+            return False
+        return entry.validated_at > time() - config.cache.trust_secs
+
+    def pin(self, name: str):
+        self.pins[name] = self.pins.get(name, 0) + 1
+
+    def unpin(self, name: str):
+        self.pins[name] -= 1
+        if self.pins[name] == 0:
+            del self.pins[name]
+        self.evict()
+
+    def remove(self, name: str):
+        self._discard(name)
+        self.filter_stale = True
+        PosixPath(config.cache_dir, name).unlink(missing_ok=True)
+
+    def evict(self):
+        if self.total_bytes <= config.cache.max_bytes:
+            return
+        # the most recently used file is kept, as it is about to be used.
+        candidates = [(name, entry) for name, entry in list(self.entries.items())[:-1]
+            if name not in self.pins and name not in fetching]
+        for name, entry in candidates:
+            if self.total_bytes <= config.cache.max_bytes:
+                break
+            logger.debug('evicting %(name)s of %(size)s bytes from cache', { 'name': name, 'size': entry.size }, 'cache:evict')
+            self.remove(name)
+            self.evicted_bytes += entry.size
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted_bytes': self.evicted_bytes,
+            'bytes': self.total_bytes,
+        }
+
+cache_index = CacheIndex()
+
+
+# ids of the cached files, advertised to the scheduler so that tasks are
+# preferably sent to runners that already have their files.
+cache_filter = BloomFilter(config.cache.bloom_bits, config.cache.bloom_hashes)
+
+def cache_summary() -> str:
+    if cache_index.filter_stale:
+        rebuild_cache_filter()
+    return cache_filter.dump()
+
+def rebuild_cache_filter():
+    global cache_filter
+    new_filter = BloomFilter(config.cache.bloom_bits, config.cache.bloom_hashes)
+    for name in cache_index.entries:
+        new_filter.add(name)
+    cache_filter = new_filter
+    cache_index.filter_stale = False
+
+
 utc_time_format = '%a, %d %b %Y %H:%M:%S GMT'
 
 
-async def ensure_cached(url: str) -> CachedFile:
+# all requests to the object storage share the connection pool of a
+# single session.
+_session: ClientSession | None = None
+
+def http_session() -> ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = ClientSession()
+    return _session
+
+
+@dataclass
+class CacheContext:
+    '''
+    Per-task state of the cache, set by the task handler. Files used by
+    the task are pinned in the cache until the task releases them.
+    '''
+    plan_version: str | None = None
+    requests: int = 0
+    trusted: int = 0
+    pin_files: bool = True
+    pinned: set[str] = field(default_factory=set)
+
+    def pin(self, file: PosixPath):
+        if self.pin_files and file.name not in self.pinned:
+            self.pinned.add(file.name)
+            cache_index.pin(file.name)
+
+    def release(self):
+        pinned, self.pinned = self.pinned, set()
+        for name in pinned:
+            cache_index.unpin(name)
+
+cache_context: ContextVar[CacheContext] = ContextVar('cache_context')
+
+def get_cache_context() -> CacheContext:
+    try:
+        return cache_context.get()
+    except LookupError:
+        # nobody would release the files of a context outside of a task.
+        context = CacheContext(pin_files=False)
+        cache_context.set(context)
+        return context
+
+
+class FileTooLargeException(Exception): pass
+
+# fetches in progress by cache file name, shared by everyone who needs the
+# file in the meantime.
+fetching: dict[str, Task[CachedFile]] = {}
+
+async def ensure_cached(url: str, max_bytes: int | None = None) -> CachedFile:
+    '''
+    Makes sure the cached copy of the file is up to date. If max_bytes is
+    given, files larger than that are not downloaded, and
+    FileTooLargeException is raised instead.
+    '''
     cache = cached_from_url(url)
+    context = get_cache_context()
+    # pinned before it is fetched, so that it is not evicted before the
+    # task gets to use it.
+    context.pin(cache.path)
+    if cache_index.is_trusted(cache.path, context.plan_version):
+        logger.debug('%(filename)s was checked recently, using cache', { 'filename': cache.filename, 'path': cache.path }, 'cache:trusted')
+        context.trusted += 1
+        cache_index.hits += 1
+        cache_index.touch(cache.path)
+        return cache
+    name = cache.path.name
+    while True:
+        task = fetching.get(name)
+        if task is None:
+            task = create_task(fetch(url, cache, context, max_bytes))
+            fetching[name] = task
+            def cleanup(_, task=task):
+                if fetching.get(name) is task:
+                    del fetching[name]
+            task.add_done_callback(cleanup)
+            # shield the fetch so that cancelling one user does not cancel
+            # the fetch for the others.
+            return await shield(task)
+        try:
+            return await shield(task)
+        except FileTooLargeException:
+            # the fetch we joined had a smaller limit than ours.
+            if max_bytes is not None:
+                raise
+            if fetching.get(name) is task:
+                del fetching[name]
+
+async def fetch(url: str, cache: CachedFile, context: CacheContext,
+                max_bytes: int | None) -> CachedFile:
     logger.debug('caching file %(filename)s to %(path)s', { 'filename': cache.filename, 'path': cache.path }, 'cache:ensure')
     headers: dict[str, str] = {}
     try:
@@ -45,15 +280,23 @@ async def ensure_cached(url: str) -> CachedFile:
         headers['If-Modified-Since'] = utc_string
     except FileNotFoundError:
         mtime = time()
-    async with request('GET', url, headers=headers) as resp:
+    context.requests += 1
+    async with http_session().get(url, headers=headers) as resp:
         if resp.status == NOT_MODIFIED:
             logger.debug('%(filename)s is not modified, using cache', { 'filename': cache.filename, 'path': cache.path }, 'cache:hit')
             utime(cache.path, (time(), mtime))
+            cache_index.hits += 1
+            cache_index.touch(cache.path)
+            cache_index.validated(cache.path, context.plan_version)
+            cache_filter.add(cache.path.name)
             return cache
         if resp.status != OK:
             raise Exception(f'Unknown response status {resp.status} while fetching object')
+        if max_bytes is not None \
+        and (resp.content_length is None or resp.content_length > max_bytes):
+            raise FileTooLargeException(f'{cache.filename} is larger than {max_bytes} bytes')
         logger.debug('%(filename)s is modified, downloading file', { 'filename': cache.filename, 'path': cache.path }, 'cache:miss')
-        part_path = cache.path.with_suffix('.part')
+        part_path = cache.path.with_name(f'{cache.path.name}.{uuid4()}.part')
         try:
             with open(part_path, 'wb') as f:
                 async for data, _ in resp.content.iter_chunks():
@@ -65,8 +308,12 @@ async def ensure_cached(url: str) -> CachedFile:
             utime(part_path, (time(), last_modified))
             rename(part_path, cache.path)
         except:
-            unlink(part_path, missing_ok=True)
+            part_path.unlink(missing_ok=True)
             raise
+        cache_index.misses += 1
+        cache_index.add(cache.path)
+        cache_index.validated(cache.path, context.plan_version)
+        cache_filter.add(cache.path.name)
         return cache
 
 
@@ -74,29 +321,48 @@ async def upload(local_path: PosixPath, url: str) -> CachedFile:
     cache = cached_from_url(url)
     if not local_path.is_file() or local_path.is_symlink():
         raise ValueError('File to upload is not regular file')
-    copy(local_path, cache.path)
-    chmod(cache.path, 0o640)
+    part_path = cache.path.with_name(f'{cache.path.name}.{uuid4()}.part')
+    try:
+        materialize(local_path, part_path, 0o640)
+        rename(part_path, cache.path)
+    except:
+        part_path.unlink(missing_ok=True)
+        raise
     utime(cache.path)
+    context = get_cache_context()
+    context.pin(cache.path)
+    cache_index.add(cache.path)
+    cache_filter.add(cache.path.name)
+    context.requests += 1
     with open(cache.path, 'rb') as f:
-        async with request('PUT', url, data=f) as resp:
+        async with http_session().put(url, data=f) as resp:
             if resp.status != OK:
                 raise Exception(f'Unknown response status {resp.status} while uploading file')
+    cache_index.validated(cache.path, None)
     return cache
 
 
 def clear_cache():
-    logger.info('clearing cache', {}, 'cache:clean')
+    logger.info('clearing cache', cache_index.stats(), 'cache:clean')
+    max_age = config.cache.max_age_secs
+    for name, entry in list(cache_index.entries.items()):
+        age = time() - entry.last_used
+        if age > max_age:
+            logger.debug('removing file %(name)s from cache as age is %(age)s', { 'name': name, 'age': age }, 'cache:purge')
+            cache_index.remove(name)
+    # .part files are not in the index, and are left behind by downloads
+    # that were interrupted by a crash.
     for file in scandir(config.cache_dir):
-        if not file.is_file():
+        if not file.is_file(follow_symlinks=False) or not file.name.endswith('.part'):
             continue
         st = file.stat()
-        atime = max(st.st_atime, st.st_mtime)
-        age = time() - atime
-        if age > config.cache.max_age_secs:
+        age = time() - max(st.st_atime, st.st_mtime)
+        if age > max_age:
             logger.debug('removing file %(path)s from cache as age is %(age)s', { 'path': file.path, 'age': age }, 'cache:purge')
-            remove(file)
+            PosixPath(file.path).unlink(missing_ok=True)
 
 async def clean_cache_worker():
+    cache_index.rebuild()
     while True:
         try:
             clear_cache()
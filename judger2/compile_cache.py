@@ -0,0 +1,182 @@
+__all__ = 'CompiledArtifact', 'compile_cache_key', 'pch_cache_key', \
+    'lookup_compiled', 'store_compiled'
+
+import json
+from dataclasses import dataclass
+from hashlib import file_digest, sha256
+from http.client import OK
+from logging import getLogger
+from os import rename, utime
+from pathlib import PosixPath
+from uuid import uuid4
+
+from commons.task_typing import (CompileCache, CompileSourceCpp,
+                                 CompileSourceVerilog, CompileTask)
+from judger2.cache import (cache_index, ensure_cached, get_cache_context,
+                           http_session)
+from judger2.config import config
+from judger2.materialize import materialize
+from judger2.sandbox import profile_fingerprint
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class CompiledArtifact:
+    path: PosixPath
+    message: str
+
+
+async def compile_cache_key(task: CompileTask) -> str | None:
+    '''
+    Hash of everything the compile output depends on: the source and
+    supplementary files, the compiler flags and the toolchain. Returns None
+    if the task could not be cached.
+    '''
+    source = task.source
+    if isinstance(source, CompileSourceCpp):
+        cxx = config.compiler.cxx
+        options = [cxx.file_name, cxx.exec_name, *cxx.flags]
+    elif isinstance(source, CompileSourceVerilog):
+        verilog = config.compiler.verilog
+        options = [verilog.file_name, verilog.exec_name]
+    else:
+        # git repositories could change between compiles.
+        return None
+
+    h = InputHash()
+    h.update(type(source).__name__.encode())
+    h.update(profile_fingerprint('std').encode())
+    h.update(json.dumps(options).encode())
+    h.update(file_hash((await ensure_cached(source.main)).path))
+    await h.update_files(task.supplementary_files)
+    return h.hexdigest()
+
+async def pch_cache_key(task: CompileTask, header: str) -> str:
+    '''
+    Hash of everything a precompiled header built from one of the
+    supplementary files of a C++ compile task depends on.
+    '''
+    h = InputHash()
+    h.update(b'pch')
+    h.update(header.encode())
+    h.update(profile_fingerprint('std').encode())
+    h.update(json.dumps(config.compiler.cxx.flags).encode())
+    await h.update_files(task.supplementary_files)
+    return h.hexdigest()
+
+
+class InputHash:
+    def __init__(self):
+        self._hash = sha256()
+
+    def update(self, data: bytes):
+        self._hash.update(len(data).to_bytes(8, 'little'))
+        self._hash.update(data)
+
+    async def update_files(self, urls: list[str]):
+        for url in urls:
+            file = await ensure_cached(url)
+            self.update(file.filename.encode())
+            self.update(file_hash(file.path))
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+def file_hash(path: PosixPath) -> bytes:
+    with open(path, 'rb') as f:
+        return file_digest(f, 'sha256').digest()
+
+
+def local_paths(key: str) -> tuple[PosixPath, PosixPath]:
+    artifact = PosixPath(config.cache_dir) / f'compile-{key}'
+    return artifact, artifact.with_name(f'{artifact.name}.json')
+
+def lookup_local(key: str) -> CompiledArtifact | None:
+    artifact, meta = local_paths(key)
+    try:
+        message = json.loads(meta.read_text())['message']
+        # touch the files so that they stay in the cache
+        utime(artifact)
+        utime(meta)
+    except FileNotFoundError:
+        return None
+    get_cache_context().pin(artifact)
+    cache_index.touch(meta)
+    cache_index.touch(artifact)
+    return CompiledArtifact(artifact, message)
+
+def store_local(key: str, file: PosixPath, message: str) -> CompiledArtifact:
+    artifact, meta = local_paths(key)
+    part = artifact.with_name(f'{artifact.name}.{uuid4()}.part')
+    try:
+        materialize(file, part)
+        rename(part, artifact)
+    except:
+        part.unlink(missing_ok=True)
+        raise
+    meta.write_text(json.dumps({ 'message': message }))
+    get_cache_context().pin(artifact)
+    cache_index.add(meta)
+    cache_index.add(artifact)
+    return CompiledArtifact(artifact, message)
+
+
+# The shared cache object is a JSON header line with the cache key and the
+# compile message, followed by the artifact. The object name is chosen by
+# the scheduler, so the key is checked before using the artifact.
+
+async def fetch_shared(key: str, cache: CompileCache) -> CompiledArtifact | None:
+    get_cache_context().requests += 1
+    async with http_session().get(cache.get) as resp:
+        if resp.status != OK:
+            return None
+        header = json.loads(await resp.content.readline())
+        if header.get('key') != key:
+            return None
+        artifact, meta = local_paths(key)
+        part = artifact.with_name(f'{artifact.name}.{uuid4()}.part')
+        try:
+            with open(part, 'wb') as f:
+                async for data, _ in resp.content.iter_chunks():
+                    f.write(data)
+            part.chmod(0o755)
+            rename(part, artifact)
+        except:
+            part.unlink(missing_ok=True)
+            raise
+        meta.write_text(json.dumps({ 'message': header['message'] }))
+        get_cache_context().pin(artifact)
+        cache_index.add(meta)
+        cache_index.add(artifact)
+        return CompiledArtifact(artifact, header['message'])
+
+async def store_shared(key: str, compiled: CompiledArtifact, cache: CompileCache):
+    header = json.dumps({ 'key': key, 'message': compiled.message }) + '\n'
+    body = header.encode() + compiled.path.read_bytes()
+    get_cache_context().requests += 1
+    async with http_session().put(cache.put, data=body) as resp:
+        if resp.status != OK:
+            raise Exception(f'Unknown response status {resp.status} while uploading compile cache')
+
+
+async def lookup_compiled(key: str, cache: CompileCache | None) \
+    -> CompiledArtifact | None:
+    compiled = lookup_local(key)
+    if compiled is not None or cache is None:
+        return compiled
+    try:
+        return await fetch_shared(key, cache)
+    except Exception as e:
+        logger.warning('cannot fetch compile cache: %(error)s', { 'error': e }, 'compile:cache')
+        return None
+
+async def store_compiled(key: str, file: PosixPath, message: str,
+                         cache: CompileCache | None) -> CompiledArtifact:
+    compiled = store_local(key, file, message)
+    if cache is not None:
+        try:
+            await store_shared(key, compiled, cache)
+        except Exception as e:
+            logger.warning('cannot upload compile cache: %(error)s', { 'error': e }, 'compile:cache')
+    return compiled
@@ -27,8 +27,18 @@ class ConfigRedis(BaseModel):
 
 
 class ConfigCache(BaseModel):
+    # total size of the cache, least recently used files are evicted beyond it
+    max_bytes: int = Field(default=21474836480, ge=0)
+    # cached files are used by judge tasks without checking them for this
+    # long after a task of the same judge plan checked them
+    trust_secs: float = Field(default=3600.0, ge=0)
+    # files unused for longer than this are removed
     max_age_secs: float = 86400.0
     clear_interval_secs: float = 86400.0
+    # size of the bloom filter of cached files advertised to the scheduler
+    bloom_bits: int = Field(default=262144, ge=8)
+    bloom_hashes: int = Field(default=7, ge=1)
+    advertise_interval_secs: float = Field(default=10.0, gt=0)
 
 
 class ConfigTask(BaseModel):
@@ -45,6 +55,13 @@ class ConfigTask(BaseModel):
     timeout_secs: int = Field(default=3600, ge=1)
     heartbeat_interval_secs: float = Field(default=2.0, gt=0)
     poll_timeout_secs: int = Field(default=10, ge=1)
+    progress_stream_maxlen: int = Field(default=100000, ge=1)
+    # bytes of files of the next testpoint to fetch while a testpoint runs
+    prefetch_bytes: int = Field(default=268435456, ge=0)
+    # number of tasks run at the same time, each pinned to a CPU of its own
+    slots: int = Field(default=1, ge=1)
+    # CPUs to pin the slots to, defaults to the first CPUs available to us
+    cpus: list[int] | None = None
 
 
 class ConfigGitSsh(BaseModel):
@@ -69,6 +86,16 @@ class ConfigCxx(BaseModel):
     flags: list[str] = Field(default=["-fmax-errors=10", "-O2", "-DONLINE_JUDGE", "-std=c++20"])
     file_name: str = "main.cpp"
     exec_name: str = "code"
+    # system headers precompiled at startup for the flags above
+    pch_headers: list[str] = Field(default=["bits/stdc++.h"])
+    pch_limits: ResourceUsage = Field(
+        default=ResourceUsage(
+            time_msecs=60000,
+            memory_bytes=2147483648,
+            file_count=-1,
+            file_size_bytes=-1,
+        )
+    )
 
 
 class ConfigVerilog(BaseModel):
@@ -97,6 +124,9 @@ class ConfigValgrind(BaseModel):
 
 
 class ConfigChecker(BaseModel):
+    # compare outputs with answers while programs run, killing them at the
+    # first difference, instead of running the checker afterwards
+    streaming: bool = False
     cmp_limits: ResourceUsage = Field(
         default=ResourceUsage(
             time_msecs=10000,
@@ -107,6 +137,18 @@ class ConfigChecker(BaseModel):
     )
 
 
+class ConfigSandbox(BaseModel):
+    # cgroup v2 directory delegated to the runner, if set runs get cgroups of
+    # their own under it that enforce memory limits and account memory and
+    # CPU time
+    cgroup_root: Path | None = None
+    # memory a run cgroup may use beyond the memory limit, for the runner
+    # process and kernel memory charged to the cgroup
+    cgroup_memory_slack_bytes: int = Field(default=16777216, ge=0)
+    # CPU time a program may use beyond its time limit before it is killed
+    cgroup_kill_margin_msecs: int = Field(default=50, ge=0)
+
+
 class Config(BaseSettings):
     model_config = SettingsConfigDict(
         extra="ignore", env_nested_delimiter="_", yaml_file=["runner.yml", "runner.yaml"]
@@ -127,6 +169,7 @@ class Config(BaseSettings):
     compiler: ConfigCompiler = Field(default_factory=ConfigCompiler)
     valgrind: ConfigValgrind = Field(default_factory=ConfigValgrind)
     checker: ConfigChecker = Field(default_factory=ConfigChecker)
+    sandbox: ConfigSandbox = Field(default_factory=ConfigSandbox)
 
     @property
     def queues(self) -> RedisQueues:
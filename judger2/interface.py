@@ -6,14 +6,17 @@ from dataclasses import field, dataclass
 import functools
 import json
 from logging import getLogger
+from os import sched_getaffinity
 from time import time
 from pydantic import validate_call
 from typing import Any, NoReturn
 from redis.asyncio import Redis
 
-from commons.util import serialize
-from judger2.cache import clean_cache_worker
+from commons.task_typing import StatusUpdateError
+from commons.util import Heartbeat, TaskMessage, serialize
+from judger2.cache import cache_index, cache_summary, clean_cache_worker
 from judger2.config import config
+from judger2.sandbox import slot_cpu
 
 logger = getLogger(__name__)
 
@@ -36,6 +39,8 @@ class JudgerInterface:
             **config.redis.connection.model_dump(),
         ),
     )
+    # whether each task slot is running a task, reported in heartbeats
+    busy_slots: list[bool] = field(default_factory=lambda: [False] * config.task.slots)
 
     def register_task_handler[T](self, name: str, handler: JudgerHandler[T]):
         self.task_handlers[name] = validate_call(handler)
@@ -43,7 +48,8 @@ class JudgerInterface:
     async def send_heartbeats(self):
         while True:
             try:
-                await self.redis.set(config.queues.heartbeat, time())
+                heartbeat = Heartbeat(time(), self.busy_slots, cache_index.stats())
+                await self.redis.set(config.queues.heartbeat, heartbeat.dump())
             except Exception as e:
                 logger.error("error sending heartbeat: %(error)s", {"error": e}, "heartbeat")
             # put sleep outside the except block
@@ -69,55 +75,132 @@ class JudgerInterface:
         This method is provided for task handlers to report progress,
         so that they don't need to care about the detail of communication.
         """
-        task_queues = config.queues.task(task_id)
-        await self.redis.lpush(task_queues.progress, serialize(status))
-        await self.redis.expire(task_queues.progress, config.task.timeout_secs)
+        await self.redis.xadd(
+            config.queues.progress,
+            {"task": task_id, "status": serialize(status)},
+            maxlen=config.task.progress_stream_maxlen,
+            approximate=True,
+        )
+
+    async def advertise_cache(self):
+        """
+        Publish a summary of our file cache, so that the scheduler could
+        send us tasks whose files we already have.
+        """
+        while True:
+            try:
+                summary = f"{time()} {cache_summary()}"
+                for name in self.task_handlers:
+                    await self.redis.hset(config.queues.caches_group(name), str(config.id), summary)
+            except Exception as e:
+                logger.error("error advertising cache: %(error)s", {"error": e}, "cache:advertise")
+            await asyncio.sleep(config.cache.advertise_interval_secs)
+
+    async def _take_task(
+        self, queue: str, *, woken: bool = False
+    ) -> tuple[str, str] | None:
+        """
+        Moves a task from the queue into our in-progress list, and removes
+        the wakeup token pushed with it, unless we were woken up by it.
+        """
+        message = await self.redis.lmove(queue, config.queues.in_progress, "RIGHT", "LEFT")
+        if not isinstance(message, str):
+            return None
+        if not woken:
+            await self.redis.lpop(config.queues.wakeup(queue))
+        return queue, message
+
+    async def _fetch_task(
+        self, affinity_queues: list[str], queue_list: deque[str]
+    ) -> tuple[str, str] | None:
+        """
+        Atomically move a task from one of the queues into our in-progress
+        list, where it stays until we are done with it. Returns the queue
+        the task was taken from, and the task message.
+
+        Tasks sent to this runner in particular are taken first.
+        """
+        queues = [*affinity_queues, *queue_list]
+        for queue in queues:
+            res = await self._take_task(queue)
+            if res is not None:
+                return res
+        # BLMOVE could only wait on a single list, so wait for a task to be
+        # pushed to any of the queues instead. There is a token for every
+        # queued task, so the token we get stands for a task in its queue.
+        wakeups = [config.queues.wakeup(queue) for queue in queues]
+        token = await self.redis.blpop(wakeups, timeout=config.task.poll_timeout_secs)
+        if token is None:
+            return None
+        return await self._take_task(queues[wakeups.index(token[0])], woken=True)
 
-    async def task_loop(self) -> NoReturn:
+    async def _abandon_stale_tasks(self):
+        """
+        Tasks left in our in-progress list were taken by a previous run of
+        this runner that did not finish them. Report them as failed so that
+        the scheduler retries them right away.
+        """
+        in_progress = config.queues.in_progress
+        for message in await self.redis.lrange(in_progress, 0, -1):
+            task_id = TaskMessage.id_of(message)
+            logger.warning(
+                "abandoning unfinished task %(id)s from previous run",
+                {"id": task_id},
+                "task:abandon",
+            )
+            await self.report_progress(task_id, StatusUpdateError("Runner restarted"))
+            await self.redis.lrem(in_progress, 1, message)
+
+    async def task_loop(self, slot: int, cpu: int | None) -> NoReturn:
+        """
+        Run tasks one at a time in the given slot, with sandboxes pinned
+        to the given CPU.
+        """
+        slot_cpu.set(cpu)
         queue_list = deque[str]()
+        affinity_queues: list[str] = []
         queue2handler: dict[str, JudgerHandler[Any]] = {}
 
         for name, handler in self.task_handlers.items():
-            queue_name = f"{config.redis.prefix}-{name}-tasks"
+            queue_name = config.queues.tasks_group(name)
             queue_list.append(queue_name)
             queue2handler[queue_name] = handler
+            affinity_queue_name = config.queues.tasks_runner(name, str(config.id))
+            affinity_queues.append(affinity_queue_name)
+            queue2handler[affinity_queue_name] = handler
 
-        logger.info(f"listening for tasks in queues: {', '.join(queue_list)}")
-        await self.redis.delete(config.queues.in_progress)
+        logger.info(
+            f"slot {slot} (cpu {cpu}) listening for tasks in queues: "
+            f"{', '.join(affinity_queues + list(queue_list))}"
+        )
 
         while True:
-            task_id = None
+            message = None
             try:
                 queue_list.rotate()  # fairness
                 # Start polling for tasks
-                fetch_res = await self.redis.brpop(
-                    queue_list,
-                    timeout=config.task.poll_timeout_secs,
-                )
+                fetch_res = await self._fetch_task(affinity_queues, queue_list)
                 if fetch_res is None:
                     continue
-                queue_id, task_id = fetch_res
-                await self.redis.rpush(config.queues.in_progress, task_id)
-                fetch_res = await self.redis.brpop(
-                    config.queues.task(task_id).task,
-                    timeout=config.task.poll_timeout_secs,
-                )
-                if fetch_res is None:
+                queue_id, message = fetch_res
+                task_message = TaskMessage.load(message)
+                task_id = task_message.id
+                if task_message.deadline < time():
                     logger.warning(
-                        "task %(id)s has no payload, dropping stale task id",
+                        "task %(id)s has expired, dropping stale task",
                         {"id": task_id},
                         "task:stale",
                     )
                     continue
 
                 # Start processing task
-                _, task_serialized = fetch_res
-                logger.info(f"received task {task_id} in queue {queue_id}")
+                logger.info(f"received task {task_id} in queue {queue_id} on slot {slot}")
+                self.busy_slots[slot] = True
 
                 # dispatch task to handler
                 handler = queue2handler[queue_id]
                 reporter = functools.partial(self.report_progress, task_id)
-                task = json.loads(task_serialized)
+                task = json.loads(task_message.payload)
                 works = [handler(reporter, task, task_id), self._wait_cancel(task_id)]
 
                 # wait for task finish or cancel
@@ -145,18 +228,41 @@ class JudgerInterface:
                         raise exc
                 logger.info(f"finished task {task_id}")
             finally:
-                if task_id is not None:
-                    await self.redis.lrem(config.queues.in_progress, 0, task_id)
+                self.busy_slots[slot] = False
+                # acknowledge the task
+                if message is not None:
+                    await self.redis.lrem(config.queues.in_progress, 1, message)
+
+    def _slot_cpus(self) -> list[int | None]:
+        """
+        The CPU each slot is pinned to. A single slot is not pinned unless
+        CPUs are configured, and nsjail picks a CPU for it as before.
+        """
+        slots = config.task.slots
+        cpus = config.task.cpus
+        if cpus is None:
+            if slots == 1:
+                return [None]
+            cpus = sorted(sched_getaffinity(0))
+        if len(cpus) < slots:
+            raise ValueError(f"{slots} slots configured, but only {len(cpus)} CPUs to pin them to")
+        return list(cpus[:slots])
 
     async def online(self):
         logger.info("starting runner %(id)s", {"id": str(config.id)}, "runner:start")
         atexit.register(
             lambda: logger.info("runner %(id)s stopping", {"id": str(config.id)}, "runner:stop")
         )
+        cpus = self._slot_cpus()
         try:
+            # the in-progress list is shared by all slots, so stale tasks
+            # are abandoned before any slot starts taking tasks.
+            await self._abandon_stale_tasks()
             async with asyncio.TaskGroup() as tg:
                 tg.create_task(self.send_heartbeats())
-                tg.create_task(self.task_loop())
+                tg.create_task(self.advertise_cache())
+                for slot, cpu in enumerate(cpus):
+                    tg.create_task(self.task_loop(slot, cpu))
                 tg.create_task(clean_cache_worker())
         except* (KeyboardInterrupt, asyncio.exceptions.CancelledError):
             logger.info(
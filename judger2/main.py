@@ -8,8 +8,11 @@ from commons.task_typing import (
     StatusUpdateError,
     StatusUpdateStarted,
 )
+from judger2.cache import CacheContext, cache_context
 from judger2.config import config
 from judger2.interface import JudgerInterface, ProgressReporter
+from judger2.pch import build_pch
+from judger2.sandbox.cgroup import setup_cgroups
 from judger2.steps.task import compile_task, judge_task
 from judger2.logging_ import task_logger
 
@@ -22,6 +25,8 @@ async def task_handler(
     task_id: str,
 ):
     task_logger.info('received task %(task)s', { 'id': task_id, 'task': task }, 'task:start')
+    context = CacheContext(task.plan_version if isinstance(task, JudgeTask) else None)
+    cache_context.set(context)
     try:
         await reporter(StatusUpdateStarted(str(config.id)))
         match task:
@@ -35,9 +40,14 @@ async def task_handler(
     except Exception:
         await reporter(StatusUpdateError(str(config.id)))
         raise  # philosophy: termination is better than keeping silent
+    finally:
+        context.release()
+        task_logger.info('task made %(requests)s storage requests, %(trusted)s files used without checking', { 'id': task_id, 'requests': context.requests, 'trusted': context.trusted }, 'task:requests')
 
 
 async def main():
+    setup_cgroups()
+    await build_pch()
     judger = JudgerInterface()
     judger.register_task_handler(config.group, task_handler)
     await judger.online()
@@ -0,0 +1,77 @@
+__all__ = 'build_pch', 'pch_dir'
+
+from hashlib import sha256
+from logging import getLogger
+from pathlib import PosixPath
+from shutil import rmtree
+from time import time
+
+from judger2.config import config
+from judger2.materialize import materialize
+from judger2.sandbox import chown_back, profile_fingerprint, run_with_limits
+from judger2.util import TempDir
+
+logger = getLogger(__name__)
+
+
+# Precompiled system headers for the configured C++ flags, built at
+# startup. The directory only contains the .gch files and is added to the
+# include path of compiles: g++ looks for a .gch in each include directory
+# before looking for the header itself there, and goes on to the next
+# directory if the .gch could not be used (e.g. the flags differ).
+_pch_dir: PosixPath | None = None
+
+def pch_dir() -> PosixPath | None:
+    return _pch_dir
+
+
+def pch_fingerprint() -> str:
+    h = sha256()
+    h.update(profile_fingerprint('std').encode())
+    for flag in config.compiler.cxx.flags:
+        h.update(b'\0' + flag.encode())
+    return h.hexdigest()[:32]
+
+async def build_header(header: str, dest: PosixPath):
+    with TempDir() as cwd:
+        # compile a wrapper, since the header itself is in the toolchain.
+        source = cwd / 'header.h'
+        source.write_text(f'#include <{header}>\n')
+        gch = cwd / 'header.h.gch'
+        start = time()
+        res = await run_with_limits(
+            'std',
+            ['/bin/g++'] + config.compiler.cxx.flags +
+                ['-x', 'c++-header', str(source), '-o', str(gch)],
+            cwd, config.compiler.cxx.pch_limits,
+        )
+        if res.error is not None:
+            raise Exception(f'cannot precompile {header}: {res.message}')
+        await chown_back(cwd)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        materialize(gch, dest, 0o644)
+        logger.info('precompiled %(header)s in %(secs).2fs', { 'header': header, 'secs': time() - start }, 'pch:build')
+
+async def build_pch():
+    global _pch_dir
+    if len(config.compiler.cxx.pch_headers) == 0:
+        return
+    root = PosixPath(config.cache_dir) / 'pch'
+    dir = root / pch_fingerprint()
+    done = dir / '.done'
+    if not done.exists():
+        rmtree(dir, ignore_errors=True)
+        try:
+            for header in config.compiler.cxx.pch_headers:
+                await build_header(header, dir / f'{header}.gch')
+        except Exception as e:
+            logger.error('error building precompiled headers: %(error)s', { 'error': e }, 'pch:build')
+            return
+        done.touch()
+    # headers for other flags or toolchains are useless now.
+    for entry in root.iterdir():
+        if entry != dir:
+            rmtree(entry, ignore_errors=True)
+    dir.chmod(0o755)
+    root.chmod(0o755)
+    _pch_dir = dir
@@ -1,27 +1,35 @@
-__all__ = 'run_with_limits', 'chown_back'
+__all__ = 'run_with_limits', 'chown_back', 'profile_fingerprint', 'slot_cpu'
 
-from asyncio import create_subprocess_exec, wait_for
+from asyncio import Future, create_subprocess_exec, wait_for
+from contextlib import AbstractContextManager, nullcontext
+from contextvars import ContextVar
 from dataclasses import asdict, dataclass, field
-from logging import getLogger
+from functools import cache
+from logging import DEBUG, getLogger
 from math import ceil
-from os import (WEXITSTATUS, WIFEXITED, WIFSIGNALED, WTERMSIG, getuid,
-                strerror, wait4)
+from os import (WEXITSTATUS, WIFEXITED, WIFSIGNALED, WTERMSIG, getuid, lstat,
+                path, rename, scandir, strerror)
 from pathlib import PosixPath
 from shlex import quote
-from shutil import which
+from shutil import copyfile, which
 from signal import strsignal
-from subprocess import DEVNULL, PIPE, Popen
+from stat import S_ISDIR
+from subprocess import DEVNULL, PIPE
 from sys import platform
 from time import time
-from typing import (IO, Any, Callable, Coroutine, List, Optional, Sequence,
-                    Union)
+from typing import (IO, Any, Callable, Coroutine, Dict, List, Optional,
+                    Sequence, Union)
+from uuid import uuid4
 
 from typing_extensions import Literal
 
 from commons.task_typing import ResourceUsage, RunResult
 from commons.util import asyncrun
 from judger2.config import config
-from judger2.util import TempDir, format_args
+from judger2.sandbox.cgroup import CgroupUsage, RunCgroup, cgroups_enabled
+from judger2.sandbox.process import spawn
+from judger2.sandbox.rundir import run_dir
+from judger2.util import format_args
 
 logger = getLogger(__name__)
 
@@ -31,12 +39,11 @@ if platform != 'linux':
     exit(2)
 
 
-nsjail = PosixPath(__file__).with_name('nsjail')
-nsjail_wrapper = PosixPath(__file__).with_name('stdenv') / 'bin' / 'nsjail-wrapper'
-if not nsjail.exists() or not nsjail_wrapper.exists():
+nsjail_path = PosixPath(__file__).with_name('nsjail')
+if not nsjail_path.exists():
     raise Exception('nsjail executable not found')
-nsjail = str(nsjail)
-nsjail_wrapper = str(nsjail_wrapper)
+nsjail = str(nsjail_path)
+profiles_dir = PosixPath(__file__).with_name('stdenv') / 'profiles'
 
 bindmount_ro_base = ['/dev/urandom']
 bindmount_rw_base = ['/dev/null', '/dev/zero']
@@ -75,8 +82,13 @@ class NsjailArgs:
 
     # maximum size in megabytes of files that the process may create.
     rlimit_fsize: str = 'inf'
-    # cgroup-based memory limit: not working.
-    # cgroup_mem_max: str
+    # cgroup v2 dir under which nsjail creates the cgroup of the program,
+    # see judger2.sandbox.cgroup.
+    use_cgroupv2: bool = False
+    cgroupv2_mount: Union[Literal[False], str] = False
+    # cgroup-based memory limit (bytes) and swap limit.
+    cgroup_mem_max: Union[Literal[False], str] = False
+    cgroup_mem_swap_max: Union[Literal[False], str] = False
 
     # whether to enable network access in the container.
     disable_clone_newnet: bool = False
@@ -100,8 +112,140 @@ class NsjailArgs:
 
 time_tolerance_ratio = 1.25
 
+# The CPU that the task slot running the current task is pinned to. nsjail
+# picks the CPUs for --max_cpus among those it is allowed to run on, so
+# pinning nsjail is enough to keep programs on the CPU of their slot.
+slot_cpu: ContextVar[Optional[int]] = ContextVar('slot_cpu', default=None)
+
 Profile = Literal['std', 'libc', 'valgrind', 'python']
 
+@cache
+def profile_fingerprint(profile: Profile) -> str:
+    '''
+    Identifies the toolchain of a profile. Profiles are nix builds, so the
+    store path of the result changes whenever anything in it changes.
+    '''
+    result = profiles_dir / profile / 'result'
+    return path.realpath(result)
+
+# fields of NsjailArgs that differ between runs, the others are the same
+# for all runs of a profile.
+run_fields = {
+    'chroot', 'cwd', 'time_limit', 'rlimit_cpu', 'bindmount_ro', 'bindmount',
+    'rlimit_fsize', 'use_cgroupv2', 'cgroupv2_mount', 'cgroup_mem_max',
+    'cgroup_mem_swap_max', 'disable_clone_newnet', 'disable_proc',
+    'tmpfsmount',
+}
+
+def protobuf_str(s: str) -> str:
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+@cache
+def profile_args(profile: Profile) -> List[str]:
+    '''
+    nsjail args shared by all runs of a profile. The mounts and environment
+    of the toolchain go to a config file written once, instead of being
+    read by nsjail-wrapper from the profile in a bash for every run.
+    '''
+    profile_dir = profiles_dir / profile
+    requisites_file = profile_dir / 'requisites'
+    env_file = profile_dir / 'env'
+    result_dir = profile_dir / 'result'
+    if not requisites_file.exists() or not env_file.exists() or not result_dir.exists():
+        raise Exception(f'profile {profile} not found')
+
+    mounts = [(x, x) for x in requisites_file.read_text().splitlines() if x != '']
+    mounts += [(str(result_dir / x.name), f'/{x.name}') for x in sorted(result_dir.iterdir())]
+    lines = [
+        f'mount {{ src: {protobuf_str(src)} dst: {protobuf_str(dst)} is_bind: true rw: false }}'
+        for src, dst in mounts
+    ]
+    lines += [
+        f'envar: {protobuf_str(x)}'
+        for x in env_file.read_text().splitlines() if x != ''
+    ]
+    content = '\n'.join(lines) + '\n'
+    config_file = PosixPath(config.working_dir) / f'nsjail-{profile}.cfg'
+    # runs of an earlier judger process could still be reading the file.
+    if not config_file.is_file() or config_file.read_text() != content:
+        part = config_file.with_name(f'{config_file.name}.{uuid4()}.part')
+        try:
+            part.write_text(content)
+            rename(part, config_file)
+        except:
+            part.unlink(missing_ok=True)
+            raise
+
+    defaults = asdict(NsjailArgs(chroot='', cwd='', time_limit=''))
+    static = { k: v for k, v in defaults.items() if k not in run_fields }
+    return ['--config', str(config_file)] + format_args(static)
+
+du_path = str(PosixPath(__file__).with_name('du'))
+runner_path = str(PosixPath(__file__).with_name('runner'))
+
+async def du_nsjail(cwd: PosixPath) -> tuple[int, int]:
+    '''
+    Disk usage of cwd in bytes and number of files, by running du in a
+    namespace where it could read everything the worker user created.
+    '''
+    du_proc = await create_subprocess_exec(
+        nsjail,
+        *format_args(asdict(NsjailArgs('/', str(cwd), '9.0'))),
+        '--', du_path, '-s',
+        stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+        limit=4096,
+    )
+    du_code = await wait_for(du_proc.wait(), 10.0)
+    if du_code != 0:
+        raise Exception(f'du exited with code {du_code}')
+    assert du_proc.stdout is not None
+    du_out = (await du_proc.stdout.read(4096)).decode(errors='replace') \
+        .split('\n')
+    file_size_kbytes, file_count = [int(x) for x in du_out[:2]]
+    return file_size_kbytes * 1024, file_count
+
+def walk_disk_usage(cwd: PosixPath) -> tuple[int, int]:
+    '''
+    Disk usage of cwd in bytes and number of files, counted the way du
+    does: blocks of everything including directories, with hard linked
+    files counted once, in size and in number. Raises PermissionError if
+    the worker user created something we could not read.
+    '''
+    seen: set[tuple[int, int]] = set()
+    st = lstat(cwd)
+    blocks = st.st_blocks
+    count = 0
+    dirs = [cwd]
+    while len(dirs) > 0:
+        with scandir(dirs.pop()) as it:
+            for entry in it:
+                st = entry.stat(follow_symlinks=False)
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                if S_ISDIR(st.st_mode):
+                    dirs.append(PosixPath(entry.path))
+                else:
+                    count += 1
+                blocks += st.st_blocks
+    # du reports sizes in KiB, rounded up.
+    return ceil(blocks * 512 / 1024) * 1024, count
+
+async def disk_usage(cwd: PosixPath) -> tuple[int, int]:
+    '''
+    Disk usage of cwd in bytes and number of files.
+    '''
+    try:
+        file_size_bytes, file_count = await asyncrun(lambda: walk_disk_usage(cwd))
+    except PermissionError:
+        file_size_bytes, file_count = await du_nsjail(cwd)
+    # empty directories could still use disk storage on some FSs.
+    # let's ignore them.
+    if file_count == 0 and file_size_bytes < 16 * 1024:
+        file_size_bytes = 0
+    return file_size_bytes, file_count
+
 async def run_with_limits(
     profile: Profile,
     argv: List[str],
@@ -118,62 +262,88 @@ async def run_with_limits(
     disable_stderr: bool = False,
     env: List[str] = [],
     setup_root_dir: Optional[Callable[[PosixPath], Coroutine[Any, Any, None]]] = None,
+    abort: Optional[Future[None]] = None,
 ) -> RunResult:
+    '''
+    Runs argv in the sandbox. If abort is given, the run is killed once it
+    is done, and the result is whatever the killed run leaves.
+    '''
     # these are nsjail args
     fsize = 'inf' if limits.file_size_bytes < 0 else \
         str(ceil(limits.file_size_bytes / 1048576 + 256))
     time_limit_scaled = limits.time_msecs * config.relative_slowness
     time_limit_nsjail = str(ceil(time_limit_scaled / 1000 * time_tolerance_ratio + 1))
-    # memory_limit = str(limits.memory_bytes + 1048576)
+    # wall time after which runner kills the program.
+    checker_time_limit = ceil(time_limit_scaled * time_tolerance_ratio + 500)
     bindmount_ro = bindmount_ro_base + [str(x) for x in supplementary_paths]
     bindmount_rw = bindmount_rw_base + [str(cwd)] \
         + [str(x) for x in supplementary_paths_rw]
-    # get the absolute path for ./runner and ./du
-    runner_path = str(PosixPath(__file__).with_name('runner'))
-    du_path = str(PosixPath(__file__).with_name('du'))
-
-    with TempDir() as tmp_dir, open(tmp_dir / 'stderr', 'w+b') as errfile:
-        # make needed files and dirs
-        tmp_dir.chmod(0o700)
-        chroot = tmp_dir / 'root'
-        chroot.mkdir(0o750)
+
+    cgroup_context: AbstractContextManager[Optional[RunCgroup]] = \
+        RunCgroup() if cgroups_enabled() else nullcontext()
+    with run_dir(reusable=setup_root_dir is None and not network_access) as dir, \
+        open(dir.stderr, 'w+b') as errfile, \
+        cgroup_context as cgroup:
+        chroot = dir.chroot
         if setup_root_dir is not None:
             await setup_root_dir(chroot)
-        result_dir = tmp_dir / 'result'
-        result_dir.mkdir(0o700)
-        result_file = result_dir / 'result'
+        if network_access:
+            # programs with network access need a resolver config.
+            (chroot / 'acmoj').mkdir(exist_ok=True)
+            copyfile('/etc/resolv.conf', chroot / 'acmoj' / 'resolv.conf')
+        result_file = dir.result_file
 
         # construct nsjail args
-        args = NsjailArgs(
-            chroot=str(chroot),
-            cwd=str(cwd),
-            rlimit_fsize=fsize,
-            time_limit=time_limit_nsjail,
-            rlimit_cpu=str(ceil(float(time_limit_nsjail) + 1)),
-            # cgroups-based memory limit is not working
-            # cgroup_mem_max=memory_limit,
-            bindmount_ro=bindmount_ro,
-            bindmount=[str(result_dir)] + bindmount_rw,
-            disable_clone_newnet=network_access,
-            disable_proc=disable_proc,
-            tmpfsmount='/tmp' if tmpfsmount else False,
-            env=config.task.envp + env,
-        )
-        checker_time_limit = str(ceil(time_limit_scaled * time_tolerance_ratio + 500))
-        run_args = [runner_path, checker_time_limit, str(result_file)] \
+        args: Dict[str, Union[bool, str, List[str]]] = {
+            'chroot': str(chroot),
+            'cwd': str(cwd),
+            'rlimit_fsize': fsize,
+            'time_limit': time_limit_nsjail,
+            'rlimit_cpu': str(ceil(float(time_limit_nsjail) + 1)),
+            'bindmount_ro': bindmount_ro,
+            'bindmount': [str(dir.result_dir)] + bindmount_rw,
+            'disable_clone_newnet': network_access,
+            'disable_proc': disable_proc,
+            'tmpfsmount': '/tmp' if tmpfsmount else False,
+            'env': env,
+        }
+        runner_time_limit = str(checker_time_limit)
+        if cgroup is not None:
+            # CPU time is measured accurately by the cgroup, so CPU bound
+            # programs are killed by runner right after the limit instead
+            # of running until the deadline in wall time.
+            cpu_limit = ceil(time_limit_scaled + config.sandbox.cgroup_kill_margin_msecs)
+            runner_time_limit += f':{cpu_limit}'
+            args['rlimit_cpu'] = str(ceil(cpu_limit / 1000) + 1)
+            args['use_cgroupv2'] = True
+            args['cgroupv2_mount'] = str(cgroup.path)
+            args['cgroup_mem_max'] = str(limits.memory_bytes + config.sandbox.cgroup_memory_slack_bytes)
+            args['cgroup_mem_swap_max'] = '0'
+        run_args = [runner_path, runner_time_limit, str(result_file)] \
             + argv
-        nsjail_argv = [profile] + format_args(asdict(args)) + ['--'] + run_args
-        argv_str = ' '.join(quote(x) for x in nsjail_argv)
-        logger.debug('about to run nsjail with args %(args)s', { 'args': argv_str }, 'nsjail:run')
+        nsjail_argv = [nsjail] + profile_args(profile) + format_args(args) \
+            + ['--'] + run_args
+        if logger.isEnabledFor(DEBUG):
+            argv_str = ' '.join(quote(x) for x in nsjail_argv)
+            logger.debug('about to run nsjail with args %(args)s', { 'args': argv_str }, 'nsjail:run')
 
         # execute
         time_start = time()
-        proc = Popen(
-            [nsjail_wrapper, nsjail] + nsjail_argv,
+        proc = spawn(
+            nsjail_argv,
+            cpu=slot_cpu.get(),
             stdin=infile, stdout=outfile,
             stderr=DEVNULL if disable_stderr else errfile,
         )
-        _, status, rusage = await asyncrun(lambda: wait4(proc.pid, 0))
+        def on_abort(_):
+            proc.kill()
+        if abort is not None:
+            abort.add_done_callback(on_abort)
+        try:
+            status, rusage = await proc.wait()
+        finally:
+            if abort is not None:
+                abort.remove_done_callback(on_abort)
         code = waitstatus_to_exitcode(status)
         approx_time = time() - time_start
         approx_mem = rusage.ru_maxrss * 1024
@@ -199,28 +369,26 @@ async def run_with_limits(
             mem = int(approx_mem)
             usage_is_accurate = False
 
-        du_proc = await create_subprocess_exec(
-            nsjail,
-            *format_args(asdict(NsjailArgs('/', str(cwd), '9.0'))),
-            '--', du_path, '-s',
-            stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
-            limit=4096,
-        )
-        du_code = await wait_for(du_proc.wait(), 10.0)
-        if du_code != 0:
-            raise Exception(f'du exited with code {du_code}')
-        assert du_proc.stdout is not None
-        du_out = (await du_proc.stdout.read(4096)).decode(errors='replace') \
-            .split('\n')
-        file_size_bytes, file_count = [int(x) for x in du_out[:2]]
-        # empty directories could still use disk storage on some FSs.
-        # let's ignore them.
-        if file_count == 0 and file_size_bytes < 16:
-            file_size_bytes = 0
-        file_size_bytes *= 1024
+        cgroup_usage: Optional[CgroupUsage] = None
+        if cgroup is not None:
+            try:
+                cgroup_usage = cgroup.usage()
+            except Exception as e:
+                logger.error('cannot read usage of cgroup %(path)s: %(error)s', { 'path': cgroup.path, 'error': e }, 'cgroup:usage')
+        if cgroup_usage is not None:
+            time_used = cgroup_usage.cpu_msecs
+            # the peak of the cgroup includes page cache, e.g. of output
+            # files, so it is only used if runner could not tell the
+            # resident memory of the program.
+            if not usage_is_accurate or cgroup_usage.oom_killed:
+                mem = cgroup_usage.memory_peak_bytes
+        else:
+            time_used = realtime
+
+        file_size_bytes, file_count = await disk_usage(cwd)
 
         usage = ResourceUsage(
-            time_msecs=int(realtime / config.relative_slowness),
+            time_msecs=int(time_used / config.relative_slowness),
             memory_bytes=mem,
             file_count=file_count,
             file_size_bytes=file_size_bytes,
@@ -234,15 +402,24 @@ async def run_with_limits(
         errmsg = '' if err == '' else f': {err}'
 
         # check for errors
-        if usage_is_accurate and realtime > time_limit_scaled \
-        or approx_time * 1000 > time_limit_scaled + 500:
+        if cgroup_usage is not None:
+            # CPU time needs no tolerance; wall time only catches programs
+            # that idled until runner killed them.
+            time_limit_exceeded = cgroup_usage.cpu_msecs > time_limit_scaled \
+                or realtime >= checker_time_limit
+        else:
+            time_limit_exceeded = \
+                usage_is_accurate and realtime > time_limit_scaled \
+                or approx_time * 1000 > time_limit_scaled + 500
+        if time_limit_exceeded:
             # Check needed here as some TLE'd programs end
             # up being kill -9'd by nsjail; the real time
             # won't be accurate in this case. Therefore,
             # do not move this check down after the check
             # for exit code.
             return RunResult('time_limit_exceeded', '', usage)
-        if usage_is_accurate and mem > limits.memory_bytes:
+        if cgroup_usage is not None and cgroup_usage.oom_killed \
+        or usage_is_accurate and mem > limits.memory_bytes:
             return RunResult('memory_limit_exceeded', '', usage)
         if code != 0:
             # code is ./runner's exit code, so there must be something wrong.
@@ -280,24 +457,25 @@ _chown = which('chown')
 assert _chown is not None
 chown: str = _chown
 
-def chown_back(path: Union[PosixPath, str]):
-    logger.debug('about to chown_back %(path)s', { 'path': path }, 'tempdir:chown_back')
-    cwd = PosixPath(path)
-    if not cwd.is_dir():
-        cwd = cwd.parent
+async def chown_back(*paths: Union[PosixPath, str]):
+    logger.debug('about to chown_back %(paths)s', { 'paths': paths }, 'tempdir:chown_back')
+    dirs: List[str] = []
+    for path in map(PosixPath, paths):
+        dirs.append(str(path if path.is_dir() else path.parent))
+    dirs = list(dict.fromkeys(dirs))
     argv = [nsjail] + format_args({
-        'cwd': str(cwd),
+        'cwd': dirs[0],
         'chroot': '/',
         'uid_mapping': worker_uid_maps,
         'group': '0',
         'cap': 'CAP_CHOWN',
         'really_quiet': True,
-        'bindmount': str(cwd),
-    }) + ['--', chown, '-R', 'root', str(path)]
-    Popen(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) \
+        'bindmount': dirs,
+    }) + ['--', chown, '-R', 'root'] + [str(x) for x in paths]
+    await spawn(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) \
         .wait(timeout=10.0)
 
-def chown_to_user(path: Union[PosixPath, str]):
+async def chown_to_user(path: Union[PosixPath, str]):
     logger.debug('about to chown_to_user %(path)s', { 'path': path }, 'tempdir:chown_to_user')
     cwd = PosixPath(path)
     if not cwd.is_dir():
@@ -311,5 +489,5 @@ def chown_to_user(path: Union[PosixPath, str]):
         'really_quiet': True,
         'bindmount': str(cwd),
     }) + ['--', chown, '-R', str(worker_uid_inside), str(path)]
-    Popen(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) \
+    await spawn(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) \
         .wait(timeout=10.0)
@@ -0,0 +1,116 @@
+__all__ = 'setup_cgroups', 'cgroups_enabled', 'RunCgroup', 'CgroupUsage'
+
+from dataclasses import dataclass
+from logging import getLogger
+from os import getpid
+from pathlib import PosixPath
+from typing import Optional
+from uuid import uuid4
+
+from judger2.config import config
+
+logger = getLogger(__name__)
+
+
+cgroup_mount = PosixPath('/sys/fs/cgroup')
+controllers = '+memory +pids +cpu'
+
+_root: Optional[PosixPath] = None
+
+def cgroups_enabled() -> bool:
+    return _root is not None
+
+
+def own_cgroup() -> PosixPath:
+    # the unified hierarchy is the only line of the form '0::/path'.
+    for line in PosixPath('/proc/self/cgroup').read_text().splitlines():
+        if line.startswith('0::'):
+            return cgroup_mount / line[3:].lstrip('/')
+    raise Exception('not in a cgroup v2 hierarchy')
+
+def setup_cgroups():
+    '''
+    Prepares the cgroup root of runs if configured. Controllers could only
+    be enabled for the children of a cgroup without processes in it, so if
+    the root is a child of our own cgroup (e.g. a systemd service with
+    Delegate=yes), we move ourselves to a leaf next to it first. Runs fall
+    back to the measurements of runner.c if anything here fails.
+    '''
+    global _root
+    root = config.sandbox.cgroup_root
+    if root is None:
+        return
+    root = PosixPath(root)
+    try:
+        parent = root.parent
+        if own_cgroup() == parent:
+            leaf = parent / 'runner'
+            leaf.mkdir(exist_ok=True)
+            (leaf / 'cgroup.procs').write_text(str(getpid()))
+            (parent / 'cgroup.subtree_control').write_text(controllers)
+        root.mkdir(exist_ok=True)
+        (root / 'cgroup.subtree_control').write_text(controllers)
+        # clean up cgroups of runs left by a previous instance.
+        for entry in root.iterdir():
+            if entry.is_dir():
+                RunCgroup.remove(entry)
+    except Exception as e:
+        logger.error('cannot set up cgroups at %(root)s, falling back to rlimits: %(error)s', { 'root': root, 'error': e }, 'cgroup:setup')
+        return
+    _root = root
+    logger.info('runs are accounted with cgroups at %(root)s', { 'root': root }, 'cgroup:setup')
+
+
+@dataclass
+class CgroupUsage:
+    # CPU time of everything that ran in the cgroup.
+    cpu_msecs: int
+    # peak memory usage, including page cache charged to the cgroup.
+    memory_peak_bytes: int
+    # whether the OOM killer has killed anything in the cgroup.
+    oom_killed: bool
+
+
+class RunCgroup:
+    '''
+    The cgroup of a single run. nsjail puts the program into a cgroup it
+    creates under this one, and removes it once the program exits; the
+    usage of removed children is still accounted to this cgroup, so it is
+    read from here after nsjail is done.
+    '''
+
+    def __init__(self):
+        assert _root is not None
+        self.path = _root / str(uuid4())
+
+    def __enter__(self) -> 'RunCgroup':
+        self.path.mkdir()
+        return self
+
+    def __exit__(self, *_args):
+        RunCgroup.remove(self.path)
+
+    @staticmethod
+    def remove(path: PosixPath):
+        # cgroups are removed bottom-up with rmdir, even with files in them.
+        try:
+            for child in path.iterdir():
+                if child.is_dir():
+                    RunCgroup.remove(child)
+            path.rmdir()
+        except OSError as e:
+            logger.warning('cannot remove cgroup %(path)s: %(error)s', { 'path': path, 'error': e }, 'cgroup:remove')
+
+    def _read_keyed(self, file: str) -> dict[str, int]:
+        keyed = {}
+        for line in (self.path / file).read_text().splitlines():
+            key, value = line.split(' ')
+            keyed[key] = int(value)
+        return keyed
+
+    def usage(self) -> CgroupUsage:
+        return CgroupUsage(
+            cpu_msecs=self._read_keyed('cpu.stat')['usage_usec'] // 1000,
+            memory_peak_bytes=int((self.path / 'memory.peak').read_text()),
+            oom_killed=self._read_keyed('memory.events').get('oom_kill', 0) > 0,
+        )
@@ -0,0 +1,129 @@
+__all__ = 'ChildProcess', 'spawn'
+
+from asyncio import get_running_loop, wait_for
+from contextlib import contextmanager
+from logging import getLogger
+from os import (WNOHANG, close, kill, pidfd_open, sched_getaffinity,
+                sched_setaffinity, wait4, waitstatus_to_exitcode)
+from resource import struct_rusage
+from signal import SIGKILL
+from subprocess import Popen
+from typing import Any, Optional, Sequence, Tuple
+
+from commons.util import asyncrun
+
+logger = getLogger(__name__)
+
+
+@contextmanager
+def pinned_to(cpu: Optional[int]):
+    '''
+    Pins the calling thread to the CPU, so that children spawned in the
+    meantime start on it. Popen could then use vfork, which it could not
+    with a preexec_fn, and the event loop is not held up by a full fork.
+    '''
+    if cpu is None:
+        yield
+        return
+    mask = sched_getaffinity(0)
+    sched_setaffinity(0, { cpu })
+    try:
+        yield
+    finally:
+        sched_setaffinity(0, mask)
+
+
+class ChildProcess:
+    '''
+    A child process that is reaped without blocking the event loop or a
+    thread: the pidfd of the child becomes readable once it exits, and
+    wait4 then collects its status and resource usage right away.
+    '''
+
+    def __init__(self, popen: Popen):
+        self.popen = popen
+        self.pid = popen.pid
+        self.pidfd: Optional[int]
+        try:
+            self.pidfd = pidfd_open(self.pid)
+        except OSError as e:
+            # pidfds are available since Linux 5.3
+            logger.warning('pidfd_open failed, waiting in a thread: %(error)s', { 'error': e }, 'process:pidfd')
+            self.pidfd = None
+        self.result: Optional[Tuple[int, struct_rusage]] = None
+        self.waiting = False
+
+    def _reap(self) -> Tuple[int, struct_rusage]:
+        if self.result is None:
+            _, status, rusage = wait4(self.pid, 0 if self.pidfd is None else WNOHANG)
+            self.result = status, rusage
+            # keep Popen from waiting for the pid, which may be reused.
+            self.popen.returncode = waitstatus_to_exitcode(status)
+            if self.pidfd is not None:
+                close(self.pidfd)
+        return self.result
+
+    def _reap_in_thread(self) -> Tuple[int, struct_rusage]:
+        # the thread reaps the process even if the wait is cancelled.
+        try:
+            return self._reap()
+        finally:
+            self.waiting = False
+
+    async def _wait(self) -> Tuple[int, struct_rusage]:
+        if self.result is not None:
+            return self.result
+        if self.pidfd is None:
+            self.waiting = True
+            return await asyncrun(self._reap_in_thread)
+        loop = get_running_loop()
+        exited = loop.create_future()
+        def on_exit():
+            if not exited.done():
+                exited.set_result(None)
+        loop.add_reader(self.pidfd, on_exit)
+        self.waiting = True
+        try:
+            await exited
+        finally:
+            self.waiting = False
+            loop.remove_reader(self.pidfd)
+        return self._reap()
+
+    async def wait(self, timeout: Optional[float] = None) -> Tuple[int, struct_rusage]:
+        '''
+        Waits for the process to exit, and returns its wait status and
+        resource usage. The process is killed if the wait is cancelled or
+        times out.
+        '''
+        try:
+            return await wait_for(self._wait(), timeout)
+        except BaseException:
+            self.kill()
+            raise
+
+    def kill(self):
+        if self.result is not None:
+            return
+        # not Popen.send_signal, which could reap the process itself.
+        kill(self.pid, SIGKILL)
+        # a wait in progress reaps the process itself.
+        if self.waiting:
+            return
+        if self.pidfd is None:
+            # the process is gone right after SIGKILL.
+            self._reap()
+            return
+        # reap the process once it is gone, without waiting for it here.
+        loop = get_running_loop()
+        pidfd = self.pidfd
+        def reap():
+            loop.remove_reader(pidfd)
+            self._reap()
+        loop.add_reader(pidfd, reap)
+
+
+def spawn(argv: Sequence[str], *, cpu: Optional[int] = None, **kwargs: Any) \
+    -> ChildProcess:
+    with pinned_to(cpu):
+        return ChildProcess(Popen(argv, **kwargs))
@@ -0,0 +1,67 @@
+__all__ = 'RunDir', 'run_dir'
+
+from contextlib import contextmanager
+from pathlib import PosixPath
+from shutil import rmtree
+from typing import Iterator, List
+from uuid import uuid4
+
+from judger2.config import config
+
+
+class RunDir:
+    '''
+    The private dir of a run: an empty dir to chroot to, the dir runner.c
+    writes its result to, and the file the stderr of nsjail goes to.
+    '''
+
+    def __init__(self):
+        self.path = PosixPath(config.working_dir) / f'run-{uuid4()}'
+        self.path.mkdir()
+        self.path.chmod(0o700)
+        self.chroot = self.path / 'root'
+        self.chroot.mkdir(0o750)
+        self.result_dir = self.path / 'result'
+        self.result_dir.mkdir(0o700)
+        self.result_file = self.result_dir / 'result'
+        self.stderr = self.path / 'stderr'
+
+    def reset(self) -> bool:
+        '''Empties the dir for the next run, returns whether it could.'''
+        # nsjail creates mount points in the chroot dir, which would pile
+        # up as different paths are mounted by each run.
+        try:
+            rmtree(self.chroot)
+            self.chroot.mkdir(0o750)
+            self.result_file.unlink(missing_ok=True)
+        except OSError:
+            return False
+        return True
+
+    def remove(self):
+        # everything in here is created by us or by runner.c as root in
+        # its user namespace, which is us outside of it.
+        rmtree(self.path, ignore_errors=True)
+
+
+# Dirs of finished runs, ready for the next ones. Emptying the chroot dir
+# of a finished run is cheaper than setting up a fresh dir and removing
+# the old one, so they are reused instead. The pool grows to the number
+# of runs that have been going on at the same time, which is a few per
+# task slot.
+_free: List[RunDir] = []
+
+@contextmanager
+def run_dir(reusable: bool = True) -> Iterator[RunDir]:
+    '''
+    Gets a run dir from the pool. Runs that put anything into the chroot
+    dir are not reusable, and their dirs are removed afterwards.
+    '''
+    dir = _free.pop() if reusable and len(_free) > 0 else RunDir()
+    try:
+        yield dir
+    finally:
+        if reusable and dir.reset():
+            _free.append(dir)
+        else:
+            dir.remove()
@@ -48,7 +48,7 @@ time_ms_t gettime () {
   return time;
 }
 
-void set_timer (time_ms_t time) {
+void set_timer (int which, time_ms_t time) {
   /* Not using timer_create(2) here since timers created
      that way would be cleared upon execve(2), which is not
      desired for us.
@@ -58,7 +58,7 @@ void set_timer (time_ms_t time) {
   val.it_value.tv_usec = (time % SEC_TO_MS) * MS_TO_US;
   val.it_interval.tv_sec = 0;
   val.it_interval.tv_usec = 10 * MS_TO_US;
-  check(setitimer(ITIMER_REAL, &val, NULL), "setitimer");
+  check(setitimer(which, &val, NULL), "setitimer");
 }
 
 /* send error information to parent */
@@ -73,7 +73,7 @@ inline static void die_child (int fd, const char *msg) {
 
 int main (int argc, char **argv) {
   if (argc < 4) {
-    fprintf(stderr, "Usage: runner <time limit msecs> <result file> <executable> [args...]\n");
+    fprintf(stderr, "Usage: runner <time limit msecs>[:<cpu limit msecs>] <result file> <executable> [args...]\n");
     exit(126);
   }
   if (getuid() != 0 || geteuid() != 0) {
@@ -84,7 +84,11 @@ int main (int argc, char **argv) {
     exit(EXIT_FAILURE);
   }
 
-  time_ms_t time_limit = atoll(argv[1]);
+  /* The CPU time limit is optional, the program gets SIGPROF
+     once it has used up the CPU time. */
+  char *cpu_limit_str;
+  time_ms_t time_limit = strtoll(argv[1], &cpu_limit_str, 10);
+  time_ms_t cpu_limit = *cpu_limit_str == ':' ? atoll(cpu_limit_str + 1) : 0;
   const char * const results_file = argv[2];
   FILE *results = fopen(results_file, "w");
   check(!results, "fopen");
@@ -102,7 +106,10 @@ int main (int argc, char **argv) {
     if (setuid(WORKER_UID)) {
       die_child(pipefd[1], "setuid");
     }
-    set_timer(time_limit);
+    set_timer(ITIMER_REAL, time_limit);
+    if (cpu_limit > 0) {
+      set_timer(ITIMER_PROF, cpu_limit);
+    }
 
     execv(argv[3], &argv[3]);
     /* execv return only on errors. */
@@ -0,0 +1,182 @@
+__all__ = 'BatchChecker', 'BatchCheckers', 'BatchCheckerException', 'batch_checkers'
+
+from asyncio import (Future, IncompleteReadError, Lock, StreamReader,
+                     StreamReaderProtocol, Task, create_task, get_running_loop,
+                     wait_for)
+from contextlib import ExitStack
+from contextvars import ContextVar
+from dataclasses import replace
+from logging import getLogger
+from os import devnull, fdopen, pipe
+from pathlib import PosixPath
+from typing import Dict, Optional, Tuple
+
+from commons.task_typing import RunResult, SpjChecker
+from judger2.config import config
+from judger2.materialize import materialize
+from judger2.sandbox import run_with_limits
+from judger2.util import TempDir, copy_supplementary_files
+
+logger = getLogger(__name__)
+
+
+class BatchCheckerException(Exception): pass
+
+
+class BatchChecker:
+    '''
+    A checker of the batch format, which is started once for a task and
+    checks its testpoints one after another. For each testpoint, it reads
+    a line from stdin:
+
+        <input> <output> <answer>
+
+    and writes to stdout a line of the score and the length of the message
+    in bytes, followed by the message:
+
+        <score> <length>\\n<message>
+
+    It should exit once stdin is closed. The files of a testpoint are only
+    there until its result is written.
+    '''
+
+    def __init__(self, checker: SpjChecker, exe: PosixPath, testpoints: int):
+        self.checker = checker
+        self.exe = exe
+        self.testpoints = testpoints
+        self.lock = Lock()
+        self.count = 0
+        self.error: Optional[str] = None
+        self.stack = ExitStack()
+        self.run: Optional[Task[RunResult]] = None
+
+    async def start(self):
+        cwd = self.stack.enter_context(TempDir())
+        self.exchange = self.stack.enter_context(TempDir())
+        exec_file = cwd / 'spj'
+        materialize(self.exe, exec_file, 0o550)
+        await copy_supplementary_files(self.checker.supplementary_files, cwd)
+
+        r1, w1 = pipe()
+        r2, w2 = pipe()
+        requests_r = self.stack.enter_context(fdopen(r1, 'rb'))
+        self.requests = self.stack.enter_context(fdopen(w1, 'wb'))
+        responses_r = fdopen(r2, 'rb')
+        responses_w = self.stack.enter_context(fdopen(w2, 'wb'))
+
+        # the limits are for each testpoint, the checker runs for all of them.
+        limits = replace(self.checker.limits,
+            time_msecs=self.checker.limits.time_msecs * (self.testpoints + 1))
+        self.abort: Future[None] = get_running_loop().create_future()
+        self.run = create_task(run_with_limits(
+            'std', [str(exec_file)], cwd, limits,
+            infile=requests_r, outfile=responses_w,
+            supplementary_paths=[self.exchange],
+            abort=self.abort,
+        ))
+        def on_exit(_):
+            # we see the end of the responses once our end is closed.
+            requests_r.close()
+            responses_w.close()
+        self.run.add_done_callback(on_exit)
+
+        self.responses = StreamReader()
+        transport, _ = await get_running_loop().connect_read_pipe(
+            lambda: StreamReaderProtocol(self.responses), responses_r)
+        self.stack.callback(transport.close)
+
+    async def _read_response(self) -> Tuple[str, str]:
+        line = await self.responses.readline()
+        if line == b'':
+            raise BatchCheckerException('checker exited')
+        try:
+            score, length = line.decode(errors='replace').split()
+            message = await self.responses.readexactly(int(length))
+        except ValueError:
+            raise BatchCheckerException(f'invalid response {line[:100]!r}')
+        except IncompleteReadError as e:
+            raise BatchCheckerException(f'checker exited after {len(e.partial)} bytes of message')
+        return score, message.decode(errors='replace')
+
+    async def _fail(self, error: str):
+        self.error = error
+        if not self.abort.done():
+            self.abort.set_result(None)
+        assert self.run is not None
+        res = await self.run
+        if res.error is not None and res.error != 'system_error':
+            self.error += f' ({res.error}: {res.message})'
+
+    async def check(self, infile: Optional[PosixPath], outfile: PosixPath,
+                    answer: Optional[PosixPath]) -> Tuple[str, str]:
+        '''
+        Checks a testpoint, returns the score and the message written by
+        the checker. Raises BatchCheckerException if the checker fails,
+        and for all the testpoints after that.
+        '''
+        async with self.lock:
+            if self.error is not None:
+                raise BatchCheckerException(self.error)
+            self.count += 1
+            paths = []
+            for path, ext in (infile, 'in'), (outfile, 'out'), (answer, 'ans'):
+                if path is None:
+                    paths.append(PosixPath(devnull))
+                else:
+                    paths.append(self.exchange / f'{self.count}.{ext}')
+                    materialize(path, paths[-1])
+            try:
+                self.requests.write(' '.join(str(x) for x in paths).encode() + b'\n')
+                self.requests.flush()
+                timeout = self.checker.limits.time_msecs * config.relative_slowness / 1000 + 1
+                return await wait_for(self._read_response(), timeout)
+            except TimeoutError:
+                await self._fail('checker timed out')
+            except (BatchCheckerException, OSError) as e:
+                await self._fail(str(e))
+            finally:
+                for path in paths:
+                    if path.parent == self.exchange:
+                        path.unlink(missing_ok=True)
+            raise BatchCheckerException(self.error)
+
+    async def close(self):
+        try:
+            self.requests.close()
+            if self.run is not None:
+                try:
+                    res = await wait_for(self.run, 10.0)
+                    if res.error is not None:
+                        logger.warning('batch checker exited with %(error)s: %(message)s', { 'error': res.error, 'message': res.message }, 'checker:batch')
+                except TimeoutError:
+                    if not self.abort.done():
+                        self.abort.set_result(None)
+                    await self.run
+        finally:
+            self.stack.close()
+
+
+class BatchCheckers:
+    '''
+    The batch checkers of a task, started when they are first used.
+    '''
+
+    def __init__(self, testpoints: int):
+        self.testpoints = testpoints
+        self.checkers: Dict[PosixPath, BatchChecker] = {}
+
+    async def get(self, checker: SpjChecker, exe: PosixPath) -> BatchChecker:
+        if exe not in self.checkers:
+            batch = BatchChecker(checker, exe, self.testpoints)
+            self.checkers[exe] = batch
+            await batch.start()
+        return self.checkers[exe]
+
+    async def close(self):
+        for checker in self.checkers.values():
+            try:
+                await checker.close()
+            except Exception as e:
+                logger.error('error closing batch checker: %(error)s', { 'error': e }, 'checker:batch')
+
+batch_checkers: ContextVar[Optional[BatchCheckers]] = ContextVar('batch_checkers', default=None)
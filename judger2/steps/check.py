@@ -2,15 +2,19 @@ from logging import getLogger
 from math import isinf, isnan
 from os import devnull
 from pathlib import PosixPath
-from shutil import copy2
 from typing import Any, Callable, Coroutine, Dict, Literal, Optional, Type
 
+from commons.answer_hash import hash_answer
 from commons.task_typing import (Checker, CheckInput, CheckResult,
                                  CompareChecker, DirectChecker, RunResult, SpjChecker)
+from commons.util import asyncrun
 
 from judger2.cache import ensure_cached
 from judger2.config import config
+from judger2.materialize import materialize
 from judger2.sandbox import run_with_limits
+from judger2.steps.batch_check import (BatchCheckerException, BatchCheckers,
+                                       batch_checkers)
 from judger2.steps.compile_ import NotCompiledException, ensure_input
 from judger2.util import TempDir, copy_supplementary_files
 
@@ -41,6 +45,16 @@ checker_exe = '/bin/acmoj-checker'
 
 
 async def checker_cmp(_infile: PosixPath | None , outfile: PosixPath, _cwd: PosixPath, checker: CompareChecker):
+    if checker.answer_hash is not None:
+        # the checker tells nothing but whether they differ, which the
+        # hash of the answer tells as well without the answer.
+        def hash_output():
+            with open(outfile, 'rb') as f:
+                return hash_answer(f, checker.ignore_whitespace)
+        if await asyncrun(hash_output) == checker.answer_hash:
+            return CheckResult('accepted', '', 1.0)
+        return CheckResult('wrong_answer', '')
+
     ans = (await ensure_cached(checker.answer)).path
     argv = [checker_exe, '-ZB', '--', str(outfile), str(ans)] if checker.ignore_whitespace \
         else [checker_exe, '--', str(outfile), str(ans)]
@@ -74,6 +88,9 @@ def checker_read_float(outfile: PosixPath, message: str = ''):
         return CheckResult('bad_problem', 'Invalid score: score not number')
     except PermissionError:
         return CheckResult('bad_problem', 'Invalid score: cannot read score file')
+    return checker_score(score, message)
+
+def checker_score(score: float, message: str = ''):
     if isinf(score):
         return CheckResult('bad_problem', 'Invalid score: score is infinity')
     if isnan(score):
@@ -95,12 +112,13 @@ async def checker_spj(infile: Optional[PosixPath], outfile: PosixPath, \
         exe = (await ensure_input(checker.executable)).path
     except NotCompiledException as e:
         return CheckResult('bad_problem', f'cannot compile spj: {e}')
+    if checker.format == 'batch':
+        return await checker_spj_batch(infile, outfile, exe, checker)
 
     # run spj
     with TempDir() as cwd:
         exec_file = cwd / 'spj'
-        copy2(exe, exec_file)
-        exec_file.chmod(0o550)
+        materialize(exe, exec_file, 0o550)
 
         await copy_supplementary_files(checker.supplementary_files, cwd)
 
@@ -139,6 +157,29 @@ async def checker_spj(infile: Optional[PosixPath], outfile: PosixPath, \
         return checker_read_float(score, msg)
 
 
+async def checker_spj_batch(infile: Optional[PosixPath], outfile: PosixPath,
+                            exe: PosixPath, checker: SpjChecker) -> CheckResult:
+    ans = None if checker.answer is None \
+        else (await ensure_cached(checker.answer)).path
+    checkers = batch_checkers.get()
+    # checked on its own, e.g. outside of a task.
+    own = checkers is None
+    if checkers is None:
+        checkers = BatchCheckers(1)
+    try:
+        batch = await checkers.get(checker, exe)
+        score, message = await batch.check(infile, outfile, ans)
+    except BatchCheckerException as e:
+        return CheckResult('bad_problem', f'checker error: {e}')
+    finally:
+        if own:
+            await checkers.close()
+    try:
+        return checker_score(float(score), message)
+    except ValueError:
+        return CheckResult('bad_problem', 'Invalid score: score not number')
+
+
 type CheckerFunction = Callable[
     [Optional[PosixPath], PosixPath, PosixPath, Checker],
     Coroutine[Any, Any, CheckResult],
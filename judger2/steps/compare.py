@@ -0,0 +1,139 @@
+__all__ = 'StreamComparator',
+
+from asyncio import Future, StreamReader, StreamReaderProtocol, get_running_loop
+from pathlib import PosixPath
+from typing import IO, List, Optional
+
+from commons.task_typing import CheckResult
+
+chunk_size = 65536
+
+
+class StreamComparator:
+    '''
+    Compares the output of a program with the answer while the program is
+    running, the way acmoj-checker does: byte by byte, or line by line
+    ignoring trailing whitespace and blank lines if ignore_whitespace is
+    set. The run is aborted at the first difference, or once the output
+    is too long to be right.
+    '''
+
+    def __init__(self, answer: PosixPath, ignore_whitespace: bool):
+        self.answer = open(answer, 'rb')
+        self.ignore_whitespace = ignore_whitespace
+        # output longer than this is wrong even with all the whitespace
+        # that could be ignored.
+        self.max_bytes = answer.stat().st_size * 2 + 1048576
+        self.bytes = 0
+        # line of the output being compared, from 1.
+        self.line = 1
+        self.partial = b''
+        self.expected: Optional[bytes] = None
+        self.message: Optional[str] = None
+
+    def close(self):
+        self.answer.close()
+
+    def result(self) -> CheckResult:
+        if self.message is not None:
+            return CheckResult('wrong_answer', self.message)
+        return CheckResult('accepted', '', 1.0)
+
+    def differ(self, message: str) -> bool:
+        self.message = message
+        return False
+
+    def next_expected(self) -> Optional[bytes]:
+        # the next line of the answer that is not blank, without trailing
+        # whitespace, None at the end of the answer.
+        if self.expected is None:
+            while (line := self.answer.readline()) != b'':
+                line = line.rstrip()
+                if line != b'':
+                    self.expected = line
+                    break
+        return self.expected
+
+    def feed_lines(self, data: bytes) -> bool:
+        lines: List[bytes] = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if not self.compare_line(line.rstrip()):
+                return False
+            self.line += 1
+        # a line could be known to be wrong before it ends.
+        partial = self.partial.rstrip()
+        if partial != b'':
+            expected = self.next_expected()
+            if expected is None:
+                return self.differ(f'Output is longer than the answer at line {self.line}')
+            if not expected.startswith(partial):
+                return self.differ(f'Output differs from the answer at line {self.line}')
+        return True
+
+    def compare_line(self, line: bytes) -> bool:
+        if line == b'':
+            return True
+        expected = self.next_expected()
+        if expected is None:
+            return self.differ(f'Output is longer than the answer at line {self.line}')
+        if line != expected:
+            return self.differ(f'Output differs from the answer at line {self.line}')
+        self.expected = None
+        return True
+
+    def feed_bytes(self, data: bytes) -> bool:
+        expected = self.answer.read(len(data))
+        if data != expected:
+            diff = next((i for i, (a, b) in enumerate(zip(data, expected)) if a != b), len(expected))
+            self.line += data.count(b'\n', 0, diff)
+            if diff == len(expected):
+                return self.differ(f'Output is longer than the answer at line {self.line}')
+            return self.differ(f'Output differs from the answer at line {self.line}')
+        self.line += data.count(b'\n')
+        return True
+
+    def feed(self, data: bytes) -> bool:
+        '''
+        Compares the next part of the output, returns False if the output
+        is wrong.
+        '''
+        self.bytes += len(data)
+        if self.bytes > self.max_bytes:
+            return self.differ('Output is too long')
+        if self.ignore_whitespace:
+            return self.feed_lines(data)
+        return self.feed_bytes(data)
+
+    def finish(self) -> bool:
+        '''
+        Compares the end of the output, returns False if the output is
+        wrong.
+        '''
+        if self.ignore_whitespace:
+            if not self.compare_line(self.partial.rstrip()):
+                return False
+            if self.next_expected() is not None:
+                return self.differ(f'Output ends before the answer at line {self.line}')
+            return True
+        if self.answer.read(1) != b'':
+            return self.differ(f'Output ends before the answer at line {self.line}')
+        return True
+
+    async def consume(self, pipe: IO[bytes], ouf: IO[bytes], abort: Future[None]):
+        '''
+        Reads the output of a run from pipe into ouf, comparing it on the
+        way, and sets abort if it is wrong before the run is done.
+        '''
+        reader = StreamReader()
+        transport, _ = await get_running_loop().connect_read_pipe(
+            lambda: StreamReaderProtocol(reader), pipe)
+        try:
+            while (data := await reader.read(chunk_size)) != b'':
+                ouf.write(data)
+                if not self.feed(data):
+                    abort.set_result(None)
+                    return
+            self.finish()
+        finally:
+            transport.close()
@@ -2,11 +2,11 @@ __all__ = 'compile', 'ensure_input'
 
 from dataclasses import dataclass
 from logging import getLogger
-from os import chmod, utime
+from os import chmod, rename, utime
 from pathlib import PosixPath
-from shutil import copy2
 from subprocess import DEVNULL
 from tempfile import NamedTemporaryFile
+from time import time
 from typing import Any, Callable, Coroutine, Dict, List, Type
 from uuid import uuid4
 
@@ -16,8 +16,13 @@ from commons.task_typing import (CompileLocalResult, CompileResult,
                                  CompileSource, CompileSourceCpp,
                                  CompileSourceGit, CompileSourceVerilog,
                                  CompileTask, Input, ResourceUsage)
-from judger2.cache import CachedFile, ensure_cached, upload
+from judger2.cache import (CachedFile, cache_index, ensure_cached,
+                           get_cache_context, upload)
+from judger2.compile_cache import (compile_cache_key, lookup_compiled,
+                                   pch_cache_key, store_compiled)
 from judger2.config import config
+from judger2.materialize import materialize
+from judger2.pch import pch_dir
 from judger2.sandbox import chown_back, chown_to_user, run_with_limits
 from judger2.util import (FileConflictException, TempDir,
                           copy_supplementary_files)
@@ -30,6 +35,19 @@ class StageResult:
     message: str
 
 async def compile(task: CompileTask) -> CompileLocalResult:
+    cache_key = await compile_cache_key(task)
+    if cache_key is not None:
+        compiled = await lookup_compiled(cache_key, task.cache)
+        if compiled is not None:
+            logger.debug('using cached compile artifact %(key)s', { 'key': cache_key }, 'compile:cache:hit')
+            if task.artifact is not None:
+                local_path = (await upload(compiled.path, task.artifact.url)).path
+            else:
+                local_path = compiled.path
+            cached_result = CompileResult('compiled', compiled.message,
+                cache_key=cache_key, cache_hit=True)
+            return CompileLocalResult(result=cached_result, local_path=local_path)
+
     with TempDir() as cwd:
         type = task.source.__class__
         # prepare
@@ -50,6 +68,8 @@ async def compile(task: CompileTask) -> CompileLocalResult:
                 CompileResult(result='compile_error', message=str(e)),
                 local_path=None,
             )
+        if isinstance(task.source, CompileSourceCpp):
+            await precompile_headers(cwd, task)
 
         # compile
         # The compiled program returned by these functions
@@ -82,21 +102,87 @@ async def compile(task: CompileTask) -> CompileLocalResult:
         # Chown back, or else we probably couldn't copy the
         # artifact in case the file is of mode like 0700
         # set by the compiler or by a bad mask.
-        chown_back(cwd)
+        await chown_back(cwd)
+
+        if cache_key is not None:
+            res.result.cache_key = cache_key
+            compiled = await store_compiled(cache_key, res.local_path,
+                res.result.message, task.cache)
+            res.local_path = compiled.path
 
         # upload artifacts
         if task.artifact is not None:
             local_path = (await upload(res.local_path, task.artifact.url)).path
+        elif cache_key is not None:
+            # already copied into the cache
+            local_path = res.local_path
         else:
             local_path = PosixPath(config.cache_dir) / str(uuid4())
-            copy2(res.local_path, local_path)
+            materialize(res.local_path, local_path)
             # touch the local file so the file will be eventually deleted
             utime(local_path)
+            get_cache_context().pin(local_path)
+            cache_index.add(local_path)
 
         # done
         return CompileLocalResult(result=res.result, local_path=local_path)
 
 
+async def precompile_headers(cwd: PosixPath, task: CompileTask):
+    '''
+    Builds precompiled headers next to the headers. g++ uses a precompiled
+    header when the header is included before anything else and the flags
+    match, and silently parses the header otherwise. Precompiled headers
+    are cached, so the testpoints of a problem compiled per testpoint share
+    the work on the user's header.
+    '''
+    for header in task.precompiled_headers:
+        header_file = cwd / header
+        gch_file = cwd / f'{header}.gch'
+        if not header_file.is_file() or gch_file.exists():
+            continue
+        key = await pch_cache_key(task, header)
+        # an empty file is cached if the header could not be precompiled.
+        cached = PosixPath(config.cache_dir) / f'pch-{key}'
+        if cached.is_file():
+            utime(cached)
+            cache_index.touch(cached)
+            if cached.stat().st_size == 0:
+                logger.debug('header %(header)s could not be precompiled before', { 'header': header, 'key': key }, 'compile:pch:failed')
+                continue
+            logger.debug('using cached precompiled header %(key)s', { 'key': key }, 'compile:pch:hit')
+            materialize(cached, gch_file)
+            continue
+        res = await run_with_limits(
+            'std',
+            ['/bin/g++'] + config.compiler.cxx.flags +
+                ['-x', 'c++-header', str(header_file), '-o', str(gch_file)],
+            cwd, task.limits,
+        )
+        failed = res.error is not None or not gch_file.is_file()
+        if failed:
+            # errors in the header are reported by the compile itself.
+            logger.debug('cannot precompile header %(header)s: %(message)s', { 'header': header, 'message': res.message }, 'compile:pch:error')
+            gch_file.unlink(missing_ok=True)
+        else:
+            # the compiler could have created the file with a mode that
+            # does not allow us to read it.
+            await chown_back(gch_file)
+        part = cached.with_name(f'{cached.name}.{uuid4()}.part')
+        try:
+            if failed:
+                part.touch()
+            else:
+                materialize(gch_file, part)
+            rename(part, cached)
+        except OSError as e:
+            # the header is precompiled anyway, only the cache is missed.
+            logger.warning('cannot cache precompiled header %(header)s: %(error)s', { 'header': header, 'error': e }, 'compile:pch:error')
+            part.unlink(missing_ok=True)
+            continue
+        cache_index.add(cached)
+
+
 class NotCompiledException(Exception): pass
 
 async def ensure_input(input: Input) -> CachedFile:
@@ -117,7 +203,7 @@ async def prepare_cpp(
 ) -> StageResult:
     main_file = (await ensure_cached(source.main)).path
     code_file = cwd / config.compiler.cxx.file_name
-    copy2(main_file, code_file)
+    materialize(main_file, code_file)
     return StageResult(True, '')
 
 async def compile_cpp(
@@ -127,11 +213,19 @@ async def compile_cpp(
 ) -> CompileLocalResult:
     code_file = cwd / config.compiler.cxx.file_name
     exec_file = cwd / config.compiler.cxx.exec_name
+    include_dirs = []
+    pch = pch_dir()
+    if pch is not None:
+        include_dirs = ['-I', str(pch)]
+    start = time()
     res = await run_with_limits(
         'std',
-        ['/bin/g++'] + config.compiler.cxx.flags + [str(code_file), '-o', str(exec_file)],
+        ['/bin/g++'] + config.compiler.cxx.flags + include_dirs +
+            [str(code_file), '-o', str(exec_file)],
         cwd, limits,
+        supplementary_paths=[] if pch is None else [pch],
     )
+    logger.info('compiled C++ code in %(secs).2fs (pch: %(pch)s)', { 'secs': time() - start, 'pch': pch is not None }, 'compile:cpp')
     if res.error is not None:
         return CompileLocalResult.from_run_failure(res)
     return CompileLocalResult.from_file(exec_file, res.message)
@@ -150,7 +244,7 @@ async def prepare_git(
             chmod(tempfile.name, 0o600)
             tempfile.write(config.git.ssh.private_key)
             tempfile.flush()
-            chown_to_user(tempfile.name)
+            await chown_to_user(tempfile.name)
             bind = [
                 f'{tempfile.name}:/id_acmoj',
             ]
@@ -168,7 +262,7 @@ async def prepare_git(
                 ],
             )
         finally:
-            chown_back(tempfile.name)
+            await chown_back(tempfile.name)
             tempfile.close()
     
     # clone
@@ -253,7 +347,7 @@ async def prepare_verilog(
 ) -> StageResult:
     main_file = (await ensure_cached(source.main)).path
     code_file = cwd / config.compiler.verilog.file_name
-    copy2(main_file, code_file)
+    materialize(main_file, code_file)
     return StageResult(True, '')
 
 async def compile_verilog(
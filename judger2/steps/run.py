@@ -1,10 +1,9 @@
 __all__ = ('run',)
 
-from asyncio import FIRST_COMPLETED, create_task, wait
+from asyncio import FIRST_COMPLETED, Future, create_task, get_running_loop, wait
 from dataclasses import dataclass
 from os import chmod, fdopen, pipe
 from pathlib import PosixPath
-from shutil import copy2
 from signal import SIGPIPE
 from subprocess import DEVNULL
 from typing import IO, Dict, List, Optional, Tuple, Union
@@ -13,7 +12,9 @@ from commons.task_typing import Input, RunArgs, RunResult
 from commons.util import TempDir
 from judger2.cache import ensure_cached, upload
 from judger2.config import config
+from judger2.materialize import materialize
 from judger2.sandbox import Profile, run_with_limits
+from judger2.steps.compare import StreamComparator
 from judger2.steps.compile_ import NotCompiledException, ensure_input
 from judger2.util import InvalidProblemException, copy_supplementary_files
 
@@ -33,7 +34,7 @@ class BaseRunner:
         return result
     async def run(self, cwd: PosixPath,
                   exec_file: PosixPath, inf: Union[IO, int], ouf: Union[IO, int],
-                  args: RunArgs) -> RunResult:
+                  args: RunArgs, abort: Optional[Future[None]] = None) -> RunResult:
         params: RunParams = self.prepare(exec_file)
         return self.interpret_result(await run_with_limits(
             params.profile, params.argv, cwd, args.limits,
@@ -42,6 +43,7 @@ class BaseRunner:
             disable_stderr=True,
             disable_proc=params.disable_procfs,
             tmpfsmount=params.tmpfsmount,
+            abort=abort,
         ))
 
 elf_mode = 0o550
@@ -137,8 +139,7 @@ async def run_interactive(cwd: PosixPath,
     with TempDir() as interactor_wd, TempDir() as exe_dir:
         # prepare executables
         interactor_exe = exe_dir / exe.filename
-        copy2(exe.path, interactor_exe)
-        chmod(interactor_exe, elf_mode)
+        materialize(exe.path, interactor_exe, elf_mode)
         chmod(exec_file, elf_mode)
 
         # and supplementary files
@@ -188,8 +189,34 @@ async def run_interactive(cwd: PosixPath,
         return result_of_interactive(res_user, res_interactor)
 
 
-async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
-    -> RunResult:
+async def run_compared(runner: BaseRunner, cwd: PosixPath, exec_file: PosixPath,
+                       inf: Union[IO, int], outfile: PosixPath, args: RunArgs,
+                       comparator: StreamComparator) -> RunResult:
+    # the output goes through a pipe to the comparator, which writes it
+    # to outfile and kills the run once the output is known to be wrong.
+    r, w = pipe()
+    abort: Future[None] = get_running_loop().create_future()
+    with fdopen(r, 'rb') as pipe_r, fdopen(w, 'wb') as pipe_w, \
+        open(outfile, 'wb') as ouf:
+        task_compare = create_task(comparator.consume(pipe_r, ouf, abort))
+        try:
+            res = await runner.run(cwd, exec_file, inf, pipe_w, args, abort)
+        finally:
+            # the comparator sees the end of the output once we close this.
+            pipe_w.close()
+            await task_compare
+    if abort.done():
+        assert comparator.message is not None
+        return RunResult('wrong_answer', comparator.message, res.resource_usage)
+    return res
+
+
+async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs,
+              comparator: Optional[StreamComparator] = None) -> RunResult:
+    '''
+    Runs the program of a testpoint. With a comparator, the output is
+    compared with the answer while the program runs, see run_compared.
+    '''
     # get infile
     infile = None if args.infile is None \
         else (await ensure_cached(args.infile)).path
@@ -202,7 +229,7 @@ async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
     except NotCompiledException as e:
         return RunResult('compile_error', str(e))
     exec_file = oufdir / exe.filename
-    copy2(exe.path, exec_file)
+    materialize(exe.path, exec_file, elf_mode)
     if exe.filename == outfile_name:
         outfile = oufdir / f'{outfile_name}1'
 
@@ -215,8 +242,12 @@ async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
         runner = runners[args.type]
         try:
             inf = None if infile is None else open(infile, 'r')
-            with open(outfile, 'w') as ouf:
-                res = await runner.run(cwd, exec_file, DEVNULL if inf is None else inf, ouf, args)
+            if comparator is not None:
+                res = await run_compared(runner, cwd, exec_file,
+                    DEVNULL if inf is None else inf, outfile, args, comparator)
+            else:
+                with open(outfile, 'w') as ouf:
+                    res = await runner.run(cwd, exec_file, DEVNULL if inf is None else inf, ouf, args)
         finally:
             try:
                 if inf is not None and not inf.closed:
@@ -1,14 +1,20 @@
+from asyncio import Task, create_task
+from contextlib import AbstractContextManager, ExitStack, nullcontext
 from logging import getLogger
 from pathlib import PosixPath
 from typing import List, Optional, Sequence, Union
-from commons.task_typing import (Artifact, CompileResult, CompileTask, Input,
+from commons.task_typing import (Artifact, CompareChecker, CompileResult, CompileTask, Input,
                                  InvalidTaskException, JudgeResult, JudgeTask, ResourceUsage,
-                                 RunResult, StatusUpdateProgress, Testpoint,
+                                 RunResult, SpjChecker, StatusUpdateProgress, Testpoint,
                                  TestpointJudgeResult)
 from commons.util import format_exc
+from judger2.cache import FileTooLargeException, ensure_cached
+from judger2.config import config
 from judger2.interface import ProgressReporter
 from judger2.logging_ import task_logger
+from judger2.steps.batch_check import BatchCheckers, batch_checkers
 from judger2.steps.check import check
+from judger2.steps.compare import StreamComparator
 from judger2.steps.compile_ import compile
 from judger2.steps.run import run
 from judger2.util import TempDir, copy_supplementary_files
@@ -60,12 +66,18 @@ async def judge_testpoint(testpoint: Testpoint[Input], result: JudgeResult, \
             message=skip_reason,
         )
 
-    with TempDir() as oufdir:
+    with TempDir() as oufdir, ExitStack() as stack:
         output: Union[CompileTask, Artifact, RunResult]
+        comparator: Optional[StreamComparator] = None
         if testpoint.run is not None:
             await copy_supplementary_files(testpoint.run.supplementary_files,
                 cwd)
-            output = await run(oufdir, cwd, testpoint.input, testpoint.run)
+            if config.checker.streaming and isinstance(testpoint.check, CompareChecker) \
+            and testpoint.run.interactor is None:
+                ans = (await ensure_cached(testpoint.check.answer)).path
+                comparator = StreamComparator(ans, testpoint.check.ignore_whitespace)
+                stack.callback(comparator.close)
+            output = await run(oufdir, cwd, testpoint.input, testpoint.run, comparator)
             logger.debug('run result: %(result)s', { 'result': output }, 'testpoint:run')
             rusage.value = output.resource_usage
             if output.error is not None:
@@ -78,7 +90,8 @@ async def judge_testpoint(testpoint: Testpoint[Input], result: JudgeResult, \
         else:
             output = testpoint.input
 
-        check_res = await check(output, cwd, testpoint.check)
+        check_res = comparator.result() if comparator is not None \
+            else await check(output, cwd, testpoint.check)
         logger.debug('check result: %(result)s', { 'result': check_res }, 'testpoint:check')
         res = TestpointJudgeResult(
             **check_res.__dict__,
@@ -88,23 +101,96 @@ async def judge_testpoint(testpoint: Testpoint[Input], result: JudgeResult, \
         task_logger.debug('testpoint %(id)s finished with %(result)s', { 'id': testpoint.id, 'result': res }, 'testpoint:done')
         return res
 
+def testpoint_files(testpoint: Testpoint[Input]) -> List[str]:
+    '''
+    URLs of the files a testpoint needs. Executables that are compiled by
+    the testpoint are not included.
+    '''
+    urls: List[str] = []
+    def add_input(input: Input):
+        if isinstance(input, Artifact):
+            urls.append(input.url)
+
+    add_input(testpoint.input)
+    if testpoint.run is not None:
+        if testpoint.run.infile is not None:
+            urls.append(testpoint.run.infile)
+        urls.extend(testpoint.run.supplementary_files)
+        if testpoint.run.interactor is not None:
+            add_input(testpoint.run.interactor.executable)
+            urls.extend(testpoint.run.interactor.supplementary_files)
+    check = testpoint.check
+    if isinstance(check, CompareChecker):
+        # answers with a hash are only needed to compare while running.
+        if check.answer_hash is None or config.checker.streaming:
+            urls.append(check.answer)
+    elif isinstance(check, SpjChecker):
+        add_input(check.executable)
+        if check.answer is not None:
+            urls.append(check.answer)
+        urls.extend(check.supplementary_files)
+    return list(dict.fromkeys(urls))
+
+async def prefetch(urls: List[str]):
+    '''
+    Fetches files into the cache ahead of time, until the prefetch budget
+    runs out. Errors are left for the testpoint to report when it fetches
+    the file itself.
+    '''
+    budget = config.task.prefetch_bytes
+    for url in urls:
+        try:
+            file = await ensure_cached(url, max_bytes=budget)
+        except FileTooLargeException:
+            return
+        except Exception as e:
+            logger.debug('error prefetching file: %(error)s', { 'error': e }, 'testpoint:prefetch')
+            continue
+        budget -= file.path.stat().st_size
+        if budget <= 0:
+            return
+
+def prefetch_next(task: JudgeTask[Input], i: int) -> Optional[Task[None]]:
+    '''
+    Starts fetching the files of testpoint i + 1 while testpoint i runs.
+    Testpoint i joins the fetches of files it shares with testpoint i + 1.
+    '''
+    if i + 1 >= len(task.testpoints) or config.task.prefetch_bytes == 0:
+        return None
+    return create_task(prefetch(testpoint_files(task.testpoints[i + 1])))
+
 async def judge_task(reporter: ProgressReporter, task: JudgeTask[Input]) -> JudgeResult:
     result = JudgeResult([None for _ in task.testpoints])
-    with TempDir() as cwd:
-        for i, testpoint in enumerate(task.testpoints):
-            rusage = Ref[ResourceUsage](None)
-            try:
-                result.testpoints[i] = \
-                    await judge_testpoint(testpoint, result, cwd, rusage)
-            except Exception as e:
-                logger.error('error judging testpoint: %(error)s', { 'error': e }, 'testpoint:error')
-                result.testpoints[i] = TestpointJudgeResult(
-                    id=testpoint.id,
-                    result='system_error',
-                    message=str(e),
-                    resource_usage=rusage.value,
-                )
+    prefetching: Optional[Task[None]] = None
+    checkers = BatchCheckers(len(task.testpoints))
+    batch_checkers.set(checkers)
+    with TempDir() as task_cwd:
+        try:
+            for i, testpoint in enumerate(task.testpoints):
+                # at most one testpoint is prefetched at a time.
+                if prefetching is not None:
+                    await prefetching
+                prefetching = prefetch_next(task, i)
+                rusage = Ref[ResourceUsage](None)
+                cwd_context: AbstractContextManager[PosixPath] = \
+                    TempDir() if task.isolated else nullcontext(task_cwd)
+                try:
+                    with cwd_context as cwd:
+                        result.testpoints[i] = \
+                            await judge_testpoint(testpoint, result, cwd, rusage)
+                except Exception as e:
+                    logger.error('error judging testpoint: %(error)s', { 'error': e }, 'testpoint:error')
+                    result.testpoints[i] = TestpointJudgeResult(
+                        id=testpoint.id,
+                        result='system_error',
+                        message=str(e),
+                        resource_usage=rusage.value,
+                    )
 
-            await reporter(StatusUpdateProgress(result))
+                await reporter(StatusUpdateProgress(result))
+        finally:
+            if prefetching is not None:
+                prefetching.cancel()
+            await checkers.close()
 
     return result
@@ -1,34 +1,76 @@
-from asyncio import as_completed
+from asyncio import Task, as_completed, get_running_loop, run
 from logging import getLogger
 from pathlib import PosixPath
-from shutil import copy2
-from typing import Dict, List, Tuple, Union
+from shutil import rmtree
+from typing import Dict, List, Optional, Tuple, Union
 
 from commons.task_typing import FileUrl
-from commons.util import TempDir, format_exc
+from commons.util import TempDir, asyncrun, format_exc
 
 from judger2.cache import ensure_cached
 from judger2.config import config
+from judger2.materialize import materialize
 
 logger = getLogger(__name__)
 
 
-def _judger_before_tmpdir_exit(path: PosixPath):
+def _rmtree(path: PosixPath) -> bool:
+    failed = False
+    def onexc(*_args):
+        nonlocal failed
+        failed = True
+    rmtree(path, onexc=onexc)
+    return not failed
+
+# temp dirs that could not be removed, waiting for chown_back. They are
+# only taken off once removed, so that dirs of a cancelled round are left
+# for the next one.
+_pending_chown: List[PosixPath] = []
+_chowning: Optional[Task] = None
+
+async def _chown_and_remove():
+    # Why chown_back:
+    # There may be some subdirtectories in the temp
+    # dir that are created by the worker process.
+    # In that case, these dirs are owned by the
+    # worker user, not the current user, thus rmtree
+    # would fail on these files. However, we could
+    # create a new namespace and chown these things
+    # back to our user, so these files could be
+    # removed by rmtree.
     # import here to avoid circular reference
     from judger2.sandbox import chown_back
+    # dirs left while chown_back is running are handled in the next round,
+    # so a burst of exits costs a single nsjail.
+    while len(_pending_chown) > 0:
+        paths = _pending_chown.copy()
+        try:
+            await chown_back(*paths)
+        except Exception as e:
+            logger.error('error chowning temp dirs %(paths)s: %(error)s', { 'paths': paths, 'error': e }, 'tempdir:remove')
+        for path in paths:
+            if not await asyncrun(lambda: _rmtree(path)):
+                logger.error('error removing temp dir %(path)s', { 'path': path }, 'tempdir:remove')
+            _pending_chown.remove(path)
+
+def _judger_before_tmpdir_exit(path: PosixPath) -> bool:
+    global _chowning
+    # Most dirs have nothing of the worker in them that we could not
+    # remove, so rmtree is tried first and chown_back is only spawned for
+    # the rest, batched with the other dirs waiting for it.
+    if _rmtree(path):
+        return True
+    _pending_chown.append(path)
     try:
-        # Why chown_back:
-        # There may be some subdirtectories in the temp
-        # dir that are created by the worker process.
-        # In that case, these dirs are owned by the
-        # worker user, not the current user, thus rmtree
-        # would fail on these files. However, we could
-        # create a new namespace and chown these things
-        # back to our user, so these files could be
-        # removed by rmtree.
-        chown_back(path)
-    except Exception as e:
-        logger.error('error removing temp dir %(path)s: %(error)s', { 'path': path, 'error': e }, 'tempdir:remove')
+        loop = get_running_loop()
+    except RuntimeError:
+        run(_chown_and_remove())
+        return True
+    # TempDir is left from async code, where chown_back must not block the
+    # event loop, so the dir is removed in the background.
+    if _chowning is None or _chowning.done():
+        _chowning = loop.create_task(_chown_and_remove())
+    return True
 
 TempDir.config(str(config.working_dir), _judger_before_tmpdir_exit)
 
@@ -45,7 +87,7 @@ async def copy_supplementary_files(files: List[FileUrl], cwd: PosixPath):
             dest = cwd / file.filename
             if dest.is_file():
                 raise FileConflictException(f'File \'{file.filename}\' already exists')
-            copy2(file.path, dest)
+            materialize(file.path, dest)
         except FileConflictException:
             raise
         except Exception as e:
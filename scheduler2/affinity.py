@@ -0,0 +1,131 @@
+__all__ = 'enqueue_task',
+
+from asyncio import CancelledError, Task, create_task, shield, sleep
+from logging import getLogger
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from commons.bloom import BloomFilter
+from commons.task_typing import CompareChecker, JudgeTask, SpjChecker, TaskType
+from commons.util import Heartbeat, RedisQueues, cache_id
+from scheduler2.config import (affinity_candidates, affinity_deadline_secs,
+                               affinity_refresh_secs, affinity_stale_secs,
+                               redis, redis_queues)
+from scheduler2.metrics import tasks_dispatched_total
+from scheduler2.util import push_task, remove_task
+
+logger = getLogger(__name__)
+
+
+# Runners advertise bloom filters of their cached files. Tasks are sent to
+# a runner with a free slot that has the most of the task's files through a queue of
+# its own, and moved to the shared queue of the group if the runner has
+# not taken them within a short deadline.
+runner_caches: Dict[str, Tuple[float, Dict[str, BloomFilter]]] = {}
+refreshing_caches: Dict[str, Task[Dict[str, BloomFilter]]] = {}
+# number of tasks sent to each runner that it has not taken yet.
+pending_tasks: Dict[str, int] = {}
+
+
+async def fetch_runner_caches(group: str) -> Dict[str, BloomFilter]:
+    now = time()
+    caches: Dict[str, BloomFilter] = {}
+    for runner_id, value in (await redis.hgetall(redis_queues.caches_group(group))).items():
+        timestamp, dump = value.split(' ', 1)
+        if float(timestamp) < now - affinity_stale_secs:
+            continue
+        caches[runner_id] = BloomFilter.load(dump)
+    runner_caches[group] = (now, caches)
+    return caches
+
+async def get_runner_caches(group: str) -> Dict[str, BloomFilter]:
+    cached = runner_caches.get(group)
+    if cached is not None and cached[0] > time() - affinity_refresh_secs:
+        return cached[1]
+    if group not in refreshing_caches:
+        task = create_task(fetch_runner_caches(group))
+        refreshing_caches[group] = task
+        task.add_done_callback(lambda _: refreshing_caches.pop(group, None))
+    # do not wait for the refresh if there is anything to use.
+    if cached is not None:
+        return cached[1]
+    return await shield(refreshing_caches[group])
+
+
+def task_files(task: TaskType) -> List[str]:
+    if not isinstance(task, JudgeTask):
+        return []
+    urls: List[str] = []
+    for testpoint in task.testpoints:
+        if testpoint.run is not None:
+            if testpoint.run.infile is not None:
+                urls.append(testpoint.run.infile)
+            urls.extend(testpoint.run.supplementary_files)
+        if isinstance(testpoint.check, (CompareChecker, SpjChecker)) \
+        and testpoint.check.answer is not None:
+            urls.append(testpoint.check.answer)
+    return urls
+
+async def pick_runner(group: str, task: TaskType) -> Optional[str]:
+    ids = [cache_id(x) for x in task_files(task)]
+    if len(ids) == 0:
+        return None
+    caches = await get_runner_caches(group)
+    scores = [(sum(id in cache for id in ids), runner_id)
+        for runner_id, cache in caches.items()]
+    scores = sorted(filter(lambda x: x[0] > 0, scores), reverse=True)
+    for _, runner_id in scores[:affinity_candidates]:
+        runner_queues = redis_queues.runner(RedisQueues.RunnerInfo(runner_id, group))
+        heartbeat = await redis.get(runner_queues.heartbeat)
+        if heartbeat is None:
+            continue
+        # the runner has a free slot for the task.
+        slots = len(Heartbeat.load(heartbeat).slots)
+        running = await redis.llen(runner_queues.in_progress)
+        if running + pending_tasks.get(runner_id, 0) < slots:
+            return runner_id
+    return None
+
+
+async def send_to_runner(group: str, runner_id: str, message: str):
+    runner_queue = redis_queues.tasks_runner(group, runner_id)
+    pending_tasks[runner_id] = pending_tasks.get(runner_id, 0) + 1
+    try:
+        await push_task(runner_queue, message)
+        tasks_dispatched_total.labels(route='runner').inc()
+        try:
+            await sleep(affinity_deadline_secs)
+        except CancelledError:
+            # the task is started or given up, do not leave it for the
+            # runner if it has not been taken.
+            await shield(remove_task(runner_queue, message))
+            raise
+        # only move the task if the runner has not taken it in the meantime.
+        if await remove_task(runner_queue, message):
+            logger.debug('runner %(runner)s did not take task in time, falling back to shared queue', { 'runner': runner_id }, 'task:affinity')
+            tasks_dispatched_total.labels(route='fallback').inc()
+            # consumers take tasks from the right end, so the task does
+            # not wait behind those queued after it.
+            await push_task(redis_queues.tasks_group(group), message, first=True)
+    finally:
+        pending_tasks[runner_id] -= 1
+        if pending_tasks[runner_id] == 0:
+            del pending_tasks[runner_id]
+
+async def enqueue_task(group: str, task: TaskType, message: str) \
+    -> Optional[Task[None]]:
+    '''
+    Sends the task to runners. If the task is sent to a specific runner,
+    returns the task moving it to the shared queue after the deadline,
+    which should be cancelled once the task is started.
+    '''
+    try:
+        runner_id = await pick_runner(group, task)
+    except Exception as e:
+        logger.warn('cannot pick runner by cache: %(error)s', { 'error': e }, 'task:affinity')
+        runner_id = None
+    if runner_id is None:
+        await push_task(redis_queues.tasks_group(group), message)
+        tasks_dispatched_total.labels(route='shared').inc()
+        return None
+    return create_task(send_to_runner(group, runner_id, message))
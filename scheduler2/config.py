@@ -28,6 +28,11 @@ s3_buckets = S3Buckets(**config['s3']['buckets'])
 def plan_key(problem_id: str) -> str:
     return f'plans/{problem_id}.json'
 
+# Shared compile cache objects, in the artifacts bucket. These are not
+# removed by the scheduler; configure an expiration rule for this prefix.
+def compile_cache_key(digest: str) -> str:
+    return f'compile-cache/{digest}'
+
 
 problem_config_filename = 'config.json'
 quiz_filename = 'quiz.json'
@@ -41,6 +46,10 @@ redis = Redis(
     socket_keepalive=True,
 )
 
+# historical running time of testpoints, for batching testpoints.
+def runtimes_key(problem_id: str) -> str:
+    return f'{config["redis"]["prefix"]}-runtimes-{problem_id}'
+
 
 Secs = 1000
 KiB = 1024
@@ -78,3 +87,28 @@ request_retries = 10
 request_retry_interval_secs = 2
 
 runner_heartbeat_interval_secs = 2.0
+
+plan_cache_size = 64
+
+# presigned urls of problem files are reused while they are still valid
+# for this long, which is long enough for any task they are sent in.
+signed_url_min_validity_secs = task_timeout_secs * 4
+signed_url_cache_size = 65536
+
+# connections kept to S3, and S3 requests (other than signing urls) made
+# at the same time; requests failing with connection or server errors are
+# retried this many times.
+s3_pool_size = 32
+s3_concurrency = 32
+s3_retries = 3
+
+affinity_deadline_secs = 2.0
+affinity_refresh_secs = 5.0
+affinity_stale_secs = 60.0
+affinity_candidates = 3
+
+progress_read_batch = 256
+progress_read_block_msecs = 5000
+
+testpoint_runtime_ewma_alpha = 0.3
+testpoint_runtime_ttl_secs = 30 * 86400 # 30 days
@@ -1,4 +1,5 @@
-from asyncio import FIRST_COMPLETED, CancelledError, create_task, sleep, wait
+from asyncio import (FIRST_COMPLETED, CancelledError, Task, create_task, sleep,
+                     wait)
 from logging import getLogger
 from time import time
 from typing import Awaitable, Callable, Optional
@@ -11,12 +12,15 @@ from commons.task_typing import (CompileResult, CompileTask, Input,
                                  JudgeResult, JudgeTask, StatusUpdate,
                                  StatusUpdateDone, StatusUpdateError,
                                  StatusUpdateProgress, StatusUpdateStarted)
-from commons.util import deserialize, serialize
+from commons.util import TaskMessage, deserialize, serialize
+from scheduler2.affinity import enqueue_task
 from scheduler2.config import (redis, redis_queues,
                                task_concurrency_per_account, task_retries,
                                task_retry_interval_secs, task_timeout_secs)
 from scheduler2.metrics import observe_runner, tasks_by_state, tasks_retried_total
 from scheduler2.monitor import wait_until_offline
+from scheduler2.progress import (next_progress, subscribe_progress,
+                                 unsubscribe_progress)
 from scheduler2.util import (RateLimiter, RunnerOfflineException, TaskInfo,
                              taskinfo_from_task_id)
 
@@ -44,6 +48,7 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
                    retries_left = task_retries):
     task_id = str(uuid4())
     taskinfo.id = task_id
+    taskinfo.runner_id = None
     task = taskinfo.task
     taskinfo_from_task_id[task_id] = taskinfo
     tasks_by_state.labels(state='waiting_for_rate_limit').inc()
@@ -70,17 +75,18 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
             logger.debug('running task %(id)s: %(task)s', { 'id': task_id, 'task': task }, 'task:start')
 
             queues = redis_queues.task(task_id)
-            await redis.lpush(queues.task, serialize(task))
-            await redis.expire(queues.task, task_timeout_secs)
-            await redis.lpush(redis_queues.tasks_group(taskinfo.group), task_id)
+            progress = subscribe_progress(task_id)
             task_timeout = time() + task_timeout_secs
+            task_message = TaskMessage(task_id, task_timeout, serialize(task))
+            affinity_task = await enqueue_task(taskinfo.group, task,
+                                               task_message.dump())
 
             offline_task = None
             try:
                 while True:
-                    progress_task = create_task(redis.brpop(queues.progress,
-                        int(task_timeout - time())))
-                    tasks = (progress_task,)
+                    progress_task = create_task(next_progress(progress,
+                        task_timeout - time()))
+                    tasks: tuple[Task, ...] = (progress_task,)
                     if offline_task is not None:
                         tasks = (progress_task, offline_task)
                     done, _ = await wait(tasks, return_when=FIRST_COMPLETED)
@@ -91,14 +97,16 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
                             return await retry('Runner offline')
                     if res is None:
                         return await retry('Task timed out')
-                    _, status = res
-                    status: StatusUpdate = deserialize(status)  # type: ignore
+                    status: StatusUpdate = deserialize(res)  # type: ignore
                     logger.debug('received status update from task %(id)s: %(status)s', { 'id': task_id, 'status': status }, 'task:update')
 
                     if isinstance(status, StatusUpdateStarted):
                         tasks_by_state.labels(state='queued').dec()
                         tasks_by_state.labels(state='started').inc()
                         reached_started = True
+                        taskinfo.runner_id = status.id
+                        if affinity_task is not None:
+                            affinity_task.cancel()
                         observe_runner(status.id)
                         offline_task = wait_until_offline(status.id)
                         if onprogress is not None:
@@ -120,6 +128,9 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
                 await redis.lpush(queues.abort, 1)
                 await redis.expire(queues.abort, task_timeout_secs)
                 raise
+            finally:
+                if affinity_task is not None:
+                    affinity_task.cancel()
     finally:
         if reached_started:
             tasks_by_state.labels(state='started').dec()
@@ -127,4 +138,5 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
             tasks_by_state.labels(state='queued').dec()
         else:
             tasks_by_state.labels(state='waiting_for_rate_limit').dec()
+        unsubscribe_progress(task_id)
         del taskinfo_from_task_id[task_id]
@@ -16,15 +16,18 @@ from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from commons.task_typing import (CodeLanguage, ProblemJudgeResult,
                                  SourceLocation)
-from commons.util import deserialize, dump_dataclass, format_exc, serialize
+from commons.util import dump_dataclass, format_exc, serialize
 from scheduler2.config import (host, plan_key, port,
                                runner_heartbeat_interval_secs, s3_buckets)
-from scheduler2.monitor import get_runner_status
+from scheduler2.monitor import (get_runner_status, start_reclaimer,
+                                stop_reclaimer)
 from scheduler2.plan import (InvalidCodeException, InvalidProblemException,
-                             execute_plan, generate_plan, get_partial_result)
+                             execute_plan, forget_runtimes, generate_plan,
+                             get_partial_result, invalidate_plan, load_plan)
 from scheduler2.plan.languages import languages_accepted
+from scheduler2.progress import start_progress_consumer, stop_progress_consumer
 from scheduler2.plan.summary import summarize
-from scheduler2.s3 import read_file, upload_str
+from scheduler2.s3 import close_s3, upload_str
 from scheduler2.metrics import (judge_completed_total, judge_duration_seconds,
                                 judge_requests_total, start_metrics,
                                 stop_metrics)
@@ -78,6 +81,8 @@ async def update_problem(request: Request):
         summary = dump_dataclass(summarize(plan))
         plan_str = serialize(plan)
         await upload_str(s3_buckets.problems, plan_key(problem_id), plan_str)
+        invalidate_plan(problem_id)
+        await forget_runtimes(problem_id)
     except InvalidProblemException as e:
         return json_response({'result': 'invalid problem', 'error': str(e)})
     except Exception as e:
@@ -97,15 +102,13 @@ async def run_judge(problem_id: str, submission_id: str,
     start_time = time()
     logger.info('judging submission %(id)s for problem %(problem)s', { 'id': submission_id, 'problem': problem_id }, 'judge:start')
     try:
-        plan_str = None
+        plan = None
         try:
-            plan_str = await read_file(s3_buckets.problems, plan_key(problem_id))
+            plan = await load_plan(problem_id)
         except ClientError:
             msg = 'Cannot get judge plan'
             res = ProblemJudgeResult(result='bad_problem', message=msg)
-        if plan_str is not None:
-            plan = deserialize(plan_str)
-            logger.debug('plan for problem %(id)s loaded', { 'id': problem_id }, 'plan:load')
+        if plan is not None:
             res = await execute_plan(plan, submission_id, problem_id, language,
                 source, rate_limit_group)
     except CancelledError:
@@ -227,5 +230,10 @@ if __name__ == '__main__':
     app = Application()
     app.add_routes(routes)
     app.on_startup.append(start_metrics)
+    app.on_startup.append(start_reclaimer)
+    app.on_startup.append(start_progress_consumer)
     app.on_cleanup.append(stop_metrics)
+    app.on_cleanup.append(stop_reclaimer)
+    app.on_cleanup.append(stop_progress_consumer)
+    app.on_cleanup.append(close_s3)
     run_app(app, host=host, port=port, print=None)  # type: ignore
@@ -24,6 +24,35 @@ tasks_retried_total = Counter(
     'Total task retries',
     ['reason'],
 )
+tasks_dispatched_total = Counter(
+    'scheduler_tasks_dispatched_total',
+    'Total tasks sent to runners, by the queue used',
+    ['route'],
+)
+compile_cache_lookups_total = Counter(
+    'scheduler_compile_cache_lookups_total',
+    'Total compile cache lookups reported by runners',
+    ['result'],
+)
+plan_cache_lookups_total = Counter(
+    'scheduler_plan_cache_lookups_total',
+    'Total judge plan cache lookups',
+    ['result'],
+)
+signed_urls_total = Counter(
+    'scheduler_signed_urls_total',
+    'Total presigned urls generated',
+    ['method'],
+)
+signed_url_seconds_total = Counter(
+    'scheduler_signed_url_seconds_total',
+    'Total time spent generating presigned urls',
+)
+signed_url_cache_lookups_total = Counter(
+    'scheduler_signed_url_cache_lookups_total',
+    'Total presigned url cache lookups',
+    ['result'],
+)
 
 # Histogram
 judge_duration_seconds = Histogram(
@@ -41,6 +70,14 @@ active_tasks = Gauge(
     'scheduler_active_tasks',
     'Number of currently dispatched tasks',
 )
+plan_cache_entries = Gauge(
+    'scheduler_plan_cache_entries',
+    'Number of judge plans in the plan cache',
+)
+signed_url_cache_entries = Gauge(
+    'scheduler_signed_url_cache_entries',
+    'Number of presigned urls in the url cache',
+)
 
 # Task state gauge (incremented/decremented in dispatch.py)
 tasks_by_state = Gauge(
@@ -57,8 +94,18 @@ def _count_active_tasks():
     from scheduler2.util import taskinfo_from_task_id
     return len(taskinfo_from_task_id)
 
+def _count_cached_plans():
+    from scheduler2.plan.cache import cached_plans
+    return len(cached_plans)
+
+def _count_cached_urls():
+    from scheduler2.s3 import signed_urls
+    return len(signed_urls)
+
 active_judges.set_function(_count_active_judges)
 active_tasks.set_function(_count_active_tasks)
+plan_cache_entries.set_function(_count_cached_plans)
+signed_url_cache_entries.set_function(_count_cached_urls)
 
 # Runner status gauges (updated by background task)
 runner_online = Gauge(
@@ -72,6 +119,33 @@ runner_status = Gauge(
     ['runner_id', 'status'],
 )
 
+runner_cache_hits = Gauge(
+    'scheduler_runner_cache_hits',
+    'File cache hits reported by a runner since it started',
+    ['runner_id'],
+)
+runner_cache_misses = Gauge(
+    'scheduler_runner_cache_misses',
+    'File cache misses reported by a runner since it started',
+    ['runner_id'],
+)
+runner_cache_evicted_bytes = Gauge(
+    'scheduler_runner_cache_evicted_bytes',
+    'Bytes evicted from the file cache of a runner since it started',
+    ['runner_id'],
+)
+runner_cache_bytes = Gauge(
+    'scheduler_runner_cache_bytes',
+    'Total size of the file cache of a runner',
+    ['runner_id'],
+)
+runner_cache_gauges = {
+    'hits': runner_cache_hits,
+    'misses': runner_cache_misses,
+    'evicted_bytes': runner_cache_evicted_bytes,
+    'bytes': runner_cache_bytes,
+}
+
 seen_runners: Set[str] = set()
 _runner_poll_task: Task | None = None
 
@@ -93,6 +167,9 @@ async def _poll_runner_statuses():
                     runner_status.labels(runner_id=runner_id, status=s).set(
                         1 if status.status == s else 0
                     )
+                for name, value in status.cache.items():
+                    if name in runner_cache_gauges:
+                        runner_cache_gauges[name].labels(runner_id=runner_id).set(value)
             except Exception:
                 pass
         await sleep(runner_heartbeat_interval_secs)
@@ -1,15 +1,16 @@
 from asyncio import CancelledError, Task, create_task, sleep
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from logging import getLogger
 from time import time
 from typing import Dict, Optional
 
 from typing_extensions import Literal
 
-from commons.util import RedisQueues, format_exc
+from commons.util import Heartbeat, RedisQueues, TaskMessage, format_exc
 from scheduler2.config import (redis, redis_queues,
                                runner_heartbeat_interval_secs)
-from scheduler2.util import RunnerOfflineException, taskinfo_from_task_id
+from scheduler2.util import (RunnerOfflineException, push_task,
+                             taskinfo_from_task_id)
 
 logger = getLogger(__name__)
 
@@ -19,23 +20,32 @@ class RunnerStatus:
     status: Literal['invalid', 'idle', 'busy', 'offline']
     message: str
     last_seen: Optional[float]
+    # statistics of the runner's file cache, from its heartbeat
+    cache: Dict[str, int] = field(default_factory=dict)
 
 async def get_runner_status(runner_id: str):
-    heartbeat = None
+    last_seen = None
     try:
         runner_info = RedisQueues.RunnerInfo(runner_id, '')
         runner_queues = redis_queues.runner(runner_info)
         heartbeat_str = await redis.get(runner_queues.heartbeat)
-        heartbeat = float(heartbeat_str) if heartbeat_str is not None else None
+        heartbeat = Heartbeat.load(heartbeat_str) if heartbeat_str is not None else None
+        if heartbeat is not None:
+            last_seen = heartbeat.time
         if heartbeat is None \
-        or heartbeat < time() - runner_heartbeat_interval_secs * 2:
-            return RunnerStatus('offline', 'Offline', heartbeat)
+        or heartbeat.time < time() - runner_heartbeat_interval_secs * 2:
+            return RunnerStatus('offline', 'Offline', last_seen)
 
-        task_ids = await redis.lrange(runner_queues.in_progress, 0, -1)
+        messages = await redis.lrange(runner_queues.in_progress, 0, -1)
+        task_ids = [TaskMessage.id_of(x) for x in messages]
+        slots = len(heartbeat.slots)
         status: Literal['idle', 'busy', 'invalid']
         if len(task_ids) == 0:
             status = 'idle'
             msg = 'Idle'
+        elif len(task_ids) > slots:
+            status = 'invalid'
+            msg = 'More tasks are running on this runner than it has slots'
         elif len(task_ids) == 1:
             status = 'busy'
             task_id = task_ids[0]
@@ -45,16 +55,18 @@ async def get_runner_status(runner_id: str):
                 taskinfo = taskinfo_from_task_id[task_id]
                 msg = taskinfo.message
         else:
-            status = 'invalid'
-            msg = 'Multiple tasks are running on this runner'
-        return RunnerStatus(status, msg, heartbeat)
+            status = 'busy'
+            msg = f'Running {len(task_ids)} tasks in {slots} slots'
+        return RunnerStatus(status, msg, last_seen, heartbeat.cache)
     except Exception as e:
-        if not isinstance(heartbeat, float):
-            heartbeat = None
         msg = f'Cannot get runner status: {format_exc(e)}'
         logger.warn(msg, { 'error': e }, 'runner:status')
-        return RunnerStatus('invalid', msg, heartbeat)
+        return RunnerStatus('invalid', msg, last_seen)
+
 
+def runner_is_offline(heartbeat: Optional[str]) -> bool:
+    return heartbeat is None \
+        or Heartbeat.load(heartbeat).time < time() - runner_heartbeat_interval_secs * 5
 
 watch_tasks: Dict[str, Task] = {}
 
@@ -68,8 +80,7 @@ def wait_until_offline(runner_id: str):
         while True:
             await sleep(runner_heartbeat_interval_secs * 2)
             heartbeat = await redis.get(key)
-            if heartbeat is None \
-            or float(heartbeat) < time() - runner_heartbeat_interval_secs * 5:
+            if runner_is_offline(heartbeat):
                 raise RunnerOfflineException('Runner is offline')
     t = create_task(task())
     watch_tasks[runner_id] = t
@@ -83,3 +94,53 @@ def wait_until_offline(runner_id: str):
         del watch_tasks[runner_id]
     t.add_done_callback(cleanup)
     return t
+
+
+async def reclaim_tasks():
+    '''
+    Put tasks taken by offline runners, which the runners had not started,
+    back into their queues. Tasks that had been started are retried by
+    run_task once it notices that the runner is offline.
+    '''
+    async for key in redis.scan_iter(match=redis_queues.all_in_progress()):
+        runner_id = redis_queues.runner_id_from_in_progress(key)
+        runner_info = RedisQueues.RunnerInfo(runner_id, '')
+        heartbeat = await redis.get(redis_queues.runner(runner_info).heartbeat)
+        if not runner_is_offline(heartbeat):
+            continue
+        for message in await redis.lrange(key, 0, -1):
+            task_id = TaskMessage.id_of(message)
+            if await redis.lrem(key, 1, message) == 0:
+                continue
+            taskinfo = taskinfo_from_task_id.get(task_id)
+            if taskinfo is None or taskinfo.runner_id is not None:
+                continue
+            logger.info('reclaiming task %(id)s from offline runner %(runner)s', { 'id': task_id, 'runner': runner_id }, 'task:reclaim')
+            # consumers take tasks from the right end, so the task is
+            # picked up before anything queued after it.
+            await push_task(redis_queues.tasks_group(taskinfo.group), message, first=True)
+
+async def reclaim_tasks_worker():
+    while True:
+        await sleep(runner_heartbeat_interval_secs * 5)
+        try:
+            await reclaim_tasks()
+        except Exception as e:
+            logger.error('error reclaiming tasks: %(error)s', { 'error': e }, 'task:reclaim')
+
+
+reclaim_task: Optional[Task] = None
+
+async def start_reclaimer(app):
+    global reclaim_task
+    reclaim_task = create_task(reclaim_tasks_worker())
+
+async def stop_reclaimer(app):
+    global reclaim_task
+    if reclaim_task is not None:
+        reclaim_task.cancel()
+        try:
+            await reclaim_task
+        except CancelledError:
+            pass
+        reclaim_task = None
@@ -1,7 +1,10 @@
 __all__ = ('generate_plan', 'execute_plan', 'get_partial_result',
-           'languages_accepted', 'InvalidCodeException',
-           'InvalidProblemException')
+           'languages_accepted', 'load_plan', 'invalidate_plan',
+           'forget_runtimes',
+           'InvalidCodeException', 'InvalidProblemException')
 
+from scheduler2.plan.batch import forget_runtimes
+from scheduler2.plan.cache import invalidate_plan, load_plan
 from scheduler2.plan.execute import execute_plan, get_partial_result
 from scheduler2.plan.generate import generate_plan
 from scheduler2.plan.languages import languages_accepted
@@ -0,0 +1,97 @@
+__all__ = 'batch_judge_plans', 'load_runtimes', 'record_runtimes', \
+    'forget_runtimes'
+
+from logging import getLogger
+from typing import Dict, List, Optional
+
+from commons.task_typing import (BatchPlan, InputPlan, JudgeResult, JudgeTask,
+                                 JudgeTaskPlan, Testpoint)
+from scheduler2.config import (redis, runtimes_key, testpoint_runtime_ewma_alpha,
+                               testpoint_runtime_ttl_secs)
+from scheduler2.plan.generate import generate_dependents
+
+logger = getLogger(__name__)
+
+
+def estimate_msecs(testpoint: Testpoint[InputPlan],
+                   runtimes: Dict[str, float]) -> Optional[float]:
+    if testpoint.id in runtimes:
+        return runtimes[testpoint.id]
+    if testpoint.run is not None and testpoint.run.limits.time_msecs >= 0:
+        return testpoint.run.limits.time_msecs
+    return None
+
+def batch_judge_plans(plans: List[JudgeTaskPlan], batch: BatchPlan,
+                      runtimes: Dict[str, float]) -> List[JudgeTaskPlan]:
+    '''
+    Packs single-testpoint tasks that are not part of any dependency into
+    batches of about batch.target_msecs of running time, estimated from
+    historical runtimes and falling back to time limits. Other tasks and
+    the dependencies between them are kept as is.
+
+    The plans are shared with other submissions and are not modified.
+    '''
+    estimates: Dict[int, float] = {}
+    for i, plan in enumerate(plans):
+        if len(plan.task.testpoints) != 1 \
+        or len(plan.dependencies) > 0 or len(plan.dependents) > 0:
+            continue
+        estimate = estimate_msecs(plan.task.testpoints[0], runtimes)
+        if estimate is not None and estimate < batch.target_msecs:
+            estimates[i] = estimate
+
+    # first fit decreasing
+    batches: List[List[int]] = []
+    totals: List[float] = []
+    for i in sorted(estimates, key=lambda i: -estimates[i]):
+        for j, members in enumerate(batches):
+            if totals[j] + estimates[i] <= batch.target_msecs \
+            and len(members) < batch.max_testpoints:
+                members.append(i)
+                totals[j] += estimates[i]
+                break
+        else:
+            batches.append([i])
+            totals.append(estimates[i])
+    batch_of = dict((min(members), members) for members in batches)
+
+    batched: List[JudgeTaskPlan] = []
+    new_index: Dict[int, int] = {}
+    for i, plan in enumerate(plans):
+        if i in batch_of and len(batch_of[i]) > 1:
+            testpoints = [plans[x].task.testpoints[0] for x in sorted(batch_of[i])]
+            task = JudgeTask(testpoints, isolated=True)
+            batched.append(JudgeTaskPlan(task, [], []))
+        elif i in batch_of or not i in estimates:
+            new_index[i] = len(batched)
+            batched.append(JudgeTaskPlan(plan.task, plan.dependencies, []))
+    for plan in batched:
+        plan.dependencies = [new_index[x] for x in plan.dependencies]
+    return generate_dependents(batched)
+
+
+async def load_runtimes(problem_id: str) -> Dict[str, float]:
+    runtimes = await redis.hgetall(runtimes_key(problem_id))
+    return dict((id, float(x)) for id, x in runtimes.items())
+
+async def record_runtimes(problem_id: str, result: JudgeResult):
+    measured: Dict[str, int] = {}
+    for testpoint in result.testpoints:
+        if testpoint is not None and testpoint.resource_usage is not None \
+        and testpoint.resource_usage.time_msecs >= 0:
+            measured[testpoint.id] = testpoint.resource_usage.time_msecs
+    if len(measured) == 0:
+        return
+
+    key = runtimes_key(problem_id)
+    ids = list(measured)
+    alpha = testpoint_runtime_ewma_alpha
+    runtimes: Dict[str, float] = {}
+    for id, previous in zip(ids, await redis.hmget(key, ids)):
+        runtimes[id] = measured[id] if previous is None \
+            else float(previous) * (1 - alpha) + measured[id] * alpha
+    await redis.hset(key, mapping=runtimes)  # type: ignore
+    await redis.expire(key, testpoint_runtime_ttl_secs)
+
+async def forget_runtimes(problem_id: str):
+    await redis.delete(runtimes_key(problem_id))
@@ -0,0 +1,69 @@
+__all__ = 'load_plan', 'invalidate_plan'
+
+from asyncio import Task, create_task, shield
+from collections import OrderedDict
+from logging import getLogger
+from typing import Dict, Tuple
+
+from commons.task_typing import JudgePlan
+from commons.util import deserialize
+from scheduler2.config import plan_cache_size, plan_key, s3_buckets
+from scheduler2.metrics import plan_cache_lookups_total
+from scheduler2.s3 import read_file
+
+logger = getLogger(__name__)
+
+
+# Plans are keyed by (problem id, plan version). The version is bumped
+# every time a problem is updated, so a download that started before the
+# update can never put a stale plan back into the cache.
+#
+# Cached plans are shared between all submissions of the problem, and
+# must be treated as read-only by their users.
+plan_versions: Dict[str, int] = {}
+cached_plans: OrderedDict[Tuple[str, int], JudgePlan] = OrderedDict()
+loading_plans: Dict[Tuple[str, int], Task[JudgePlan]] = {}
+
+
+async def fetch_plan(problem_id: str) -> JudgePlan:
+    plan_str = await read_file(s3_buckets.problems, plan_key(problem_id))
+    plan = deserialize(plan_str)
+    logger.debug('plan for problem %(id)s loaded', { 'id': problem_id }, 'plan:load')
+    return plan
+
+
+async def load_plan(problem_id: str) -> JudgePlan:
+    version = plan_versions.get(problem_id, 0)
+    key = (problem_id, version)
+    if key in cached_plans:
+        plan_cache_lookups_total.labels(result='hit').inc()
+        cached_plans.move_to_end(key)
+        return cached_plans[key]
+
+    plan_cache_lookups_total.labels(result='miss').inc()
+    # concurrent submissions to a cold problem share a single download.
+    if key not in loading_plans:
+        task = create_task(fetch_plan(problem_id))
+        loading_plans[key] = task
+        def cleanup(_):
+            if loading_plans.get(key) is task:
+                del loading_plans[key]
+        task.add_done_callback(cleanup)
+    # shield the download so that aborting one judge does not abort the
+    # download other judges are waiting for.
+    plan = await shield(loading_plans[key])
+
+    if plan_versions.get(problem_id, 0) == version:
+        cached_plans[key] = plan
+        cached_plans.move_to_end(key)
+        while len(cached_plans) > plan_cache_size:
+            cached_plans.popitem(last=False)
+    return plan
+
+
+def invalidate_plan(problem_id: str):
+    version = plan_versions.get(problem_id, 0)
+    plan_versions[problem_id] = version + 1
+    cached_plans.pop((problem_id, version), None)
+    loading_plans.pop((problem_id, version), None)
+    logger.debug('plan cache for problem %(id)s invalidated', { 'id': problem_id }, 'plan:invalidate')
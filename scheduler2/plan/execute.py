@@ -1,32 +1,36 @@
 __all__ = 'execute_plan', 'get_partial_result'
 
 import json
-from asyncio import (FIRST_COMPLETED, CancelledError, Task, create_task, sleep,
-                     wait)
-from copy import deepcopy
+from asyncio import (FIRST_COMPLETED, CancelledError, Task, create_task, gather,
+                     sleep, wait)
+from copy import copy, deepcopy
 from dataclasses import dataclass, field
 from enum import Enum, auto
+from hashlib import sha256
 from logging import getLogger
 from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from typing_extensions import Literal, TypeAlias, TypeGuard, overload
+from typing_extensions import Literal, TypeAlias, overload
 
 from commons.task_typing import (Artifact, CodeLanguage, CompareChecker,
-                                 CompileResult, CompileSource,
+                                 CompileCache, CompileResult, CompileSource,
                                  CompileSourceCpp, CompileSourceGit,
                                  CompileSourceVerilog, CompileTask,
                                  CompileTaskPlan, DirectChecker,
-                                 GroupJudgeResult, Input, JudgePlan,
-                                 JudgeResult, JudgeTask, JudgeTaskPlan,
-                                 ProblemJudgeResult, QuizProblem,
-                                 ResourceUsage, ResultType, SourceLocation,
-                                 SpjChecker, StatusUpdate,
+                                 GroupJudgeResult, Input, InputPlan,
+                                 JudgePlan, JudgeResult, JudgeTask,
+                                 JudgeTaskPlan, ProblemJudgeResult,
+                                 QuizProblem, ResourceUsage, ResultType,
+                                 SourceLocation, SpjChecker, StatusUpdate,
                                  StatusUpdateProgress, StatusUpdateStarted,
                                  Testpoint, TestpointGroup,
                                  TestpointJudgeResult, UserCode)
-from commons.util import format_exc
-from scheduler2.config import s3_buckets
+from commons.util import format_exc, serialize
+from scheduler2.config import compile_cache_key, s3_buckets
 from scheduler2.dispatch import TaskInfo, run_task
+from scheduler2.metrics import compile_cache_lookups_total
+from scheduler2.plan.batch import (batch_judge_plans, load_runtimes,
+                                   record_runtimes)
 from scheduler2.plan.util import (InvalidCodeException,
                                   InvalidProblemException, sign_url)
 from scheduler2.s3 import (copy_file, read_file, remove_file, sign_url_get,
@@ -55,9 +59,13 @@ class DependencyNotSatisfied(str):
 
 @dataclass
 class JudgeTaskRecord:
-    task: JudgeTask[Input]
+    # the task as in the plan, with its own testpoints, as their
+    # dependencies are updated while the submission is judged.
+    task: JudgeTask[InputPlan]
     plan: JudgeTaskPlan
     result: Optional[JudgeResult] = None
+    # the task to run, with its urls signed by prepare_judge_task.
+    prepared: Optional[JudgeTask[Input]] = None
 
 @dataclass
 class ExecutionContext:
@@ -95,7 +103,7 @@ class ExecutionContext:
         else:
             raise Exception(f'Invalid url type {type}')
 
-    def dependencies_satisfied(self, rec: JudgeTaskRecord) -> TypeGuard[bool]:
+    def dependencies_satisfied(self, rec: JudgeTaskRecord) -> bool:
         def dependency_satisfied(testpoint: Testpoint) -> bool:
             dep = testpoint.dependent_on
             return dep is None or isinstance(dep, DependencyNotSatisfied) \
@@ -166,24 +174,52 @@ async def prepare_compile(ctx, plan):
     artifact = Artifact(ctx.file_url(UrlType.ARTIFACT, artifact_filename)) \
         if plan.artifact else None
     limits = deepcopy(plan.limits)
-    return CompileTask(source, supplementary_files, artifact, limits)
-
-
-async def get_judge_task(ctx: ExecutionContext, plan: JudgeTaskPlan) \
-    -> JudgeTaskRecord:
-    task: JudgeTask[Input] = deepcopy(plan.task)  # type: ignore
-    for testpoint in task.testpoints:
+    cache = get_compile_cache(ctx, plan) \
+        if isinstance(source, (CompileSourceCpp, CompileSourceVerilog)) \
+        else None
+    return CompileTask(source, supplementary_files, artifact, limits, cache,
+        plan.precompiled_headers[:])
+
+def get_compile_cache(ctx: ExecutionContext, plan: CompileTaskPlan) \
+    -> CompileCache:
+    # Retries and rejudges of a submission share the object. Runners check
+    # the hash of the actual inputs stored in it before using it.
+    h = sha256(f'{ctx.code.bucket}/{ctx.code.key}\n'.encode())
+    h.update(serialize(plan).encode())
+    key = compile_cache_key(h.hexdigest())
+    bucket = s3_buckets.artifacts
+    return CompileCache(sign_url_get(bucket, key), sign_url_put(bucket, key))
+
+
+def get_judge_record(plan: JudgeTaskPlan) -> JudgeTaskRecord:
+    task = copy(plan.task)
+    task.testpoints = [copy(x) for x in task.testpoints]
+    return JudgeTaskRecord(task, plan)
+
+async def prepare_judge_task(ctx: ExecutionContext, rec: JudgeTaskRecord):
+    '''
+    Copies the task of a record and signs its urls, right before it runs,
+    so that tasks never run (e.g. after a compile error, or with all their
+    testpoints skipped) cost nothing, and urls do not expire while earlier
+    tasks are running.
+    '''
+    if rec.prepared is not None:
+        return
+    testpoints: List[Testpoint[Input]] = []
+    for testpoint in deepcopy(rec.task.testpoints):
+        input: Input
         if isinstance(testpoint.input, UserCode):
             if ctx.compile_artifact is None:
                 ctx.compile_artifact = Artifact(ctx.file_url(UrlType.CODE,
                     raw_code_filename))
-            testpoint.input = ctx.compile_artifact
+            input = ctx.compile_artifact
         elif isinstance(testpoint.input, CompileTaskPlan):
-            testpoint.input = await prepare_compile(ctx, testpoint.input)
+            input = await prepare_compile(ctx, testpoint.input)
         elif isinstance(testpoint.input, CompileTask):
-            pass
+            input = testpoint.input
         elif isinstance(testpoint.input, Artifact):
             testpoint.input.url = sign_url(testpoint.input.url)
+            input = testpoint.input
         else:
             msg = f'Unknown testpoint input type at testpoint {testpoint.id}'
             raise InvalidProblemException(msg)
@@ -217,16 +253,30 @@ async def get_judge_task(ctx: ExecutionContext, plan: JudgeTaskPlan) \
                 sign_url(testpoint.check.executable.url)
             testpoint.check.supplementary_files = \
                 [sign_url(x) for x in testpoint.check.supplementary_files]
+        testpoints.append(Testpoint(testpoint.id, testpoint.dependent_on,
+            input, testpoint.run, testpoint.check))
 
-    return JudgeTaskRecord(task, deepcopy(plan))
+    rec.prepared = JudgeTask(testpoints, rec.task.isolated, ctx.plan.version)
+    # the user code is only known to be needed here if the testpoints run
+    # it directly.
+    await upload_code(ctx)
 
 async def get_judge_tasks(ctx: ExecutionContext) -> List[JudgeTaskRecord]:
-    return [await get_judge_task(ctx, plan) for plan in ctx.plan.judge]
+    plans = ctx.plan.judge
+    if ctx.plan.batch is not None:
+        try:
+            runtimes = await load_runtimes(ctx.problem_id)
+        except Exception as e:
+            logger.warn('cannot load testpoint runtimes: %(error)s', { 'error': e }, 'plan:execute:batch')
+            runtimes = {}
+        plans = batch_judge_plans(plans, ctx.plan.batch, runtimes)
+    return [get_judge_record(plan) for plan in plans]
 
 
 async def upload_code(ctx: ExecutionContext):
-    if ctx.code_key is not None:
-        bucket = s3_buckets.artifacts
+    bucket = s3_buckets.artifacts
+    if ctx.code_key is not None \
+    and (bucket, ctx.code_key) not in ctx.files_to_clean:
         logger.debug('uploading user code to %(bucket)s/%(key)s', { 'bucket': bucket, 'key': ctx.code_key }, 'code:upload')
         ctx.files_to_clean.add((bucket, ctx.code_key))
         await copy_file(ctx.code, bucket, ctx.code_key)
@@ -240,7 +290,11 @@ async def run_compile_task(ctx: ExecutionContext) -> Optional[CompileResult]:
             await update_status(ctx.id, 'compiling')
     msg = f'Compiling code for submission #{ctx.id}'
     task = TaskInfo(ctx.compile, ctx.id, ctx.problem_id, ctx.plan.group, msg)
-    return await run_task(task, onprogress, ctx.rate_limit_group)
+    res = await run_task(task, onprogress, ctx.rate_limit_group)
+    if res.cache_key is not None:
+        compile_cache_lookups_total \
+            .labels(result='hit' if res.cache_hit else 'miss').inc()
+    return res
 
 
 def skipped_result(name, message = 'Skipped'):
@@ -290,7 +344,8 @@ async def run_judge_tasks(ctx: ExecutionContext):
     await update_status(ctx.id, 'judging')
     records = ctx.judge
     assert records is not None
-    ready = list(filter(ctx.dependencies_satisfied, records))
+    ready: List[JudgeTaskRecord] = \
+        list(filter(ctx.dependencies_satisfied, records))
     ResType: TypeAlias = Task[Union[
         Tuple[JudgeTaskRecord, Literal[True], JudgeResult],
         Tuple[JudgeTaskRecord, Literal[False], Exception],
@@ -313,10 +368,12 @@ async def run_judge_tasks(ctx: ExecutionContext):
                         or ctx.results[testpoint1.id].result
                             in ('pending', 'judging')):
                         ctx.results[testpoint1.id] = testpoint1
+        prepared = task.prepared
+        assert prepared is not None
         async def run_with_rec():
             try:
                 msg = f'Running test for submission #{ctx.id}'
-                taskinfo = TaskInfo(task.task, ctx.id, ctx.problem_id,
+                taskinfo = TaskInfo(prepared, ctx.id, ctx.problem_id,
                                     ctx.plan.group, msg)
                 return (task, True, await run_task(taskinfo, onprogress,
                     ctx.rate_limit_group))
@@ -326,13 +383,16 @@ async def run_judge_tasks(ctx: ExecutionContext):
                 return (task, False, e)
         return create_task(run_with_rec())
     while len(ready) > 0 or len(tasks_running) > 0:
-        tasks_running.extend(filter(lambda x: x is not None, map(run, ready)))  # type: ignore
-        if len(tasks_running) == 0:
-            ready = []
-            break
         try:
+            await gather(*(prepare_judge_task(ctx, ready_record)
+                for ready_record in ready
+                if len(ready_record.task.testpoints) > 0))
+            tasks_running.extend(filter(lambda x: x is not None, map(run, ready)))  # type: ignore
+            if len(tasks_running) == 0:
+                ready = []
+                break
             done, pending = await wait(tasks_running, return_when=FIRST_COMPLETED)
-        except CancelledError:
+        except BaseException:
             for task in tasks_running:
                 if not task.cancelled():
                     task.cancel()
@@ -348,6 +408,11 @@ async def run_judge_tasks(ctx: ExecutionContext):
                     result='system_error',
                     message=str(error),
                 ) for x in record.plan.task.testpoints])
+            elif ctx.plan.batch is not None:
+                try:
+                    await record_runtimes(ctx.problem_id, res)
+                except Exception as e:
+                    logger.warn('cannot record testpoint runtimes: %(error)s', { 'error': e }, 'plan:execute:batch')
             record.result = res
 
             for testpoint in res.testpoints:
@@ -467,7 +532,6 @@ async def execute_plan(plan: JudgePlan, id: str, problem_id: str,
 
     try:
         ctx.compile = await prepare_compile(ctx, ctx.plan.compile)  # type: ignore
-        ctx.judge = await get_judge_tasks(ctx)
         await upload_code(ctx)
         compile_res = await run_compile_task(ctx)
         if compile_res is not None and compile_res.result != 'compiled':
@@ -489,6 +553,7 @@ async def execute_plan(plan: JudgePlan, id: str, problem_id: str,
         if compile_res is not None:
             ctx.compile_message = compile_res.message
         compiled = True
+        ctx.judge = await get_judge_tasks(ctx)
         await run_judge_tasks(ctx)
         return synthesize_scores(ctx)
     except CancelledError:
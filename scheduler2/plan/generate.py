@@ -5,28 +5,31 @@ from copy import deepcopy
 from dataclasses import dataclass, field
 from logging import getLogger
 from os import remove
-from typing import Dict, List, Optional, Set, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
+from uuid import uuid4
 from zipfile import ZipFile
 
 from typing_extensions import Literal, Type
 
-from commons.task_typing import (Artifact, Checker, CompareChecker,
-                                 CompileSourceCpp, CompileSourceVerilog,
-                                 CompileTask, CompileTaskPlan, DirectChecker,
+from commons.task_typing import (Artifact, BatchPlan, Checker,
+                                 CompareChecker, CompileSourceCpp,
+                                 CompileSourceVerilog, CompileTask,
+                                 CompileTaskPlan, DirectChecker,
                                  FileUrl, InteractorOptions, JudgePlan,
                                  JudgeTask, JudgeTaskPlan, QuizOption,
                                  QuizProblem, ResourceUsage, RunArgs, RunType,
                                  SpjChecker, Testpoint, TestpointGroup,
                                  UserCode)
-from commons.util import format_exc
+from commons.answer_hash import hash_answer
+from commons.util import asyncrun, format_exc
 from scheduler2.config import (default_check_limits, default_compile_limits,
                                default_run_limits, problem_config_filename,
                                quiz_filename, s3_buckets, working_dir)
 from scheduler2.dispatch import TaskInfo, run_task
 from scheduler2.plan.util import InvalidProblemException, sign_url, url_scheme
-from scheduler2.problem_typing import (Group, ProblemConfig, SpjConfig,
-                                       SpjConfigDesugared, SpjNumeric,
-                                       SpjProgram)
+from scheduler2.problem_typing import (BatchConfig, Group, ProblemConfig,
+                                       SpjConfig, SpjConfigDesugared,
+                                       SpjNumeric, SpjProgram)
 from scheduler2.problem_typing import Testpoint as ConfigTestpoint
 from scheduler2.problem_typing import spj_config_from_numeric
 from scheduler2.s3 import download, sign_url_put, upload_obj
@@ -49,6 +52,7 @@ class ParseContext:
     compile_tasks: List[CompileTask] = field(default_factory=lambda: [])
     compile_artifacts: Dict[str, Artifact] = field(default_factory=lambda: {})
     files_to_upload: Set[str] = field(default_factory=lambda: set())
+    answers_to_hash: List[Tuple[str, CompareChecker]] = field(default_factory=lambda: [])
     plan: JudgePlan = field(default_factory=lambda: JudgePlan())
 
     def file_key(self, filename: str):
@@ -121,6 +125,8 @@ async def load_config(ctx: ParseContext):
         if 'SPJ' not in cfg:
             cfg['SPJ'] = {}
         cfg['SPJ'] = desugar_spj_config(cfg['SPJ'])
+        if cfg.get('Batch') is not None:
+            cfg['Batch'] = BatchConfig(**cfg['Batch'])
         if '$schema' in cfg:
             del cfg['$schema']
         ctx.cfg = ProblemConfig(**cfg)
@@ -189,6 +195,10 @@ async def parse_compile(ctx: ParseContext) -> Optional[CompileTaskPlan]:
     # the compile task will be set to None in parse_testpoints.
     ctx.compile_per_testpoint = True
     task.artifact = False
+    if not ctx.cfg.Verilog:
+        # the user's header is precompiled once and shared by the
+        # testpoints.
+        task.precompiled_headers = [src_filename]
     return task
 
 
@@ -280,21 +290,28 @@ def parse_testpoint(ctx: ParseContext, conf: ConfigTestpoint) -> Testpoint:
                                                    interactor_exec_filename)
             run.interactor = InteractorOptions(executable=interactor, limits=run_limits, supplementary_files=[])
 
-    def ans() -> Optional[FileUrl]:
+    def ans_filename() -> Optional[str]:
         ans_filename = answer_name_template.format(id)
         if ans_filename in ctx.namelist():
-            return ctx.file_url(ans_filename)
+            return ans_filename
         ans_filename_alt = answer_name_template_alt.format(id)
         if ans_filename_alt in ctx.namelist():
-            return ctx.file_url(ans_filename_alt)
+            return ans_filename_alt
         return None
 
+    def ans() -> Optional[FileUrl]:
+        filename = ans_filename()
+        return None if filename is None else ctx.file_url(filename)
+
     check_cfg = ctx.cfg.SPJ.Check
     if check_cfg.Type == 'compare':
-        answer = ans()
+        answer = ans_filename()
         if answer is None:
             raise InvalidProblemException(f'Answer file needed for testpoint {id}')
-        check: Checker = CompareChecker(check_cfg.IgnoreInsignificantWhitespace, answer)
+        compare = CompareChecker(check_cfg.IgnoreInsignificantWhitespace,
+                                 ctx.file_url(answer))
+        ctx.answers_to_hash.append((answer, compare))
+        check: Checker = compare
     elif check_cfg.Type == 'skip':
         check = DirectChecker()
     elif check_cfg.Type == 'custom':
@@ -303,7 +320,7 @@ def parse_testpoint(ctx: ParseContext, conf: ConfigTestpoint) -> Testpoint:
                                             checker_source_filename,
                                             checker_exec_filename)
         check = SpjChecker(
-            format='checker',
+            format='batch' if check_cfg.Batch else 'checker',
             executable=checker,
             answer=ans(),
             supplementary_files=[],
@@ -379,6 +396,15 @@ async def parse_testpoints(ctx: ParseContext) -> List[JudgeTaskPlan]:
     return generate_dependents(plan)
 
 
+def parse_batch(ctx: ParseContext) -> Optional[BatchPlan]:
+    conf = ctx.cfg.Batch
+    if conf is None:
+        return None
+    if conf.TargetTime <= 0 or conf.MaxTestpoints <= 0:
+        raise InvalidProblemException('Batch.TargetTime and Batch.MaxTestpoints should be positive')
+    return BatchPlan(conf.TargetTime, conf.MaxTestpoints)
+
+
 group_name_template = 'Task {}'
 
 async def parse_groups(ctx: ParseContext) -> List[TestpointGroup]:
@@ -401,6 +427,16 @@ async def upload_files(ctx: ParseContext):
             await upload_obj(s3_buckets.problems, ctx.file_key(file), f)
 
 
+async def hash_answers(ctx: ParseContext):
+    # runners check outputs of compare checkers against these hashes, so
+    # they do not need to download answers.
+    def hash_all():
+        for filename, checker in ctx.answers_to_hash:
+            with ctx.open(filename, 'r') as f:
+                checker.answer_hash = hash_answer(f, checker.ignore_whitespace)
+    await asyncrun(hash_all)
+
+
 async def execute_compile_tasks(ctx: ParseContext):
     for task in ctx.compile_tasks:
         msg = f'Compiling SPJ for problem {ctx.problem_id}'
@@ -421,11 +457,14 @@ async def generate_plan(problem_id: str) -> JudgePlan:
             ctx = ParseContext(problem_id, zip, None)  # type: ignore
             await load_config(ctx)
             ctx.plan.group = ctx.cfg.RunnerGroup
+            ctx.plan.version = str(uuid4())
             if ctx.plan.quiz is not None:
                 return ctx.plan
             ctx.plan.compile = await parse_compile(ctx)
             ctx.plan.judge = await parse_testpoints(ctx)
+            ctx.plan.batch = parse_batch(ctx)
             ctx.plan.score = await parse_groups(ctx)
+            await hash_answers(ctx)
             await upload_files(ctx)
             await execute_compile_tasks(ctx)
             logger.debug('generated plan for %(id)s: %(plan)s', { 'id': problem_id, 'plan': ctx.plan }, 'plan:generate:done')
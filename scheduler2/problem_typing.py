@@ -50,6 +50,8 @@ class CheckConfig:
     IgnoreInsignificantWhitespace: bool = True
     # For custom
     Checker: Optional[SpjProgram] = None
+    # For custom: run one checker per task that checks all its testpoints
+    Batch: bool = False
 
 @dataclass
 class SpjConfig:
@@ -91,6 +93,13 @@ class Group:
     TestPoints: List[int]
     GroupName: Optional[str] = None
 
+@dataclass
+class BatchConfig:
+    # Independent testpoints are packed into runner tasks of about this
+    # much running time in total, in milliseconds.
+    TargetTime: int = 1000
+    MaxTestpoints: int = 16
+
 @dataclass
 class ProblemConfig:
     Details: List[Testpoint]
@@ -102,3 +111,4 @@ class ProblemConfig:
     Verilog: bool = False
     Quiz: bool = False
     RunnerGroup: str = DEFAULT_GROUP
+    Batch: Optional[BatchConfig] = None
@@ -0,0 +1,85 @@
+__all__ = 'subscribe_progress', 'unsubscribe_progress', 'next_progress', \
+    'start_progress_consumer', 'stop_progress_consumer'
+
+from asyncio import CancelledError, Queue, Task, create_task, sleep, wait_for
+from logging import getLogger
+from typing import Dict, Optional
+
+from scheduler2.config import (progress_read_batch, progress_read_block_msecs,
+                               redis, redis_queues)
+
+logger = getLogger(__name__)
+
+
+# Status updates from all runners go through a single Redis stream, which
+# is read by one consumer and demultiplexed to the tasks waiting on them.
+# This keeps the number of blocking Redis connections independent of the
+# number of tasks in flight.
+progress_queues: Dict[str, Queue[str]] = {}
+
+
+def subscribe_progress(task_id: str) -> Queue[str]:
+    '''
+    Must be called before the task is sent to runners, so that no status
+    update of the task is missed.
+    '''
+    queue: Queue[str] = Queue()
+    progress_queues[task_id] = queue
+    return queue
+
+def unsubscribe_progress(task_id: str):
+    progress_queues.pop(task_id, None)
+
+
+async def next_progress(queue: Queue[str], timeout: float) -> Optional[str]:
+    '''Returns the next serialized status update, or None on timeout.'''
+    try:
+        return await wait_for(queue.get(), max(timeout, 0))
+    except TimeoutError:
+        return None
+
+
+async def last_progress_id() -> str:
+    entries = await redis.xrevrange(redis_queues.progress, count=1)
+    if len(entries) == 0:
+        return '0-0'
+    id, _ = entries[0]
+    return id
+
+async def consume_progress():
+    stream = redis_queues.progress
+    last_id: Optional[str] = None
+    while True:
+        try:
+            if last_id is None:
+                last_id = await last_progress_id()
+            res = await redis.xread({ stream: last_id },
+                count=progress_read_batch, block=progress_read_block_msecs)
+            for _, entries in res:
+                for id, fields in entries:
+                    last_id = id
+                    queue = progress_queues.get(fields['task'])
+                    if queue is not None:
+                        queue.put_nowait(fields['status'])
+        except CancelledError:
+            raise
+        except Exception as e:
+            logger.error('error reading progress stream: %(error)s', { 'error': e }, 'task:progress')
+            await sleep(2)  # avoid busy loop when redis is unavailable
+
+
+consumer_task: Optional[Task] = None
+
+async def start_progress_consumer(app):
+    global consumer_task
+    consumer_task = create_task(consume_progress())
+
+async def stop_progress_consumer(app):
+    global consumer_task
+    if consumer_task is not None:
+        consumer_task.cancel()
+        try:
+            await consumer_task
+        except CancelledError:
+            pass
+        consumer_task = None
@@ -1,72 +1,153 @@
+from asyncio import sleep
+from collections import OrderedDict
+from logging import getLogger
 from pathlib import PosixPath
-from urllib.parse import urljoin
+from time import perf_counter, time
+from typing import Tuple
+from urllib.parse import quote, urljoin
 
+from aiohttp import ClientConnectionError, ClientPayloadError
 from boto3 import client as s3_client
 from botocore.utils import determine_content_length
-from botocore.client import ClientError
 from botocore.config import Config
 from commons.task_typing import SourceLocation
 from commons.util import asyncrun
 
-from scheduler2.config import s3_connection, task_timeout_secs
+from scheduler2.config import (s3_concurrency, s3_connection, s3_pool_size,
+                               s3_retries, signed_url_cache_size,
+                               signed_url_min_validity_secs,
+                               task_timeout_secs)
+from scheduler2.metrics import (signed_url_cache_lookups_total,
+                                signed_url_seconds_total, signed_urls_total)
+from scheduler2.s3_client import S3Client, client_error
 
+logger = getLogger(__name__)
+
+# boto3 only signs urls here, which needs no requests; objects are read
+# and written with the asyncio client.
 cfg = Config(signature_version='s3v4')
 s3 = s3_client('s3', **s3_connection, config=cfg)
+client = S3Client(**s3_connection, pool_size=s3_pool_size,
+    concurrency=s3_concurrency, retries=s3_retries)
+
+async def close_s3(_app = None):
+    await client.close()
 
 def construct_url(host: str, bucket: str, key: str) -> str:
     return urljoin(host, f'{bucket}/{key}')
 
+url_expires_secs = task_timeout_secs * 5
+
+def presign(method: str, params: dict) -> str:
+    start = perf_counter()
+    url = s3.generate_presigned_url(method, params, ExpiresIn=url_expires_secs)
+    signed_url_seconds_total.inc(perf_counter() - start)
+    signed_urls_total.labels(method=method).inc()
+    return url
+
 def sign_url_get(bucket: str, key: str, args: dict = {}):
-    return s3.generate_presigned_url('get_object', {
+    return presign('get_object', {
         'Bucket': bucket,
         'Key': key,
         **args,
-    }, ExpiresIn=task_timeout_secs * 5)
+    })
 
 def sign_url_put(bucket: str, key: str):
-    return s3.generate_presigned_url('put_object', {
+    return presign('put_object', {
         'Bucket': bucket,
         'Key': key,
-    }, ExpiresIn=task_timeout_secs * 5)
-
+    })
+
+
+# (bucket, key) -> (url, time it was signed). Problem files are signed for
+# every task they are used in, so their urls are reused instead, which
+# also gives runners the same url for the same file.
+signed_urls: OrderedDict[Tuple[str, str], Tuple[str, float]] = OrderedDict()
+
+def sign_url_get_cached(bucket: str, key: str) -> str:
+    '''
+    Like sign_url_get, but reuses the url signed earlier for the object
+    while it is valid for at least signed_url_min_validity_secs. Only for
+    objects read many times, such as problem files.
+    '''
+    now = time()
+    entry = signed_urls.get((bucket, key))
+    if entry is not None \
+    and entry[1] + url_expires_secs - now >= signed_url_min_validity_secs:
+        signed_url_cache_lookups_total.labels(result='hit').inc()
+        signed_urls.move_to_end((bucket, key))
+        return entry[0]
+    signed_url_cache_lookups_total.labels(result='miss').inc()
+    url = sign_url_get(bucket, key)
+    signed_urls[(bucket, key)] = (url, now)
+    signed_urls.move_to_end((bucket, key))
+    while len(signed_urls) > signed_url_cache_size:
+        signed_urls.popitem(last=False)
+    return url
+
+
+download_block_bytes = 4 * 1048576
 
 async def download(bucket: str, key: str, path: PosixPath):
-    await asyncrun(lambda: s3.download_file(bucket, key, str(path)))
+    '''
+    Downloads an object to a file. The connection could break while the
+    body is read, after the request itself succeeded, so the download is
+    started over in that case. The body is written in large blocks, so
+    that a download takes few turns of the thread pool.
+    '''
+    interval = 0.5
+    for i in range(client.retries + 1):
+        async with client.request('GetObject', 'GET', bucket, key) as resp:
+            try:
+                with open(path, 'wb') as f:
+                    block = bytearray()
+                    async for data, _ in resp.content.iter_chunks():
+                        block += data
+                        if len(block) >= download_block_bytes:
+                            await asyncrun(lambda: f.write(block))
+                            block = bytearray()
+                    if len(block) > 0:
+                        await asyncrun(lambda: f.write(block))
+                return
+            except (ClientConnectionError, ClientPayloadError) as e:
+                if i == client.retries:
+                    raise
+                logger.warning('cannot download %(bucket)s/%(key)s: %(error)s, will retry in %(interval)s seconds', { 'bucket': bucket, 'key': key, 'error': e, 'interval': interval }, 's3:retry')
+        await sleep(interval)
+        interval *= 2
 
 async def upload(bucket: str, key: str, file: PosixPath):
-    await asyncrun(lambda: s3.upload_file(str(file), bucket, key))
+    with open(file, 'rb') as f:
+        await upload_obj(bucket, key, f)
 
 async def copy_file(src: SourceLocation, bucket: str, key: str):
-    src_dict = {
-        'Bucket': src.bucket,
-        'Key': src.key,
-    }
-    await asyncrun(lambda: s3.copy_object(Bucket=bucket, Key=key,
-        CopySource=src_dict))
+    headers = { 'x-amz-copy-source': quote(f'{src.bucket}/{src.key}') }
+    async with client.request('CopyObject', 'PUT', bucket, key, headers) \
+        as resp:
+        body = await resp.read()
+    # copies could fail after the response has started, with status 200
+    # and the error in the body.
+    if b'<Error>' in body:
+        raise client_error(resp, body, 'CopyObject')
 
 async def upload_str(bucket: str, key: str, fileobj):
-    await asyncrun(lambda: s3.put_object(Bucket=bucket, Key=key, Body=fileobj))
+    async with client.request('PutObject', 'PUT', bucket, key, data=fileobj):
+        pass
 
 async def upload_obj(bucket: str, key: str, fileobj):
     length = determine_content_length(fileobj)
     if length is None:
         raise Exception(f'Unable to determine length of file {key}')
-    try:
-        await asyncrun(lambda: s3.upload_fileobj(fileobj, bucket, key))
-    except ClientError:
-        raise
-
-    # From https://github.com/boto/botocore/pull/1990#issuecomment-1171401468
-    # HOTFIX: patch to close session after upload if file being uploaded is empty
-    # We can remove this when this PR is merged to boto3:
-    # https://github.com/boto/botocore/pull/1990
-    if length == 0:
-        s3._endpoint.http_session._manager.clear()
+    headers = { 'content-length': str(length) }
+    async with client.request('PutObject', 'PUT', bucket, key, headers,
+        fileobj):
+        pass
 
 
 async def remove_file(bucket: str, key: str):
-    await asyncrun(lambda: s3.delete_object(Bucket=bucket, Key=key))
+    async with client.request('DeleteObject', 'DELETE', bucket, key):
+        pass
 
 async def read_file(bucket: str, key: str) -> str:
-    return await asyncrun(lambda:
-        s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode())
+    async with client.request('GetObject', 'GET', bucket, key) as resp:
+        return (await resp.read()).decode()
@@ -0,0 +1,188 @@
+__all__ = 'S3Client', 'client_error'
+
+import hmac
+from asyncio import Semaphore, sleep
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from hashlib import sha256
+from logging import getLogger
+from ssl import SSLContext, create_default_context
+from typing import Any, AsyncIterator, Dict, Optional, Union
+from urllib.parse import quote, urlsplit
+from xml.etree.ElementTree import ParseError, fromstring
+
+from aiohttp import (ClientConnectionError, ClientResponse, ClientSession,
+                     ClientTimeout, TCPConnector)
+from botocore.exceptions import ClientError
+from yarl import URL
+
+logger = getLogger(__name__)
+
+
+unsigned_payload = 'UNSIGNED-PAYLOAD'
+default_ports = { 'http': 80, 'https': 443 }
+
+def client_error(resp: ClientResponse, body: bytes, operation: str,
+                 retry_attempts: int = 0) -> ClientError:
+    # S3 errors are like <Error><Code>NoSuchKey</Code><Message>...</Message>
+    # </Error>, responses to HEAD have no body.
+    status = resp.status
+    try:
+        root = fromstring(body)
+        code, message = root.findtext('Code', str(status)), root.findtext('Message', '')
+    except ParseError:
+        code, message = str(status), ''
+    return ClientError({
+        'Error': { 'Code': code, 'Message': message },
+        'ResponseMetadata': {
+            'RequestId': resp.headers.get('x-amz-request-id', ''),
+            'HostId': resp.headers.get('x-amz-id-2', ''),
+            'HTTPStatusCode': status,
+            'HTTPHeaders': { k.lower(): v for k, v in resp.headers.items() },
+            'RetryAttempts': retry_attempts,
+        },
+    }, operation)
+
+
+class S3Client:
+    '''
+    A minimal asyncio S3 client, signing requests with SigV4 itself and
+    sending them with aiohttp, for the few operations the scheduler needs.
+    Requests use path-style urls and unsigned payloads, which S3 and MinIO
+    both accept. Errors are raised as botocore ClientErrors, as boto3 does,
+    so that callers could handle them the same way.
+
+    The client takes the same connection options as boto3 for those it
+    supports, and raises ValueError for the others, instead of connecting
+    without them. Failed requests are retried up to `retries` times.
+    '''
+
+    def __init__(self, *, aws_access_key_id: str, aws_secret_access_key: str,
+                 aws_session_token: Optional[str] = None,
+                 endpoint_url: Optional[str] = None,
+                 region_name: str = 'us-east-1',
+                 verify: Union[bool, str, None] = None,
+                 pool_size: int, concurrency: int, retries: int,
+                 **unsupported: Any):
+        if len(unsupported) > 0:
+            raise ValueError(f'S3 connection options not supported by the scheduler: {", ".join(unsupported)}')
+        if retries < 0:
+            raise ValueError(f'S3 retries must not be negative, got {retries}')
+        if endpoint_url is None:
+            endpoint_url = f'https://s3.{region_name}.amazonaws.com'
+        url = urlsplit(endpoint_url)
+        self.endpoint = f'{url.scheme}://{url.netloc}{url.path.rstrip("/")}'
+        self.base_path = url.path.rstrip('/')
+        self.host = url.hostname or ''
+        if url.port is not None and url.port != default_ports.get(url.scheme):
+            self.host += f':{url.port}'
+        self.access_key = aws_access_key_id
+        self.secret_key = aws_secret_access_key
+        self.session_token = aws_session_token
+        # as in boto3, verify is False to skip checking certificates, or
+        # the path of a CA bundle to check them against.
+        self.ssl: Union[bool, SSLContext] = True
+        if verify is False:
+            self.ssl = False
+        elif isinstance(verify, str):
+            self.ssl = create_default_context(cafile=verify)
+        self.region = region_name
+        self.pool_size = pool_size
+        self.semaphore = Semaphore(concurrency)
+        self.retries = retries
+        self._session: Optional[ClientSession] = None
+
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self.pool_size, ssl=self.ssl),
+                timeout=ClientTimeout(total=None, sock_connect=60, sock_read=300),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def sign(self, method: str, path: str, headers: Dict[str, str]) \
+        -> Dict[str, str]:
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = amz_date[:8]
+        headers = {
+            **{ k.lower(): v for k, v in headers.items() },
+            'host': self.host,
+            'x-amz-content-sha256': unsigned_payload,
+            'x-amz-date': amz_date,
+        }
+        if self.session_token is not None:
+            headers['x-amz-security-token'] = self.session_token
+        names = sorted(headers)
+        canonical_headers = ''.join(
+            f'{k}:{" ".join(headers[k].split())}\n' for k in names)
+        signed_headers = ';'.join(names)
+        canonical_request = '\n'.join([method, path, '', canonical_headers,
+            signed_headers, unsigned_payload])
+        scope = f'{date}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+            sha256(canonical_request.encode()).hexdigest()])
+        key = f'AWS4{self.secret_key}'.encode()
+        for part in date, self.region, 's3', 'aws4_request':
+            key = hmac.digest(key, part.encode(), 'sha256')
+        signature = hmac.new(key, string_to_sign.encode(), 'sha256').hexdigest()
+        headers['authorization'] = f'AWS4-HMAC-SHA256 ' \
+            f'Credential={self.access_key}/{scope}, ' \
+            f'SignedHeaders={signed_headers}, Signature={signature}'
+        return headers
+
+    async def send(self, operation: str, method: str, bucket: str,
+                   key: str, headers: Dict[str, str], data: Any) \
+        -> ClientResponse:
+        path = f'{self.base_path}/{quote(bucket)}/{quote(key)}'
+        url = URL(f'{self.endpoint}/{quote(bucket)}/{quote(key)}', encoded=True)
+        # files are sent again from where they were.
+        position = data.tell() if hasattr(data, 'seekable') \
+            and data.seekable() else None
+        replayable = data is None or isinstance(data, (bytes, str)) \
+            or position is not None
+        interval = 0.5
+        for i in range(self.retries + 1):
+            if i > 0 and position is not None:
+                data.seek(position)
+            try:
+                signed = self.sign(method, path, headers)
+                resp = await self.session().request(method, url,
+                    headers=signed, data=data)
+            except ClientConnectionError as e:
+                error: Exception = e
+            else:
+                if resp.status < 300:
+                    return resp
+                async with resp:
+                    body = await resp.read()
+                error = client_error(resp, body, operation, i)
+                # only server errors (e.g. 503 SlowDown) could go away.
+                if resp.status < 500:
+                    raise error
+            if not replayable or i == self.retries:
+                break
+            logger.warning('S3 request %(operation)s for %(bucket)s/%(key)s failed: %(error)s, will retry in %(interval)s seconds', { 'operation': operation, 'bucket': bucket, 'key': key, 'error': error, 'interval': interval }, 's3:retry')
+            await sleep(interval)
+            interval *= 2
+        raise error
+
+    @asynccontextmanager
+    async def request(self, operation: str, method: str, bucket: str,
+                      key: str, headers: Dict[str, str] = {},
+                      data: Any = None) -> AsyncIterator[ClientResponse]:
+        '''
+        Sends a request for an object, retrying on connection errors and
+        server errors if data could be sent again, and yields the response
+        once it is successful. At most `concurrency` requests are made at
+        the same time, including reading their responses.
+        '''
+        async with self.semaphore:
+            resp = await self.send(operation, method, bucket, key, headers, data)
+            async with resp:
+                yield resp
@@ -10,7 +10,8 @@ from typing_extensions import Generic, Literal, get_args, get_origin
 
 from commons.task_typing import TaskType
 from commons.util import dump_dataclass
-from scheduler2.config import (request_retries, request_retry_interval_secs,
+from scheduler2.config import (redis, redis_queues, request_retries,
+                               request_retry_interval_secs, task_timeout_secs,
                                web_auth, web_base_url)
 
 logger = getLogger(__name__)
@@ -75,10 +76,40 @@ class TaskInfo[Task: TaskType]:
     group: str
     message: str
     id: str = ''
+    # the runner that has started the task, if any.
+    runner_id: Optional[str] = None
 
 taskinfo_from_task_id: Dict[str, TaskInfo] = {}
 
 
+async def push_task(queue: str, message: str, *, first: bool = False):
+    '''
+    Pushes a task message to a task queue, and wakes up a runner waiting
+    for it. Consumers take tasks from the right end, so tasks pushed with
+    first set are taken before those already queued. Every queued task
+    has a wakeup token, which is removed along with the task.
+    '''
+    wakeup = redis_queues.wakeup(queue)
+    async with redis.pipeline(transaction=False) as pipe:
+        if first:
+            pipe.rpush(queue, message)
+        else:
+            pipe.lpush(queue, message)
+        pipe.lpush(wakeup, 1)
+        pipe.expire(wakeup, task_timeout_secs)
+        await pipe.execute()
+
+async def remove_task(queue: str, message: str) -> bool:
+    '''
+    Removes a task message from a task queue with its wakeup token, and
+    returns whether it was still there.
+    '''
+    if await redis.lrem(queue, 1, message) == 0:
+        return False
+    await redis.lpop(redis_queues.wakeup(queue))
+    return True
+
+
 class RunnerOfflineException (Exception): pass
 
 
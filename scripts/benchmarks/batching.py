@@ -0,0 +1,74 @@
+'''
+Simulate judging a submission with and without testpoint batching, to
+estimate the dispatch overhead per submission.
+
+Each runner task is charged a fixed overhead (queueing, temp dir, file
+revalidation, status updates) on top of the running time of its testpoints.
+Runners take tasks in plan order.
+
+Usage: python3 -m scripts.benchmarks.batching [-n TESTPOINTS] [-r RUNNERS]
+'''
+
+from argparse import ArgumentParser
+from heapq import heapify, heapreplace
+from random import Random
+
+from commons.task_typing import (BatchPlan, DirectChecker, JudgeTask,
+                                 JudgeTaskPlan, ResourceUsage, RunArgs,
+                                 Testpoint, UserCode)
+from scheduler2.plan.batch import batch_judge_plans
+
+
+def make_plans(testpoints: int, time_limit: int):
+    return [JudgeTaskPlan(JudgeTask([Testpoint(
+        id=str(i + 1),
+        dependent_on=None,
+        input=UserCode(),
+        run=RunArgs('elf', ResourceUsage(time_limit, -1, -1, -1), None, []),
+        check=DirectChecker(),
+    )]), [], []) for i in range(testpoints)]
+
+def simulate(plans, runtimes, runners: int, overhead: float):
+    # makespan of greedy list scheduling, and total overhead
+    finish = [0.0] * runners
+    heapify(finish)
+    for plan in plans:
+        cost = overhead + sum(runtimes[x.id] for x in plan.task.testpoints)
+        heapreplace(finish, finish[0] + cost)
+    return max(finish), overhead * len(plans)
+
+
+def main():
+    parser = ArgumentParser(description='simulate testpoint batching')
+    parser.add_argument('-n', '--testpoints', type=int, default=100)
+    parser.add_argument('-r', '--runners', type=int, default=8)
+    parser.add_argument('-t', '--time-limit', type=int, default=1000)
+    parser.add_argument('--mean-runtime', type=float, default=50,
+        help='mean running time of testpoints, in ms')
+    parser.add_argument('--overhead', type=float, default=80,
+        help='fixed cost of dispatching a task, in ms')
+    parser.add_argument('--target', type=int, default=1000)
+    parser.add_argument('--max-testpoints', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random = Random(args.seed)
+    plans = make_plans(args.testpoints, args.time_limit)
+    runtimes = dict((str(i + 1), min(random.expovariate(1 / args.mean_runtime),
+        args.time_limit)) for i in range(args.testpoints))
+    batch = BatchPlan(args.target, args.max_testpoints)
+
+    cases = [
+        ('unbatched', plans),
+        ('cold', batch_judge_plans(plans, batch, {})),
+        ('warm', batch_judge_plans(plans, batch, runtimes)),
+    ]
+    for name, case in cases:
+        makespan, overhead = simulate(case, runtimes, args.runners,
+            args.overhead)
+        print(f'{name:>10}: {len(case):5} tasks, '
+              f'overhead {overhead:9.1f} ms, makespan {makespan:9.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
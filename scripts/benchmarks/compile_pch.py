@@ -0,0 +1,81 @@
+'''
+Measure C++ compile latency in the sandbox with and without the
+precompiled headers built by the runner. Run on a runner, with its
+runner.yml in the working directory.
+
+Usage: python3 -m scripts.benchmarks.compile_pch [-n ROUNDS] [SOURCE]
+'''
+
+from argparse import ArgumentParser
+from asyncio import run
+from pathlib import PosixPath
+from shutil import copy2
+from statistics import mean, median
+from time import perf_counter
+
+from judger2.config import config
+from judger2.pch import build_pch, pch_dir
+from judger2.sandbox import run_with_limits
+from judger2.util import TempDir
+
+SAMPLE = r'''
+#include <bits/stdc++.h>
+using namespace std;
+
+int main() {
+    int n;
+    cin >> n;
+    vector<long long> a(n);
+    for (auto &x : a) cin >> x;
+    sort(a.begin(), a.end());
+    map<long long, int> count;
+    for (auto x : a) ++count[x];
+    cout << count.size() << endl;
+}
+'''
+
+
+async def compile_once(source: PosixPath, pch: PosixPath | None) -> float:
+    with TempDir() as cwd:
+        code_file = cwd / config.compiler.cxx.file_name
+        copy2(source, code_file)
+        include_dirs = [] if pch is None else ['-I', str(pch)]
+        start = perf_counter()
+        res = await run_with_limits(
+            'std',
+            ['/bin/g++'] + config.compiler.cxx.flags + include_dirs +
+                [str(code_file), '-o', str(cwd / config.compiler.cxx.exec_name)],
+            cwd, config.compiler.cxx.pch_limits,
+            supplementary_paths=[] if pch is None else [pch],
+        )
+        elapsed = perf_counter() - start
+        if res.error is not None:
+            raise Exception(f'compile failed: {res.message}')
+        return elapsed
+
+
+async def main():
+    parser = ArgumentParser(description='benchmark C++ compiles with precompiled headers')
+    parser.add_argument('-n', '--rounds', type=int, default=10)
+    parser.add_argument('source', nargs='?', help='C++ source to compile')
+    args = parser.parse_args()
+
+    await build_pch()
+    pch = pch_dir()
+    if pch is None:
+        print('precompiled headers are not available')
+        return
+
+    with TempDir() as d:
+        source = d / 'main.cpp'
+        if args.source is not None:
+            copy2(args.source, source)
+        else:
+            source.write_text(SAMPLE)
+        for name, dir in ('without pch', None), ('with pch', pch):
+            times = [await compile_once(source, dir) for _ in range(args.rounds)]
+            print(f'{name:>12}: mean {mean(times):.3f}s, median {median(times):.3f}s')
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,48 @@
+'''
+Measure the per-run cost of disk accounting in the sandbox: du in a
+separate nsjail, as every run used to do, against the in-process walker.
+Run on a runner, with its runner.yml in the working directory.
+
+Usage: python3 -m scripts.benchmarks.disk_usage [-n ROUNDS] [-f FILES]
+'''
+
+from argparse import ArgumentParser
+from asyncio import run
+from statistics import mean, median
+from time import perf_counter
+
+from judger2.sandbox import du_nsjail, walk_disk_usage
+from judger2.util import TempDir
+
+
+async def walker(cwd):
+    return walk_disk_usage(cwd)
+
+
+async def main():
+    parser = ArgumentParser(description='benchmark disk accounting of sandboxed runs')
+    parser.add_argument('-n', '--rounds', type=int, default=50)
+    parser.add_argument('-f', '--files', type=int, default=10,
+                        help='number of files in the working directory')
+    args = parser.parse_args()
+
+    with TempDir() as cwd:
+        # a typical working directory: a few small files and an output.
+        for i in range(args.files):
+            (cwd / f'file{i}').write_bytes(b'x' * 4096 * (i + 1))
+
+        du, walked = await du_nsjail(cwd), walk_disk_usage(cwd)
+        if du != walked:
+            print(f'warning: results differ, du: {du}, walker: {walked}')
+
+        for name, measure in ('du in nsjail', du_nsjail), ('walker', walker):
+            times = []
+            for _ in range(args.rounds):
+                start = perf_counter()
+                await measure(cwd)
+                times.append(perf_counter() - start)
+            print(f'{name:>12}: mean {mean(times) * 1000:.3f}ms, median {median(times) * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,78 @@
+'''
+Measure the scheduler CPU time spent preparing the judge tasks of a
+submission (copying them from the plan and signing their urls), comparing
+preparing all of them before compiling with preparing each task right
+before it runs.
+
+Signing urls is done locally by boto3, so this does not access S3, but it
+needs the scheduler config for the S3 credentials.
+
+Usage: python3 -m scripts.benchmarks.judge_prepare [-n TESTPOINTS]
+'''
+
+import asyncio
+from argparse import ArgumentParser
+from time import process_time
+
+from commons.task_typing import (Artifact, CodeLanguage, JudgePlan, JudgeTask,
+                                 JudgeTaskPlan, ResourceUsage, RunArgs,
+                                 SourceLocation, SpjChecker, Testpoint,
+                                 UserCode)
+from scheduler2.plan.execute import (ExecutionContext, get_judge_tasks,
+                                     prepare_judge_task)
+
+
+def make_plan(testpoints: int, supplementary_files: int) -> JudgePlan:
+    limits = ResourceUsage(1000, 256 * 1048576, -1, -1)
+    files = [f's3://1000/file{i}' for i in range(supplementary_files)]
+    return JudgePlan(judge=[JudgeTaskPlan(JudgeTask([Testpoint(
+        id=str(i + 1),
+        dependent_on=None,
+        input=UserCode(),
+        run=RunArgs('elf', limits, f's3://1000/{i + 1}.in', files[:]),
+        check=SpjChecker('checker', Artifact('s3://1000/spj_bin'),
+            f's3://1000/{i + 1}.ans', files[:], limits),
+    )]), [], []) for i in range(testpoints)])
+
+def new_context(plan: JudgePlan) -> ExecutionContext:
+    ctx = ExecutionContext(plan, 'benchmark', '1000', CodeLanguage.CPP,
+        SourceLocation('submissions', 'benchmark'), 'benchmark')
+    # as if compiled, so that no user code is uploaded.
+    ctx.compile_artifact = Artifact('https://example.com/benchmark/main')
+    return ctx
+
+async def prepare(plan: JudgePlan, prepared: bool):
+    ctx = new_context(plan)
+    records = await get_judge_tasks(ctx)
+    if prepared:
+        for record in records:
+            await prepare_judge_task(ctx, record)
+
+async def measure(plan: JudgePlan, prepared: bool, rounds: int) -> float:
+    start = process_time()
+    for _ in range(rounds):
+        await prepare(plan, prepared)
+    return (process_time() - start) / rounds * 1000
+
+
+async def main():
+    parser = ArgumentParser(description='benchmark judge task preparation')
+    parser.add_argument('-n', '--testpoints', type=int, default=100)
+    parser.add_argument('-s', '--supplementary-files', type=int, default=2)
+    parser.add_argument('-r', '--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    plan = make_plan(args.testpoints, args.supplementary_files)
+    # all tasks are prepared for a submission that is judged, and were
+    # prepared for every submission before; a compile error now prepares
+    # none of them.
+    cases = [
+        ('all tasks', await measure(plan, True, args.rounds)),
+        ('compile error', await measure(plan, False, args.rounds)),
+    ]
+    for name, msecs in cases:
+        print(f'{name:>14}: {msecs:9.2f} ms CPU per submission')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+'''
+Check the asyncio S3 client of the scheduler against the configured S3
+(or a local MinIO), and compare its throughput with boto3 calls run in
+the default thread pool, which is how the scheduler used to access S3.
+
+Objects are written under a random prefix in the artifacts bucket, and
+removed at the end.
+
+Usage: python3 -m scripts.benchmarks.s3_client [-n REQUESTS] [-s SIZE]
+'''
+
+import asyncio
+from argparse import ArgumentParser
+from io import BytesIO
+from pathlib import PosixPath
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import uuid4
+
+from botocore.exceptions import ClientError
+
+from commons.task_typing import SourceLocation
+from commons.util import asyncrun
+from scheduler2.config import s3_buckets
+from scheduler2.s3 import (close_s3, copy_file, download, read_file,
+                           remove_file, s3, upload_obj, upload_str)
+
+
+async def check(bucket: str, prefix: str):
+    key = f'{prefix}/check/a b+ü.txt'
+    await upload_str(bucket, key, 'hello')
+    assert await read_file(bucket, key) == 'hello'
+    await copy_file(SourceLocation(bucket, key), bucket, f'{key}.copy')
+    assert await read_file(bucket, f'{key}.copy') == 'hello'
+    for size in 0, 3 * 1048576:
+        data = bytes(i % 251 for i in range(size))
+        await upload_obj(bucket, f'{prefix}/check/{size}', BytesIO(data))
+        with TemporaryDirectory() as dir:
+            path = PosixPath(dir) / 'file'
+            await download(bucket, f'{prefix}/check/{size}', path)
+            assert path.read_bytes() == data
+        await remove_file(bucket, f'{prefix}/check/{size}')
+    await remove_file(bucket, key)
+    await remove_file(bucket, f'{key}.copy')
+    try:
+        await read_file(bucket, key)
+        assert False, 'removed object is still there'
+    except ClientError as e:
+        assert e.response['Error']['Code'] == 'NoSuchKey'
+    print('checks passed')
+
+
+async def measure(name: str, requests: int, op):
+    start = perf_counter()
+    await asyncio.gather(*(op(i) for i in range(requests)))
+    secs = perf_counter() - start
+    print(f'{name:>12}: {requests / secs:9.1f} requests/s')
+
+async def benchmark(bucket: str, prefix: str, requests: int, size: int):
+    data = b'x' * size
+    async def put_boto3(i):
+        await asyncrun(lambda: s3.put_object(Bucket=bucket,
+            Key=f'{prefix}/{i}', Body=data))
+    async def get_boto3(i):
+        await asyncrun(lambda: s3.get_object(Bucket=bucket,
+            Key=f'{prefix}/{i}')['Body'].read())
+    async def put_async(i):
+        await upload_obj(bucket, f'{prefix}/{i}', BytesIO(data))
+    async def get_async(i):
+        await read_file(bucket, f'{prefix}/{i}')
+    await measure('boto3 put', requests, put_boto3)
+    await measure('boto3 get', requests, get_boto3)
+    await measure('async put', requests, put_async)
+    await measure('async get', requests, get_async)
+    await asyncio.gather(*(remove_file(bucket, f'{prefix}/{i}')
+        for i in range(requests)))
+
+
+async def main():
+    parser = ArgumentParser(description='check and benchmark the S3 client')
+    parser.add_argument('-n', '--requests', type=int, default=500)
+    parser.add_argument('-s', '--size', type=int, default=4096,
+        help='size of objects, in bytes')
+    args = parser.parse_args()
+
+    bucket = s3_buckets.artifacts
+    prefix = f'benchmark-{uuid4()}'
+    try:
+        await check(bucket, prefix)
+        await benchmark(bucket, prefix, args.requests, args.size)
+    finally:
+        await close_s3()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+'''
+Measure the per-run overhead of run_with_limits with a program that does
+nothing, against spawning the same program without the sandbox. Run on a
+runner, with its runner.yml in the working directory.
+
+Usage: python3 -m scripts.benchmarks.sandbox_overhead [-n ROUNDS]
+'''
+
+from argparse import ArgumentParser
+from asyncio import run
+from statistics import mean, median
+from subprocess import DEVNULL
+from time import perf_counter
+
+from commons.task_typing import ResourceUsage
+from judger2.sandbox import run_with_limits
+from judger2.sandbox.process import spawn
+from judger2.util import TempDir
+
+limits = ResourceUsage(
+    time_msecs=1000,
+    memory_bytes=268435456,
+    file_count=-1,
+    file_size_bytes=-1,
+)
+
+
+async def sandboxed(cwd):
+    res = await run_with_limits('std', ['/bin/true'], cwd, limits)
+    if res.error is not None:
+        raise Exception(f'run failed: {res.message}')
+
+
+async def bare(_cwd):
+    await spawn(['true'], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).wait()
+
+
+async def main():
+    parser = ArgumentParser(description='benchmark the overhead of sandboxed runs')
+    parser.add_argument('-n', '--rounds', type=int, default=100)
+    args = parser.parse_args()
+
+    with TempDir() as cwd:
+        # the first run writes the profile config and creates a run dir.
+        await sandboxed(cwd)
+        for name, measure in ('bare', bare), ('sandboxed', sandboxed):
+            times = []
+            for _ in range(args.rounds):
+                start = perf_counter()
+                await measure(cwd)
+                times.append(perf_counter() - start)
+            print(f'{name:>9}: mean {mean(times) * 1000:.3f}ms, median {median(times) * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    run(main())
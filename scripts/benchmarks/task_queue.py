@@ -0,0 +1,94 @@
+'''
+Compare the old task dispatch protocol (task body in a list of its own,
+task id in the queue) with the inline one, against the configured Redis.
+Each protocol runs the same Redis commands as the scheduler and runners:
+LPUSH + EXPIRE + LPUSH and BRPOP + RPUSH + BRPOP + LREM per task before,
+LPUSH and BLMOVE + LREM now.
+
+Usage: python3 -m scripts.benchmarks.task_queue [-n TASKS] [-w WORKERS]
+'''
+
+from argparse import ArgumentParser
+from asyncio import gather, run
+from time import perf_counter, time
+from uuid import uuid4
+
+from commons.util import TaskMessage
+from scheduler2.config import redis
+
+PAYLOAD = '{"task": "' + 'x' * 2000 + '"}'
+
+
+async def legacy(prefix: str, tasks: int, workers: int):
+    # the commands of the old protocol: the scheduler pushed the task body
+    # to a list of its own, then the task id to the queue; the runner
+    # popped the id, recorded it as in progress and popped the body.
+    queue = f'{prefix}-tasks'
+
+    async def produce():
+        for i in range(tasks):
+            task_id = f'{i}'
+            await redis.lpush(f'{prefix}-task-{task_id}', PAYLOAD)
+            await redis.expire(f'{prefix}-task-{task_id}', 60)
+            await redis.lpush(queue, task_id)
+
+    async def consume(worker: int, count: int):
+        in_progress = f'{prefix}-in-progress-{worker}'
+        for _ in range(count):
+            res = await redis.brpop([queue], 10)
+            assert res is not None
+            _, task_id = res
+            await redis.rpush(in_progress, task_id)
+            res = await redis.brpop([f'{prefix}-task-{task_id}'], 10)
+            assert res is not None
+            await redis.lrem(in_progress, 0, task_id)
+
+    await run_workers(produce, consume, tasks, workers)
+
+
+async def inline(prefix: str, tasks: int, workers: int):
+    queue = f'{prefix}-tasks'
+
+    async def produce():
+        deadline = time() + 60
+        for i in range(tasks):
+            message = TaskMessage(f'{i}', deadline, PAYLOAD)
+            await redis.lpush(queue, message.dump())
+
+    async def consume(worker: int, count: int):
+        in_progress = f'{prefix}-in-progress-{worker}'
+        for _ in range(count):
+            message = await redis.blmove(queue, in_progress, 10, 'RIGHT', 'LEFT')
+            assert message is not None
+            TaskMessage.load(message)
+            await redis.lrem(in_progress, 1, message)
+
+    await run_workers(produce, consume, tasks, workers)
+
+
+async def run_workers(produce, consume, tasks: int, workers: int):
+    counts = [tasks // workers + (i < tasks % workers) for i in range(workers)]
+    await gather(produce(), *(consume(i, c) for i, c in enumerate(counts)))
+
+
+async def main():
+    parser = ArgumentParser(description='benchmark task dispatch over Redis')
+    parser.add_argument('-n', '--tasks', type=int, default=5000)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    for name, protocol in ('legacy', legacy), ('inline', inline):
+        prefix = f'benchmark-{uuid4()}'
+        start = perf_counter()
+        try:
+            await protocol(prefix, args.tasks, args.workers)
+        finally:
+            keys = [key async for key in redis.scan_iter(f'{prefix}-*')]
+            if keys:
+                await redis.delete(*keys)
+        elapsed = perf_counter() - start
+        print(f'{name:>8}: {args.tasks / elapsed:10.1f} tasks/s ({elapsed:.3f}s)')
+
+
+if __name__ == '__main__':
+    run(main())